@@ -0,0 +1,571 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+БЕНЧМАРКИ АСТРОЛОГИЧЕСКОГО БОТА
+Работают без Telegram: запросы к Bot API обслуживает локальный FakeBotAPI,
+а данные бота пишутся во временную папку (настоящая data/ не затрагивается).
+
+    python benchmark.py lookups      # обращения к БД на один апдейт
+    python benchmark.py broadcast    # рассылка: скорость, блокировки, RetryAfter
+    python benchmark.py webhook      # апдейтов в секунду: webhook против polling
+    python benchmark.py latency      # задержка ответа по сценариям: гороскоп, карта дня, 3 карты
+    python benchmark.py render       # сборка текста гороскопа: конкатенация/format против шаблонов
+    python benchmark.py moon         # фаза Луны: средний цикл против таблицы эфемерид (скорость и точность)
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import timeit
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, PROJECT_DIR)
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("PAYMENT_PROVIDER_TOKEN", "BENCHMARK")
+os.environ.setdefault("PORT", "0")
+os.chdir(tempfile.mkdtemp(prefix="astrology_bench_"))
+
+import bot  # noqa: E402  (импорт после подготовки окружения)
+from telegram import Update  # noqa: E402
+from telegram.ext import TypeHandler  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+BENCH_USER_ID = 1000
+
+# ====== ЛОКАЛЬНЫЙ BOT API ======
+class FakeBotAPI(BaseRequest):
+    """Отвечает на вызовы Bot API локально, с настраиваемой задержкой «сети»"""
+
+    def __init__(self, latency=0.0, blocked_chats=(), flood_every=0, flood_retry_after=1):
+        self.latency = latency
+        self.calls = Counter()
+        self.message_id = 0
+        # Имитация ошибок: чаты, заблокировавшие бота (403), и 429 на каждом flood_every-м sendMessage
+        self.blocked_chats = set(blocked_chats)
+        self.flood_every = flood_every
+        self.flood_retry_after = flood_retry_after
+        # Очередь апдейтов для getUpdates (бенчмарк polling)
+        self.updates = []
+        # Момент последнего ответа (бенчмарк задержки)
+        self.last_response = 0.0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def fake_message(self, chat_id, photo=None):
+        self.message_id += 1
+        message = {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "text": "ok",
+        }
+        if photo is not None:
+            # Как настоящий Bot API: загруженное фото получает file_id, отправка по file_id его сохраняет
+            file_id = photo if photo.startswith("file-") else "file-" + str(abs(hash(photo)))
+            message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 512, "height": 512}]
+        return message
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data else {}
+        chat_id = params.get("chat_id", BENCH_USER_ID)
+        if endpoint == "sendMessage":
+            if int(chat_id) in self.blocked_chats:
+                return 403, json.dumps({
+                    "ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user",
+                }).encode()
+            if self.flood_every and self.calls[endpoint] % self.flood_every == 0:
+                return 429, json.dumps({
+                    "ok": False, "error_code": 429, "description": "Too Many Requests",
+                    "parameters": {"retry_after": self.flood_retry_after},
+                }).encode()
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif endpoint == "getUpdates":
+            if self.updates:
+                limit = int(params.get("limit") or 100)
+                result, self.updates = self.updates[:limit], self.updates[limit:]
+            else:
+                # Апдейтов нет — long polling просто ждёт впустую
+                await asyncio.sleep(0.1)
+                result = []
+        elif endpoint == "sendMediaGroup":
+            result = [self.fake_message(chat_id, str(media.get("media"))) for media in params.get("media", [])]
+        elif endpoint == "sendPhoto":
+            result = self.fake_message(chat_id, str(params.get("photo")))
+        elif endpoint.startswith("send"):
+            result = self.fake_message(chat_id)
+        else:
+            result = True
+        self.last_response = time.perf_counter()
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+# ====== СИНТЕТИЧЕСКИЕ АПДЕЙТЫ ======
+def make_message_update(update_id, text, user_id=BENCH_USER_ID):
+    user = {"id": user_id, "is_bot": False, "first_name": "Bench"}
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": user,
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+def make_callback_update(update_id, data, user_id=BENCH_USER_ID):
+    user = {"id": user_id, "is_bot": False, "first_name": "Bench"}
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user,
+            "chat_instance": "bench",
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "text": "menu",
+            },
+        },
+    }
+
+LOOKUP_FLOWS = {
+    "/start": lambda i: make_message_update(i, "/start"),
+    "🔮 Гороскоп": lambda i: make_message_update(i, "🔮 Гороскоп"),
+    "♌️ Лев": lambda i: make_message_update(i, "♌️ Лев"),
+    "📊 Статистика": lambda i: make_message_update(i, "📊 Статистика"),
+    "tarot_daily": lambda i: make_callback_update(i, "tarot_daily"),
+}
+
+# ====== БЕНЧМАРК: ОБРАЩЕНИЯ К БД НА АПДЕЙТ ======
+def count_db_lookups():
+    """Оборачивает is_premium/get_user счётчиками; возвращает Counter"""
+    counter = Counter()
+    for name in ("is_premium", "get_user"):
+        original = getattr(type(bot.db), name)
+        def wrapper(user_id, _original=original, _name=name):
+            counter[_name] += 1
+            return _original(bot.db, user_id)
+        setattr(bot.db, name, wrapper)
+    return counter
+
+class LegacyUpdateContext:
+    """Как код до контекста апдейта: каждое обращение к статусу — отдельный поход в БД"""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+
+    @property
+    def is_premium(self):
+        return bot.db.is_premium(self.user_id)
+
+    @is_premium.setter
+    def is_premium(self, value):
+        pass
+
+    @property
+    def user(self):
+        return bot.db.get_user(self.user_id)
+
+def legacy_lookup_path(app):
+    """Эмуляция пути до контекста апдейта (без TypeHandler группы -1)"""
+    get_update_context = bot.get_update_context
+    context_handlers = list(app.handlers.get(-1, []))
+    for handler in context_handlers:
+        app.remove_handler(handler, group=-1)
+    bot.get_update_context = lambda update, context: LegacyUpdateContext(update.effective_user.id)
+    def restore():
+        bot.get_update_context = get_update_context
+        for handler in context_handlers:
+            app.add_handler(handler, group=-1)
+    return restore
+
+async def run_lookups(rounds):
+    app = bot.build_application(request=FakeBotAPI())
+    await app.initialize()
+    bot.db.add_user(BENCH_USER_ID, "bench", "Bench")
+    bot.db.add_premium(BENCH_USER_ID, 30)
+    counter = count_db_lookups()
+    update_id = 0
+    print(f"{'Сценарий':<16}{'до (эмуляция)':>16}{'после':>10}")
+    for flow, factory in LOOKUP_FLOWS.items():
+        results = []
+        for legacy in (True, False):
+            restore = legacy_lookup_path(app) if legacy else None
+            counter.clear()
+            for _ in range(rounds):
+                update_id += 1
+                await app.process_update(Update.de_json(factory(update_id), app.bot))
+            if restore:
+                restore()
+            results.append(sum(counter.values()) / rounds)
+        before, after = results
+        print(f"{flow:<16}{before:>16.1f}{after:>10.1f}")
+    await app.shutdown()
+
+# ====== БЕНЧМАРК: РАССЫЛКА ======
+async def run_broadcast(users, latency, blocked_ratio, flood_every, rate, workers):
+    user_ids = list(range(1, users + 1))
+    blocked = user_ids[:int(users * blocked_ratio)]
+    api = FakeBotAPI(latency=latency, blocked_chats=blocked, flood_every=flood_every)
+    app = bot.build_application(request=api)
+    await app.initialize()
+    job = bot.BroadcastJob.create("benchmark", [str(uid) for uid in user_ids])
+    broadcast = bot.Broadcast(app.bot, job, workers=workers,
+                              bucket=bot.TokenBucket(rate), chat_limiter=bot.ChatRateLimiter())
+    started = time.perf_counter()
+    progress = await broadcast.run()
+    elapsed = time.perf_counter() - started
+    await app.shutdown()
+    sequential = users * latency
+    print(f"Получателей: {users}, задержка API: {latency * 1000:.0f} мс, лимит: {rate:g}/сек, воркеров: {workers}")
+    print(f"Доставлено: {progress['sent']}, заблокировали: {progress['blocked']}, "
+          f"ошибки: {progress['failed']}, повторы после 429/сети: {progress['retries']}")
+    print(f"Время: {elapsed:.2f} сек ({progress['done'] / elapsed:.1f} сообщ./сек); "
+          f"последовательно было бы ≥ {sequential:.2f} сек")
+
+# ====== БЕНЧМАРК: WEBHOOK ПРОТИВ POLLING ======
+LOAD_FLOWS = [
+    lambda i, user_id: make_message_update(i, "/start", user_id),
+    lambda i, user_id: make_message_update(i, "🔮 Гороскоп", user_id),
+    lambda i, user_id: make_message_update(i, "📊 Статистика", user_id),
+    lambda i, user_id: make_message_update(i, "ℹ️ Помощь", user_id),
+    lambda i, user_id: make_callback_update(i, "tarot_daily", user_id),
+]
+
+def make_load_updates(count, users):
+    return [LOAD_FLOWS[i % len(LOAD_FLOWS)](i + 1, 1 + i % users) for i in range(count)]
+
+def count_processed(app):
+    """Группа 99 выполняется последней — её вызов значит, что апдейт полностью обработан"""
+    state = {'done': 0, 'event': asyncio.Event(), 'target': 0}
+    async def done(update, context):
+        state['done'] += 1
+        if state['done'] >= state['target']:
+            state['event'].set()
+    app.add_handler(TypeHandler(Update, done), group=99)
+    return state
+
+async def post_updates(port, updates, connections):
+    """Шлёт апдейты POST-запросами по нескольким keep-alive соединениям, как это делает Telegram"""
+    async def sender(chunk):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        for update in chunk:
+            body = json.dumps(update).encode()
+            writer.write(
+                f"POST {bot.WEBHOOK_PATH} HTTP/1.1\r\nHost: bench\r\nContent-Type: application/json\r\n"
+                f"X-Telegram-Bot-Api-Secret-Token: {bot.WEBHOOK_SECRET}\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+            status = await reader.readline()
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b""):
+                    break
+                if line.lower().startswith(b"content-length:"):
+                    length = int(line.split(b":")[1])
+            await reader.readexactly(length)
+            if b" 200 " not in status:
+                raise RuntimeError(f"webhook ответил {status!r}")
+        writer.close()
+    await asyncio.gather(*(sender(updates[i::connections]) for i in range(connections)))
+
+async def run_webhook_load(updates, concurrency, connections, latency):
+    api = FakeBotAPI(latency=latency)
+    app = bot.build_application(request=api, concurrent_updates=concurrency)
+    state = count_processed(app)
+    state['target'] = len(updates)
+    await app.initialize()
+    await app.start()
+    await bot.start_http_server(app)
+    bot.WEBHOOK_ACTIVE = True
+    port = bot.HTTP_SERVER.sockets[0].getsockname()[1]
+    started = time.perf_counter()
+    await post_updates(port, updates, connections)
+    accepted = time.perf_counter() - started
+    await state['event'].wait()
+    elapsed = time.perf_counter() - started
+    bot.WEBHOOK_ACTIVE = False
+    await bot.stop_http_server()
+    await app.stop()
+    await app.shutdown()
+    return elapsed, accepted
+
+async def run_polling_load(updates, latency, concurrency=1):
+    api = FakeBotAPI(latency=latency)
+    app = bot.build_application(request=api, concurrent_updates=concurrency)
+    state = count_processed(app)
+    state['target'] = len(updates)
+    await app.initialize()
+    await app.start()
+    api.updates = list(updates)
+    started = time.perf_counter()
+    await app.updater.start_polling(poll_interval=0)
+    await state['event'].wait()
+    elapsed = time.perf_counter() - started
+    await app.updater.stop()
+    await app.stop()
+    await app.shutdown()
+    return elapsed
+
+async def run_webhook_bench(count, users, concurrency, connections, latency):
+    print(f"Апдейтов: {count}, пользователей: {users}, задержка Bot API: {latency * 1000:.0f} мс")
+    polling = await run_polling_load(make_load_updates(count, users), latency)
+    print(f"polling (последовательно):          {polling:7.2f} сек  {count / polling:8.1f} апд./сек")
+    polling = await run_polling_load(make_load_updates(count, users), latency, concurrency)
+    print(f"polling ({concurrency} параллельно):            {polling:7.2f} сек  {count / polling:8.1f} апд./сек")
+    webhook, accepted = await run_webhook_load(make_load_updates(count, users), concurrency, connections, latency)
+    print(f"webhook ({concurrency} параллельно, {connections} соед.): {webhook:7.2f} сек  {count / webhook:8.1f} апд./сек"
+          f"  (приём: {count / accepted:.0f} апд./сек)")
+
+# ====== БЕНЧМАРК: ЗАДЕРЖКА ОТВЕТА ПО СЦЕНАРИЯМ ======
+LATENCY_FLOWS = {
+    "♌️ Лев": lambda i, user_id: make_message_update(i, "♌️ Лев", user_id),
+    "tarot_daily": lambda i, user_id: make_callback_update(i, "tarot_daily", user_id),
+    "tarot_three": lambda i, user_id: make_callback_update(i, "tarot_three", user_id),
+}
+
+def percentile_ms(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] * 1000
+
+async def run_latency(rounds, latency):
+    """
+    Для каждого сценария: сколько обработчик держит слот и когда пользователь получил последнее
+    сообщение (ответ Bot API на последний вызов). Каждый раунд — новый пользователь, чтобы
+    ограничения одного чата не смешивались между раундами.
+    """
+    api = FakeBotAPI(latency=latency)
+    app = bot.build_application(request=api)
+    await app.initialize()
+    pipeline = getattr(bot, "SEND_PIPELINE", None)
+    print(f"Раундов: {rounds}, задержка Bot API: {latency * 1000:.0f} мс")
+    print(f"{'Сценарий':<14}{'вызовов API':>12}{'слот p50':>10}{'ответ p50':>11}{'ответ p95':>11}")
+    update_id = 0
+    for flow, factory in LATENCY_FLOWS.items():
+        handler_times, reply_times = [], []
+        calls_before = sum(api.calls.values())
+        for _ in range(rounds):
+            update_id += 1
+            user_id = 5000 + update_id
+            bot.db.add_user(user_id, "bench", "Bench")
+            bot.db.add_premium(user_id, 30)
+            update = Update.de_json(factory(update_id, user_id), app.bot)
+            started = time.perf_counter()
+            await app.process_update(update)
+            handler_times.append(time.perf_counter() - started)
+            if pipeline is not None:
+                await pipeline.flush(user_id)
+            reply_times.append(api.last_response - started)
+        calls = (sum(api.calls.values()) - calls_before) / rounds
+        print(f"{flow:<14}{calls:>12.1f}{percentile_ms(handler_times, 0.5):>8.0f}мс"
+              f"{percentile_ms(reply_times, 0.5):>9.0f}мс{percentile_ms(reply_times, 0.95):>9.0f}мс")
+    await app.shutdown()
+
+# ====== БЕНЧМАРК: СБОРКА ТЕКСТА ГОРОСКОПА ======
+def legacy_basic_assembly(zodiac_sign, date_str, time_period, time_text, moon_name, moon_desc,
+                          energy, love, career, health, advice, unique_phrase):
+    """Сборка базового гороскопа так, как это делалось до шаблонов (12 конкатенаций)"""
+    intro = "✨ *Гороскоп для " + zodiac_sign + "* ✨\n*На " + date_str + "*\n\n"
+    time_section = "🌅 *" + time_period.title() + ":* " + time_text + "\n\n"
+    moon_section = moon_name + " — " + moon_desc + "\n\n"
+    main_text = energy + "\n\n"
+    love_line = "💖 *Любовь:* " + love + "\n\n"
+    career_line = "💼 *Карьера:* " + career + "\n\n"
+    health_line = "🌿 *Здоровье:* " + health + "\n\n"
+    advice_line = "💫 *Совет:* " + advice + "\n\n"
+    horoscope = intro + time_section + moon_section + main_text + love_line + career_line + health_line + advice_line
+    if unique_phrase:
+        horoscope += "*Особенность для вашего знака:* " + unique_phrase + "\n\n"
+    horoscope += "#" + zodiac_sign.split()[-1] + " #Астрология #Гороскоп"
+    return horoscope
+
+LEGACY_PREMIUM_ADDITION = """
+
+✨ *ПРЕМИУМ ДОПОЛНЕНИЕ* ✨
+
+*Астрологические детали:*
+• Луна в знаке: {moon}
+• Благоприятное время: {time}
+• Камень-талисман: {stone}
+• Цвет удачи: {color}
+
+*Недельный прогноз:*
+{weekly}
+
+#Премиум"""
+
+def run_render(number):
+    sign = "♌️ Лев"
+    now = datetime(2026, 3, 1, 13, 0)
+    date_str = bot.get_current_date_string(now)
+    moon_name, moon_desc = bot.get_moon_phase(now)
+    phrases = dict(energy=bot.ENERGY_TEXTS[0], love=bot.LOVE_TEXTS[0], career=bot.CAREER_TEXTS[0],
+                   health=bot.HEALTH_TEXTS[0], advice=bot.ADVICE_TEXTS[0], time_text=bot.TIME_PERIOD_TEXTS["день"][0])
+    unique_phrase = bot.ZODIAC_UNIQUE[sign][0]
+    template = bot.BASIC_TEMPLATES[(sign, "день")]
+    premium = dict(moon="Льва", time="утро 9-11", stone="цитрин", color="золотой", weekly=bot.PREMIUM_WEEKLY[0])
+    premium_values = tuple(premium.values())
+
+    def legacy_basic():
+        return legacy_basic_assembly(sign, date_str, "день", phrases["time_text"], moon_name, moon_desc,
+                                     phrases["energy"], phrases["love"], phrases["career"], phrases["health"],
+                                     phrases["advice"], unique_phrase)
+
+    def compiled_basic():
+        # Так зовёт render_basic_horoscope: знак и период уже в шаблоне, значения — в порядке BASIC_SLOTS
+        return template.fill((date_str, phrases["time_text"], moon_name, moon_desc, phrases["energy"], phrases["love"],
+                              phrases["career"], phrases["health"], phrases["advice"], bot.ZODIAC_UNIQUE_LINES[sign][0]))
+
+    def legacy_basic_full():
+        """Весь прежний render_basic_horoscope: те же выборки, сборка конкатенацией"""
+        rng = bot.horoscope_rng(now.strftime("%Y-%m-%d"), sign, 42)
+        time_period, time_texts = bot.get_time_period(now)
+        moon = bot.get_moon_phase(now)
+        energy, love, career = rng.choice(bot.ENERGY_TEXTS), rng.choice(bot.LOVE_TEXTS), rng.choice(bot.CAREER_TEXTS)
+        health, advice, time_text = rng.choice(bot.HEALTH_TEXTS), rng.choice(bot.ADVICE_TEXTS), rng.choice(time_texts)
+        return legacy_basic_assembly(sign, bot.get_current_date_string(now), time_period, time_text, moon[0], moon[1],
+                                     energy, love, career, health, advice, rng.choice(bot.ZODIAC_UNIQUE[sign]))
+
+    assert legacy_basic() == compiled_basic(), "шаблон расходится со старой сборкой"
+    assert legacy_basic_full() == bot.render_basic_horoscope(sign, 42, now=now), "гороскоп расходится со старой сборкой"
+    assert LEGACY_PREMIUM_ADDITION.format(**premium) == bot.PREMIUM_ADDITION_TEMPLATE.fill(premium_values)
+    cases = [
+        ("базовый: сборка", legacy_basic, compiled_basic),
+        ("премиум-дополнение", lambda: LEGACY_PREMIUM_ADDITION.format(**premium),
+         lambda: bot.PREMIUM_ADDITION_TEMPLATE.fill(premium_values)),
+        ("базовый: целиком", legacy_basic_full, lambda: bot.render_basic_horoscope(sign, 42, now=now)),
+    ]
+    print(f"Повторов: {number}")
+    print(f"{'Что собираем':<22}{'было, мкс':>11}{'стало, мкс':>12}{'ускорение':>11}")
+    for name, before, after in cases:
+        after_us = min(timeit.repeat(after, number=number, repeat=5)) / number * 1e6
+        before_us = min(timeit.repeat(before, number=number, repeat=5)) / number * 1e6
+        print(f"{name:<22}{before_us:>11.2f}{after_us:>12.2f}{before_us / after_us:>10.1f}x")
+
+# ====== БЕНЧМАРК: ФАЗА ЛУНЫ ======
+LEGACY_KNOWN_NEW_MOON = datetime(2000, 1, 6, 18, 14)
+LEGACY_LUNAR_CYCLE = 29.53058867
+
+def legacy_moon_phase(date):
+    """Прежний get_moon_phase: возраст Луны по среднему циклу и цепочка if/elif"""
+    days_since = (date - LEGACY_KNOWN_NEW_MOON).total_seconds() / 86400
+    moon_age = days_since % LEGACY_LUNAR_CYCLE
+    if moon_age < 1.845:
+        return "🌑 Новолуние"
+    elif moon_age < 5.535:
+        return "🌒 Растущая Луна"
+    elif moon_age < 9.225:
+        return "🌓 Первая четверть"
+    elif moon_age < 12.915:
+        return "🌔 Растущая Луна"
+    elif moon_age < 14.765:
+        return "🌕 Полнолуние"
+    elif moon_age < 18.455:
+        return "🌖 Убывающая Луна"
+    elif moon_age < 22.145:
+        return "🌗 Последняя четверть"
+    elif moon_age < 25.835:
+        return "🌘 Убывающая Луна"
+    return "🌑 Новолуние"
+
+def run_moon(number, first_year, last_year):
+    from ephemeris import NEW_MOON, FULL_MOON
+    now = datetime.now()
+    # Обе функции — локальные имена, чтобы поиск атрибута модуля не попадал в замер только одной из них
+    get_moon_phase = bot.get_moon_phase
+    legacy_us = min(timeit.repeat(lambda: legacy_moon_phase(now), number=number, repeat=5)) / number * 1e6
+    table_us = min(timeit.repeat(lambda: get_moon_phase(now), number=number, repeat=5)) / number * 1e6
+    moments = [now + timedelta(minutes=37 * i) for i in range(2000)]
+    spread_us = min(timeit.repeat(lambda: [bot.get_moon_phase(m) for m in moments], number=number // 2000 or 1,
+                                  repeat=3)) / ((number // 2000 or 1) * len(moments)) * 1e6
+    print(f"Вызов get_moon_phase: было {legacy_us:.2f} мкс, стало {table_us:.2f} мкс "
+          f"(тот же интервал), {spread_us:.2f} мкс (разные моменты, bisect)")
+
+    # Точность: момент новолуния/полнолуния по среднему циклу против рядов Меёса, в UTC
+    start = datetime(first_year, 1, 1, tzinfo=timezone.utc)
+    end = datetime(last_year + 1, 1, 1, tzinfo=timezone.utc)
+    known_new_moon = LEGACY_KNOWN_NEW_MOON.replace(tzinfo=timezone.utc).timestamp()
+    cycle = LEGACY_LUNAR_CYCLE * 86400
+    errors = {NEW_MOON: [], FULL_MOON: []}
+    for moment, code in bot.MOON_PHASES.events(start, end):
+        if code in errors:
+            offset = 0 if code == NEW_MOON else cycle / 2
+            lunations = round((moment - known_new_moon - offset) / cycle)
+            errors[code].append(abs(known_new_moon + offset + lunations * cycle - moment) / 3600)
+    for code, name in ((NEW_MOON, "новолуния"), (FULL_MOON, "полнолуния")):
+        hours = errors[code]
+        print(f"Ошибка среднего цикла для {name} {first_year}-{last_year}: "
+              f"средняя {sum(hours) / len(hours):.1f} ч, максимум {max(hours):.1f} ч")
+    hours = int((end - start).total_seconds() // 3600)
+    naive_start = datetime(first_year, 1, 1)
+    differ = sum(
+        1 for hour in range(hours)
+        if legacy_moon_phase(naive_start + timedelta(hours=hour))
+        != bot.get_moon_phase((naive_start + timedelta(hours=hour)).replace(tzinfo=timezone.utc))[0]
+    )
+    print(f"Часов с другой фазой, чем по таблице: {differ} из {hours} ({differ / hours:.1%})")
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки астрологического бота")
+    sub = parser.add_subparsers(dest="command", required=True)
+    lookups = sub.add_parser("lookups", help="обращения к БД (is_premium/get_user) на один апдейт")
+    lookups.add_argument("--rounds", type=int, default=5)
+    broadcast = sub.add_parser("broadcast", help="рассылка через пул воркеров с лимитами")
+    broadcast.add_argument("--users", type=int, default=300)
+    broadcast.add_argument("--latency", type=float, default=0.1, help="задержка ответа Bot API, сек")
+    broadcast.add_argument("--blocked-ratio", type=float, default=0.05)
+    broadcast.add_argument("--flood-every", type=int, default=100, help="429 на каждом N-м sendMessage (0 — без 429)")
+    broadcast.add_argument("--rate", type=float, default=bot.BROADCAST_RATE)
+    broadcast.add_argument("--workers", type=int, default=bot.BROADCAST_WORKERS)
+    webhook = sub.add_parser("webhook", help="нагрузочный тест: webhook против polling")
+    webhook.add_argument("--updates", type=int, default=500)
+    webhook.add_argument("--users", type=int, default=100)
+    webhook.add_argument("--concurrency", type=int, default=bot.UPDATE_CONCURRENCY)
+    webhook.add_argument("--connections", type=int, default=8, help="параллельных соединений от «Telegram»")
+    webhook.add_argument("--latency", type=float, default=0.05, help="задержка ответа Bot API, сек")
+    latency = sub.add_parser("latency", help="задержка ответа: гороскоп, карта дня, расклад на 3 карты")
+    latency.add_argument("--rounds", type=int, default=20)
+    latency.add_argument("--latency", type=float, default=0.05, help="задержка ответа Bot API, сек")
+    render = sub.add_parser("render", help="сборка текста гороскопа: старая конкатенация против шаблонов")
+    render.add_argument("--number", type=int, default=20000)
+    moon = sub.add_parser("moon", help="фаза Луны: средний цикл против таблицы эфемерид")
+    moon.add_argument("--number", type=int, default=200000)
+    moon.add_argument("--first-year", type=int, default=2024)
+    moon.add_argument("--last-year", type=int, default=2030)
+    args = parser.parse_args()
+
+    if args.command == "lookups":
+        asyncio.run(run_lookups(args.rounds))
+    elif args.command == "broadcast":
+        asyncio.run(run_broadcast(args.users, args.latency, args.blocked_ratio,
+                                  args.flood_every, args.rate, args.workers))
+    elif args.command == "webhook":
+        asyncio.run(run_webhook_bench(args.updates, args.users, args.concurrency, args.connections, args.latency))
+    elif args.command == "latency":
+        asyncio.run(run_latency(args.rounds, args.latency))
+    elif args.command == "render":
+        run_render(args.number)
+    elif args.command == "moon":
+        run_moon(args.number, args.first_year, args.last_year)
+
+if __name__ == "__main__":
+    main()
@@ -14,20 +14,37 @@ import random
 import json
 import os
 import hashlib
+import hmac
+import signal
 import uuid
 import asyncio
+import heapq
+import atexit
+import time
+import functools
+import sqlite3
+import shutil
+from collections import deque
 from datetime import datetime, timedelta
 from threading import Thread, Lock
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
 from dotenv import load_dotenv
 
+from horoscope_store import HoroscopeStore, JsonlHoroscopeStore, DictHoroscopeStore
+from templates import Template, prepare_pool
+from ephemeris import MoonPhaseTable, UNIX_EPOCH
+from metrics import MetricsStore, prometheus_lines
+
 from telegram import (
     Update,
     ReplyKeyboardMarkup,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
-    LabeledPrice
+    LabeledPrice,
+    ChatMember,
+    InputMediaPhoto
 )
+from telegram.error import RetryAfter, Forbidden, BadRequest, TimedOut, NetworkError, TelegramError
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -35,7 +52,10 @@ from telegram.ext import (
     CallbackQueryHandler,
     ContextTypes,
     filters,
-    PreCheckoutQueryHandler
+    PreCheckoutQueryHandler,
+    TypeHandler,
+    ChatMemberHandler,
+    BaseUpdateProcessor
 )
 
 # ====== ЗАГРУЗКА ПЕРЕМЕННЫХ ОКРУЖЕНИЯ ======
@@ -75,85 +95,113 @@ print(f"👑 Админ ID: {ADMIN_USER_ID}")
 print("=" * 70)
 
 # ====== ЗАГРУЗКА БАЗЫ ПРЕМИУМ ГОРОСКОПОВ ======
-PREMIUM_HOROSCOPES = {}
-if os.path.exists('horoscopes_premium.json'):
+# horoscopes_premium.bin открывается через mmap, .jsonl(.gz) — по смещениям строк: в обоих случаях
+# разбираются только нужные дни (см. horoscope_store.py).
+# Старый horoscopes_premium.json поддерживается как запасной вариант и грузится целиком.
+PREMIUM_STORE_FILES = [
+    ('horoscopes_premium.bin', HoroscopeStore),
+    ('horoscopes_premium.jsonl', JsonlHoroscopeStore),
+    ('horoscopes_premium.jsonl.gz', JsonlHoroscopeStore),
+]
+PREMIUM_HOROSCOPES = None
+for store_file, store_class in PREMIUM_STORE_FILES:
+    if PREMIUM_HOROSCOPES is not None or not os.path.exists(store_file):
+        continue
+    try:
+        PREMIUM_HOROSCOPES = store_class(store_file)
+        logger.info(f"✅ Подключено хранилище премиум-гороскопов {store_file}: {len(PREMIUM_HOROSCOPES)} записей")
+    except Exception as e:
+        logger.error(f"❌ Ошибка открытия хранилища гороскопов {store_file}: {e}")
+if PREMIUM_HOROSCOPES is None and os.path.exists('horoscopes_premium.json'):
     try:
         with open('horoscopes_premium.json', 'r', encoding='utf-8') as f:
-            PREMIUM_HOROSCOPES = json.load(f)
-        logger.info(f"✅ Загружено {len(PREMIUM_HOROSCOPES)} дней премиум-гороскопов")
+            PREMIUM_HOROSCOPES = DictHoroscopeStore(json.load(f))
+        logger.info(f"✅ Загружено {len(PREMIUM_HOROSCOPES)} премиум-гороскопов из JSON")
     except Exception as e:
         logger.error(f"❌ Ошибка загрузки гороскопов: {e}")
-else:
-    logger.warning("⚠️ Файл horoscopes_premium.json не найден. Используются базовые шаблоны.")
+if PREMIUM_HOROSCOPES is None:
+    logger.warning("⚠️ База премиум-гороскопов не найдена. Используются базовые шаблоны.")
+
+# ====== ЛУННЫЕ ФАЗЫ (таблица эфемерид, см. ephemeris.py) ======
+# Тексты по кодам фаз ephemeris: от «перед новолунием» до убывающего серпа
+MOON_PHASE_TEXTS = (
+    ("🌑 Новолуние", "Цикл завершается. Подготовка к новому началу."),
+    ("🌑 Новолуние", "Время новых начинаний. Энергия направлена внутрь."),
+    ("🌒 Растущая Луна", "Энергия набирает силу. Идеально для старта проектов."),
+    ("🌓 Первая четверть", "Время действий и принятия решений."),
+    ("🌔 Растущая Луна", "Энергия продолжает расти. Поддерживайте инициативы."),
+    ("🌕 Полнолуние", "Пик энергии. Время реализации и подведения итогов."),
+    ("🌖 Убывающая Луна", "Энергия снижается. Время анализа и завершения."),
+    ("🌗 Последняя четверть", "Время отпускания и освобождения."),
+    ("🌘 Убывающая Луна", "Энергия уходит. Время отдыха и восстановления."),
+)
+# Таблица строится при старте (~10 мс) и сама достраивается, если бот проработает дольше
+MOON_PHASES = MoonPhaseTable(datetime.now().year - 1, datetime.now().year + 10)
+
+# Последний найденный интервал фазы как наивные datetime (UTC): [начало, конец, текст] —
+# запросы «сейчас» почти всегда в него попадают
+MOON_PHASE_LAST = [datetime.min, datetime.min, None]
 
-# ====== ЛУННЫЕ ФАЗЫ (упрощённый расчёт) ======
 def get_moon_phase(date=None):
-    """Определяет лунную фазу для даты"""
-    if date is None:
-        date = datetime.now()
-    
-    # Упрощённый алгоритм (достаточно для астрологии)
-    known_new_moon = datetime(2000, 1, 6, 18, 14)  # Известное новолуние
-    lunar_cycle = 29.53058867  # дней
-    
-    days_since = (date - known_new_moon).total_seconds() / 86400
-    moon_age = days_since % lunar_cycle
-    
-    if moon_age < 1.845:
-        return "🌑 Новолуние", "Время новых начинаний. Энергия направлена внутрь."
-    elif moon_age < 5.535:
-        return "🌒 Растущая Луна", "Энергия набирает силу. Идеально для старта проектов."
-    elif moon_age < 9.225:
-        return "🌓 Первая четверть", "Время действий и принятия решений."
-    elif moon_age < 12.915:
-        return "🌔 Растущая Луна", "Энергия продолжает расти. Поддерживайте инициативы."
-    elif moon_age < 14.765:
-        return "🌕 Полнолуние", "Пик энергии. Время реализации и подведения итогов."
-    elif moon_age < 18.455:
-        return "🌖 Убывающая Луна", "Энергия снижается. Время анализа и завершения."
-    elif moon_age < 22.145:
-        return "🌗 Последняя четверть", "Время отпускания и освобождения."
-    elif moon_age < 25.835:
-        return "🌘 Убывающая Луна", "Энергия уходит. Время отдыха и восстановления."
-    else:
-        return "🌑 Новолуние", "Цикл завершается. Подготовка к новому началу."
+    """
+    Определяет лунную фазу для даты: поиск по таблице точных моментов фаз.
+    Быстрый путь — два сравнения datetime с последним интервалом, без перевода в unix-время.
+    """
+    date = date or datetime.now()
+    last = MOON_PHASE_LAST
+    if date.tzinfo is None and last[0] <= date < last[1]:
+        return last[2]
+    code = MOON_PHASES.phase_code(date)
+    low, high, _ = MOON_PHASES.last
+    last[:] = UNIX_EPOCH + timedelta(seconds=low), UNIX_EPOCH + timedelta(seconds=high), MOON_PHASE_TEXTS[code]
+    return last[2]
 
 # ====== ВРЕМЕННЫЕ ПЕРИОДЫ ======
-def get_time_period():
+TIME_PERIOD_TEXTS = {
+    "утро": [
+        "Утренняя энергия наполняет вас силами",
+        "Новый день открывает новые возможности",
+        "Свежие идеи приходят с рассветом",
+        "Утро — время планирования и намерений",
+        "Солнечный свет усиливает вашу интуицию"
+    ],
+    "день": [
+        "Дневная активность на пике",
+        "Солнце в зените поддерживает ваши действия",
+        "Время реализации планов и встреч",
+        "Энергия дня благоприятствует общению",
+        "Полдень — момент ясности и решений"
+    ],
+    "вечер": [
+        "Вечерняя гармония настраивает на отдых",
+        "Закат приносит умиротворение и рефлексию",
+        "Время для близких и душевных разговоров",
+        "Вечерняя энергия способствует творчеству",
+        "Сумерки — момент перехода к внутреннему миру"
+    ],
+    "ночь": [
+        "Ночная тишина усиливает интуицию",
+        "Звёзды направляют ваши мысли",
+        "Время снов и подсознательных озарений",
+        "Ночь — период восстановления и трансформации",
+        "Лунный свет освещает путь к истине"
+    ]
+}
+# Часы, в которые начинается новый период суток (плюс полночь — смена даты)
+TIME_PERIOD_BOUNDARIES = (0, 5, 12, 18, 23)
+
+def get_time_period(now=None):
     """Определяет период суток"""
-    hour = datetime.now().hour
+    hour = (now or datetime.now()).hour
     if 5 <= hour < 12:
-        return "утро", [
-            "Утренняя энергия наполняет вас силами",
-            "Новый день открывает новые возможности",
-            "Свежие идеи приходят с рассветом",
-            "Утро — время планирования и намерений",
-            "Солнечный свет усиливает вашу интуицию"
-        ]
+        period = "утро"
     elif 12 <= hour < 18:
-        return "день", [
-            "Дневная активность на пике",
-            "Солнце в зените поддерживает ваши действия",
-            "Время реализации планов и встреч",
-            "Энергия дня благоприятствует общению",
-            "Полдень — момент ясности и решений"
-        ]
+        period = "день"
     elif 18 <= hour < 23:
-        return "вечер", [
-            "Вечерняя гармония настраивает на отдых",
-            "Закат приносит умиротворение и рефлексию",
-            "Время для близких и душевных разговоров",
-            "Вечерняя энергия способствует творчеству",
-            "Сумерки — момент перехода к внутреннему миру"
-        ]
+        period = "вечер"
     else:
-        return "ночь", [
-            "Ночная тишина усиливает интуицию",
-            "Звёзды направляют ваши мысли",
-            "Время снов и подсознательных озарений",
-            "Ночь — период восстановления и трансформации",
-            "Лунный свет освещает путь к истине"
-        ]
+        period = "ночь"
+    return period, TIME_PERIOD_TEXTS[period]
 
 # ====== РАСШИРЕННЫЕ СПИСКИ ДЛЯ УНИКАЛЬНОСТИ ======
 ENERGY_TEXTS = [
@@ -367,38 +415,396 @@ ZODIAC_UNIQUE = {
     ]
 }
 
+# Пулы фраз готовятся один раз при загрузке: экранирование под Markdown и интернирование
+ENERGY_TEXTS = prepare_pool(ENERGY_TEXTS)
+LOVE_TEXTS = prepare_pool(LOVE_TEXTS)
+CAREER_TEXTS = prepare_pool(CAREER_TEXTS)
+HEALTH_TEXTS = prepare_pool(HEALTH_TEXTS)
+ADVICE_TEXTS = prepare_pool(ADVICE_TEXTS)
+TIME_PERIOD_TEXTS = {period: prepare_pool(texts) for period, texts in TIME_PERIOD_TEXTS.items()}
+# Строка «особенности» хранится целиком — в шаблон вставляется готовый кусок
+ZODIAC_UNIQUE_LINES = {
+    sign: tuple("*Особенность для вашего знака:* " + phrase + "\n\n" for phrase in prepare_pool(phrases))
+    for sign, phrases in ZODIAC_UNIQUE.items()
+}
+
 # ====== БАЗА ДАННЫХ ПОЛЬЗОВАТЕЛЕЙ ======
+# Режим хранения: journal — изменения дописываются в журнал, снапшот пишется фоном;
+# json — каждая запись полностью перезаписывает data/users.json (старое поведение);
+# sqlite — таблицы в data/users.sqlite3 (см. SQLiteUserDatabase)
+DB_STORAGE = os.getenv("DB_STORAGE", "journal")
+JOURNAL_COMPACT_RECORDS = int(os.getenv("JOURNAL_COMPACT_RECORDS", 5000))
+JOURNAL_COMPACT_INTERVAL = int(os.getenv("JOURNAL_COMPACT_INTERVAL", 300))
+# Сброс изменений на диск: не чаще раза в DB_FLUSH_INTERVAL_MS или сразу после DB_FLUSH_MAX_PENDING изменений
+DB_FLUSH_INTERVAL_MS = int(os.getenv("DB_FLUSH_INTERVAL_MS", 500))
+DB_FLUSH_MAX_PENDING = int(os.getenv("DB_FLUSH_MAX_PENDING", 100))
+# Сколько предыдущих поколений снапшота хранить рядом (users.json.1, users.json.2, ...)
+DB_SNAPSHOT_GENERATIONS = int(os.getenv("DB_SNAPSHOT_GENERATIONS", 3))
+
+SNAPSHOT_CHECKSUM_MARKER = b',"_checksum":"'
+
+def write_snapshot(filename, payload, generations=DB_SNAPSHOT_GENERATIONS):
+    """
+    Атомарно записывает снапшот: временный файл → fsync → rename.
+    payload — байты JSON-объекта; контрольная сумма дописывается последним ключом,
+    поэтому файл остаётся обычным JSON. Старые поколения сдвигаются переименованием, без копирования.
+    """
+    checksum = hashlib.sha256(payload).hexdigest().encode()
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(memoryview(payload)[:-1])
+        f.write(SNAPSHOT_CHECKSUM_MARKER + checksum + b'"}')
+        f.flush()
+        os.fsync(f.fileno())
+    for generation in range(generations - 1, 0, -1):
+        if os.path.exists(f"{filename}.{generation}"):
+            os.replace(f"{filename}.{generation}", f"{filename}.{generation + 1}")
+    if generations and os.path.exists(filename):
+        os.replace(filename, filename + '.1')
+    os.replace(tmp_filename, filename)
+    try:
+        dir_fd = os.open(os.path.dirname(filename) or '.', os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass  # Не все ФС позволяют fsync каталога
+
+def read_snapshot(filename):
+    """Читает снапшот и сверяет контрольную сумму; бросает ValueError при повреждении"""
+    with open(filename, 'rb') as f:
+        raw = f.read()
+    marker = raw.rfind(SNAPSHOT_CHECKSUM_MARKER)
+    if marker != -1:
+        expected = raw[marker + len(SNAPSHOT_CHECKSUM_MARKER):-2]
+        digest = hashlib.sha256(memoryview(raw)[:marker])
+        digest.update(b'}')
+        if not raw.endswith(b'"}') or digest.hexdigest().encode() != expected:
+            raise ValueError(f"контрольная сумма {filename} не совпадает")
+    # Файлы старого формата (без контрольной суммы) принимаем, если они разбираются как JSON
+    data = json.loads(raw)
+    data.pop('_checksum', None)
+    return data
+
+def snapshot_candidates(filename, generations=DB_SNAPSHOT_GENERATIONS):
+    """Файлы снапшота от самого свежего к самому старому"""
+    return [filename, filename + '.tmp'] + [f"{filename}.{i}" for i in range(1, generations + 1)]
+
+# ---- Индекс окончания премиума ----
+PREMIUM_EXPIRY_INTERVAL = int(os.getenv("PREMIUM_EXPIRY_INTERVAL", 60))
+
+def parse_premium_date(date_str):
+    """Дата окончания премиума → epoch; нераспознанная дата считается истёкшей"""
+    for date_format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(date_str, date_format).timestamp()
+        except (TypeError, ValueError):
+            continue
+    return 0.0
+
+class PremiumIndex:
+    """
+    Окончания премиума в виде готовых epoch-меток + min-куча для пакетного истечения.
+    Проверка премиума — поиск в словаре и сравнение, без разбора дат и без записи.
+    """
+    
+    def __init__(self, items=()):
+        self.expires = {user_id: parse_premium_date(date_str) for user_id, date_str in items}
+        self.heap = [(expires_at, user_id) for user_id, expires_at in self.expires.items()]
+        heapq.heapify(self.heap)
+    
+    def set(self, user_id, date_str):
+        expires_at = parse_premium_date(date_str)
+        self.expires[user_id] = expires_at
+        heapq.heappush(self.heap, (expires_at, user_id))
+    
+    def remove(self, user_id):
+        # Запись в куче остаётся и отбрасывается при извлечении
+        self.expires.pop(user_id, None)
+    
+    def is_active(self, user_id):
+        return self.expires.get(user_id, 0.0) > time.time()
+    
+    def pop_expired(self, now=None):
+        now = time.time() if now is None else now
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            expires_at, user_id = heapq.heappop(self.heap)
+            if self.expires.get(user_id) == expires_at:
+                del self.expires[user_id]
+                expired.append(user_id)
+        return expired
+
+# ---- Накопительная статистика ----
+# Счётчик пользователя → итог в статистике админки
+COUNTER_STATS = {
+    'horoscope_count': 'total_horoscopes',
+    'num_count': 'total_numerology',
+    'tarot_count': 'total_tarot',
+    'compatibility_count': 'total_compatibility',
+}
+# Итоги, которые нельзя получить через len() и поэтому хранятся в data['stats']
+RUNNING_STATS = tuple(COUNTER_STATS.values()) + ('successful_payments', 'total_revenue')
+
+def payment_stats(payment):
+    """Вклад платежа в итоги: (успешных платежей, выручка)"""
+    if payment and payment.get('status') == 'succeeded':
+        return 1, float(payment.get('amount', 0))
+    return 0, 0.0
+
+def stats_drift(stored, actual):
+    """Расхождения накопленной статистики с пересчитанной: {ключ: (было, стало)}"""
+    return {
+        key: (stored.get(key), value) for key, value in actual.items()
+        if abs((stored.get(key) or 0) - value) > 1e-6
+    }
+
+def load_database_snapshot(filename):
+    """Данные БД из самого свежего целого снапшота; только чтение, файлы не меняются"""
+    found = False
+    for path in snapshot_candidates(filename):
+        if not os.path.exists(path):
+            continue
+        found = True
+        try:
+            data = read_snapshot(path)
+        except Exception as e:
+            logger.error(f"Ошибка загрузки БД из {path}: {e}")
+            continue
+        if path != filename:
+            logger.warning(f"⚠️ Основной снапшот БД недоступен, восстановлено из {path}")
+        for key in ['users', 'premium', 'payments', 'stats', 'inactive']:
+            if key not in data:
+                data[key] = {}
+        return data
+    if found:
+        # Лучше не стартовать, чем молча начать с пустой базы и затереть платящих пользователей
+        raise RuntimeError(f"❌ Все снапшоты БД {filename} повреждены")
+    return {k: {} for k in ['users', 'premium', 'payments', 'stats', 'inactive']}
+
+def apply_journal_record(data, record):
+    """
+    Применяет запись журнала. Вложенные записи (пользователь, платёж) не меняются на месте,
+    а заменяются копией — копирование при записи: снапшот, снятый поверхностной копией
+    верхнего уровня, можно сериализовать без блокировки, его словари уже никто не тронет.
+    """
+    op, path = record[0], record[1]
+    target = data.setdefault(path[0], {}) if len(path) > 1 else data
+    for key in path[1:-1]:
+        child = dict(target.get(key) or {})
+        target[key] = child
+        target = child
+    if op == 'set':
+        target[path[-1]] = record[2]
+    else:
+        target.pop(path[-1], None)
+
+def replay_journal_files(data, journal_filename):
+    """Проигрывает журнал (.old, затем текущий) поверх data; возвращает число записей"""
+    replayed = 0
+    for path in (journal_filename + '.old', journal_filename):
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Оборванная последняя запись (падение во время записи)
+                    logger.warning(f"⚠️ Повреждённая запись в журнале {path}, остаток пропущен")
+                    break
+                apply_journal_record(data, record)
+                replayed += 1
+    return replayed
+
 class UserDatabase:
-    def __init__(self, filename='data/users.json'):
+    def __init__(self, filename='data/users.json', storage=None):
         self.filename = filename
+        self.journal_filename = os.path.splitext(filename)[0] + '.journal'
+        self.storage = storage or DB_STORAGE
         self.lock = Lock()
+        self.flush_lock = Lock()
+        self.flush_event = None  # asyncio.Event фонового db_flusher, пока он запущен
+        self.pending = []
+        self.unflushed = 0
+        self.flush_stats = {'flushes': 0, 'mutations': 0, 'total_ms': 0.0, 'last_ms': 0.0, 'max_ms': 0.0}
+        self.journal_records = 0
+        self.last_compaction = time.monotonic()
         self.data = self.load_data()
+        replayed = 0
+        if self.storage == 'journal':
+            replayed = self.open_journal()
+        if any(key not in self.data['stats'] for key in RUNNING_STATS):
+            # База старого формата — один полный пересчёт, дальше итоги ведутся на лету
+            logger.info("📊 Накопительной статистики в базе нет — пересчитываем")
+            self.write_stats(self.compute_stats())
+        elif replayed:
+            # Оборванная запись журнала могла унести часть изменений итогов
+            self.verify_stats(repair=True)
+        self.premium_index = PremiumIndex(self.data['premium'].items())
     
     def load_data(self):
-        if os.path.exists(self.filename):
-            try:
-                with open(self.filename, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    for key in ['users', 'premium', 'payments', 'stats']:
-                        if key not in data:
-                            data[key] = {}
-                    return data
-            except Exception as e:
-                logger.error(f"Ошибка загрузки БД: {e}")
-        return {k: {} for k in ['users', 'premium', 'payments', 'stats']}
+        return load_database_snapshot(self.filename)
     
     def save_data(self):
+        """
+        Пишет снапшот; возвращает True, только если он записан, синхронизирован и переименован.
+        При False журнал удалять нельзя — в нём единственная копия изменений.
+        """
         try:
+            # Под блокировкой — только поверхностная копия верхнего уровня (копирование словарей в C,
+            # без сериализации); вложенные записи apply() заменяет копиями, поэтому json.dumps
+            # идёт уже без блокировки, и изменения из обработчиков его не ждут
             with self.lock:
-                with open(self.filename, 'w', encoding='utf-8') as f:
-                    json.dump(self.data, f, ensure_ascii=False, indent=2)
+                snapshot = {key: dict(value) if isinstance(value, dict) else value for key, value in self.data.items()}
+            payload = json.dumps(snapshot, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            with self.flush_lock:
+                write_snapshot(self.filename, payload)
+            return True
         except Exception as e:
             logger.error(f"Ошибка сохранения БД: {e}")
+            return False
+    
+    # ---- Журнал изменений ----
+    def open_journal(self):
+        """Проигрывает журнал поверх снапшота и открывает его на дозапись; возвращает число изменений из журнала"""
+        replayed = self.replay_journal()
+        if replayed:
+            logger.info(f"📜 Из журнала восстановлено {replayed} изменений")
+            if self.save_data():
+                for path in (self.journal_filename + '.old', self.journal_filename):
+                    if os.path.exists(path):
+                        os.remove(path)
+            else:
+                logger.warning("⚠️ Снапшот не записан — журнал сохранён и будет проигран при следующем запуске")
+        self.journal_file = open(self.journal_filename, 'a', encoding='utf-8')
+        Thread(target=self.compaction_loop, daemon=True).start()
+        return replayed
+    
+    def replay_journal(self):
+        return replay_journal_files(self.data, self.journal_filename)
+    
+    def apply(self, record):
+        apply_journal_record(self.data, record)
+    
+    def set(self, path, value):
+        record = ['set', path, value]
+        with self.lock:
+            self.apply(record)
+            self.pending.append(record)
+    
+    def delete(self, path):
+        record = ['del', path]
+        with self.lock:
+            self.apply(record)
+            self.pending.append(record)
+    
+    def commit(self):
+        """Помечает БД как изменённую; на диск изменения сбрасывает db_flusher"""
+        with self.lock:
+            self.unflushed += 1
+            unflushed = self.unflushed
+        if self.flush_event is None:
+            # Фоновый сброс не запущен (старт, миграция, скрипты) — пишем сразу
+            self.flush()
+        elif unflushed >= DB_FLUSH_MAX_PENDING:
+            self.flush_event.set()
+    
+    def flush(self):
+        """Сбрасывает накопленные изменения на диск (вызывается в пуле потоков)"""
+        with self.lock:
+            mutations = self.unflushed
+            self.unflushed = 0
+        if not mutations:
+            return
+        started = time.perf_counter()
+        if self.storage == 'journal':
+            self.write_journal()
+        else:
+            with self.lock:
+                self.pending.clear()
+            if not self.save_data():
+                # Изменения остались только в памяти — следующий сброс попробует снова
+                with self.lock:
+                    self.unflushed += mutations
+                return
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        stats = self.flush_stats
+        stats['flushes'] += 1
+        stats['mutations'] += mutations
+        stats['total_ms'] += elapsed_ms
+        stats['last_ms'] = elapsed_ms
+        stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+    
+    def get_flush_stats(self):
+        stats = dict(self.flush_stats)
+        stats['pending'] = self.unflushed
+        stats['avg_ms'] = stats['total_ms'] / stats['flushes'] if stats['flushes'] else 0.0
+        # Доля изменений, которые «схлопнулись» в чужой сброс и не стоили отдельной записи
+        stats['coalesced_ratio'] = 1 - stats['flushes'] / stats['mutations'] if stats['mutations'] else 0.0
+        return stats
+    
+    def write_journal(self):
+        """Дописывает накопленные записи в журнал: O(1) от числа пользователей"""
+        try:
+            with self.flush_lock:
+                with self.lock:
+                    if not self.pending:
+                        return
+                    lines = ''.join(json.dumps(r, ensure_ascii=False, separators=(',', ':')) + '\n' for r in self.pending)
+                    self.journal_records += len(self.pending)
+                    self.pending.clear()
+                    self.journal_file.write(lines)
+                    self.journal_file.flush()
+        except Exception as e:
+            logger.error(f"Ошибка записи журнала БД: {e}")
+    
+    def compact(self):
+        """Пишет снапшот и обрезает журнал"""
+        old_journal = self.journal_filename + '.old'
+        with self.lock:
+            self.journal_file.close()
+            if os.path.exists(old_journal):
+                # Прошлое сжатие не записало снапшот — .old ещё нужен, дописываем журнал к нему
+                with open(self.journal_filename, 'rb') as src, open(old_journal, 'ab') as dst:
+                    shutil.copyfileobj(src, dst)
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                os.remove(self.journal_filename)
+            else:
+                os.replace(self.journal_filename, old_journal)
+            self.journal_file = open(self.journal_filename, 'a', encoding='utf-8')
+            compacted = self.journal_records
+            self.journal_records = 0
+            self.last_compaction = time.monotonic()
+        # Записи, попавшие в новый журнал после ротации, идемпотентны — повторное применение безопасно
+        if not self.save_data():
+            # Старый журнал удаляем только после того, как снапшот лёг на диск
+            with self.lock:
+                self.journal_records += compacted
+            logger.warning(f"⚠️ Сжатие журнала БД отложено: снапшот не записан, {old_journal} сохранён")
+            return False
+        os.remove(old_journal)
+        logger.info(f"🗜️ Журнал БД сжат: {compacted} записей")
+        return True
+    
+    def compaction_loop(self):
+        while True:
+            time.sleep(5)
+            if not self.journal_records:
+                continue
+            elapsed = time.monotonic() - self.last_compaction
+            if self.journal_records >= JOURNAL_COMPACT_RECORDS or elapsed >= JOURNAL_COMPACT_INTERVAL:
+                try:
+                    self.compact()
+                except Exception as e:
+                    logger.error(f"Ошибка сжатия журнала БД: {e}")
     
     def add_user(self, user_id, username, first_name):
         user_id_str = str(user_id)
         if user_id_str not in self.data['users']:
-            self.data['users'][user_id_str] = {
+            self.set(['users', user_id_str], {
                 'username': username or 'unknown',
                 'first_name': first_name or 'Пользователь',
                 'joined': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
@@ -412,8 +818,8 @@ class UserDatabase:
                 'birth_date': None,
                 'life_path_number': None,
                 'total_requests': 0
-            }
-            self.save_data()
+            })
+            self.commit()
             logger.info(f"👤 Новый пользователь: {user_id} ({first_name})")
     
     def get_user(self, user_id):
@@ -423,58 +829,48 @@ class UserDatabase:
         user_id_str = str(user_id)
         if user_id_str not in self.data['users']:
             self.add_user(user_id, None, None)
-        if counter_name not in self.data['users'][user_id_str]:
-            self.data['users'][user_id_str][counter_name] = 0
-        self.data['users'][user_id_str][counter_name] += 1
-        self.data['users'][user_id_str]['total_requests'] = self.data['users'][user_id_str].get('total_requests', 0) + 1
-        self.save_data()
+        user = self.data['users'][user_id_str]
+        self.set(['users', user_id_str, counter_name], user.get(counter_name, 0) + 1)
+        self.set(['users', user_id_str, 'total_requests'], user.get('total_requests', 0) + 1)
+        stat = COUNTER_STATS.get(counter_name)
+        if stat:
+            self.set(['stats', stat], self.data['stats'].get(stat, 0) + 1)
+        self.commit()
     
     def add_premium(self, user_id, days):
         user_id_str = str(user_id)
         end_date = (datetime.now() + timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
-        self.data['premium'][user_id_str] = end_date
-        self.save_data()
+        self.set(['premium', user_id_str], end_date)
+        self.premium_index.set(user_id_str, end_date)
+        self.commit()
         logger.info(f"💎 Премиум активирован для {user_id} на {days} дней (до {end_date})")
         return end_date
     
     def is_premium(self, user_id):
-        user_id_str = str(user_id)
-        if user_id_str in self.data['premium']:
-            date_str = self.data['premium'][user_id_str]
-            try:
-                try:
-                    end_date = datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S')
-                except ValueError:
-                    try:
-                        end_date = datetime.strptime(date_str, '%Y-%m-%d')
-                    except ValueError:
-                        del self.data['premium'][user_id_str]
-                        self.save_data()
-                        return False
-                if end_date > datetime.now():
-                    return True
-                else:
-                    del self.data['premium'][user_id_str]
-                    self.save_data()
-                    return False
-            except Exception as e:
-                logger.error(f"Ошибка проверки премиума {user_id}: {e}")
-                return False
-        return False
+        return self.premium_index.is_active(str(user_id))
     
     def remove_premium(self, user_id):
         user_id_str = str(user_id)
         if user_id_str in self.data['premium']:
-            del self.data['premium'][user_id_str]
-            self.save_data()
+            self.delete(['premium', user_id_str])
+            self.premium_index.remove(user_id_str)
+            self.commit()
             logger.info(f"❌ Премиум удалён для {user_id}")
             return True
         return False
     
+    def expire_premium(self):
+        """Удаляет истёкшие премиумы одной пачкой (вызывается фоновой задачей)"""
+        expired = self.premium_index.pop_expired()
+        for user_id_str in expired:
+            self.delete(['premium', user_id_str])
+        if expired:
+            self.commit()
+            logger.info(f"⌛ Истёк премиум у {len(expired)} пользователей")
+        return expired
+    
     def save_payment(self, payment_id, user_id, tariff_days, amount, status='pending'):
         try:
-            if 'payments' not in self.data:
-                self.data['payments'] = {}
             payment_record = {
                 'user_id': str(user_id),
                 'tariff_days': tariff_days,
@@ -482,8 +878,10 @@ class UserDatabase:
                 'status': status,
                 'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             }
-            self.data['payments'][payment_id] = payment_record
-            self.save_data()
+            previous = self.data['payments'].get(payment_id)
+            self.set(['payments', payment_id], payment_record)
+            self.adjust_payment_stats(previous, payment_record)
+            self.commit()
             logger.info(f"💰 Платеж сохранен: {payment_id} | Пользователь: {user_id} | Сумма: {amount}₽ | Статус: {status}")
         except Exception as e:
             logger.error(f"❌ Ошибка сохранения платежа: {e}")
@@ -491,9 +889,12 @@ class UserDatabase:
     def update_payment_status(self, payment_id, status):
         try:
             if 'payments' in self.data and payment_id in self.data['payments']:
-                self.data['payments'][payment_id]['status'] = status
-                self.data['payments'][payment_id]['updated_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                self.save_data()
+                payment = self.data['payments'][payment_id]
+                previous = dict(payment)
+                self.set(['payments', payment_id, 'status'], status)
+                self.set(['payments', payment_id, 'updated_at'], datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+                self.adjust_payment_stats(previous, payment)
+                self.commit()
                 logger.info(f"🔄 Статус платежа {payment_id} обновлен на: {status}")
         except Exception as e:
             logger.error(f"❌ Ошибка обновления статуса платежа: {e}")
@@ -501,55 +902,538 @@ class UserDatabase:
     def update_user_birth_date(self, user_id, birth_date, life_path):
         user_id_str = str(user_id)
         if user_id_str in self.data['users']:
-            self.data['users'][user_id_str]['birth_date'] = birth_date
-            self.data['users'][user_id_str]['life_path_number'] = life_path
-            self.save_data()
+            self.set(['users', user_id_str, 'birth_date'], birth_date)
+            self.set(['users', user_id_str, 'life_path_number'], life_path)
+            self.commit()
+    
+    def adjust_payment_stats(self, previous, payment):
+        previous_count, previous_revenue = payment_stats(previous)
+        count, revenue = payment_stats(payment)
+        if count != previous_count:
+            self.set(['stats', 'successful_payments'], self.data['stats'].get('successful_payments', 0) + count - previous_count)
+        if revenue != previous_revenue:
+            self.set(['stats', 'total_revenue'], self.data['stats'].get('total_revenue', 0) + revenue - previous_revenue)
     
     def get_all_users_stats(self):
+        """O(1): размеры словарей + итоги, которые ведутся в data['stats'] при каждом изменении"""
+        stats = self.data['stats']
+        result = {
+            'total_users': len(self.data['users']),
+            'premium_users': len(self.data['premium']),
+            'total_payments': len(self.data['payments']),
+        }
+        for key in RUNNING_STATS:
+            result[key] = stats.get(key, 0)
+        return result
+    
+    def compute_stats(self, locked=False):
+        """Полный пересчёт статистики проходом по всем пользователям и платежам (locked=True — блокировка уже взята)"""
+        if not locked:
+            with self.lock:
+                return self.compute_stats(locked=True)
+        users = self.data['users'].values()
+        payments = self.data['payments'].values()
+        result = {
+            'total_users': len(users),
+            'premium_users': len(self.data['premium']),
+            'total_payments': len(payments),
+            'successful_payments': 0,
+            'total_revenue': 0.0,
+        }
+        for counter_name, stat in COUNTER_STATS.items():
+            result[stat] = sum(u.get(counter_name, 0) for u in users)
+        for payment in payments:
+            count, revenue = payment_stats(payment)
+            result['successful_payments'] += count
+            result['total_revenue'] += revenue
+        return result
+    
+    def verify_stats(self, repair=False):
+        """
+        Сверяет накопленную статистику с полным пересчётом; repair=True сразу исправляет.
+        Итоги и пересчёт снимаются под одной блокировкой — расхождение не зависит от параллельных изменений.
+        """
+        with self.lock:
+            stored = self.get_all_users_stats()
+            actual = self.compute_stats(locked=True)
+        drift = stats_drift(stored, actual)
+        if drift:
+            logger.warning(f"⚠️ Расхождение статистики: {drift}")
+            if repair:
+                self.repair_stats(drift)
+        return drift
+    
+    def repair_stats(self, drift):
+        """
+        Исправляет итоги на величину расхождения, а не перезаписывает их пересчётом:
+        изменения, сделанные после сверки, сохраняются. Вызывается в цикле событий (commit трогает asyncio.Event).
+        """
+        for key, (stored, actual) in drift.items():
+            if key in RUNNING_STATS:
+                self.set(['stats', key], self.data['stats'].get(key, 0) + actual - (stored or 0))
+        self.commit()
+    
+    def write_stats(self, values):
+        for key in RUNNING_STATS:
+            self.set(['stats', key], values[key])
+        self.commit()
+    
+    def get_all_user_ids(self):
+        return list(self.data['users'].keys())
+    
+    def get_active_user_ids(self):
+        """Пользователи без отметки «заблокировал бота» — получатели рассылок"""
+        inactive = self.data['inactive']
+        return [uid for uid in self.data['users'] if uid not in inactive]
+    
+    def set_user_active(self, user_id, active):
+        """Снимает или ставит отметку «заблокировал бота»; True, если что-то изменилось"""
+        user_id_str = str(user_id)
+        if active == (user_id_str not in self.data['inactive']):
+            return False
+        if active:
+            self.delete(['inactive', user_id_str])
+        else:
+            self.set(['inactive', user_id_str], datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        self.commit()
+        return True
+    
+    def get_premium_user_ids(self):
+        return list(self.data['premium'].keys())
+
+# ====== SQLITE-ХРАНИЛИЩЕ (DB_STORAGE=sqlite) ======
+USER_COUNTERS = ('horoscope_count', 'num_count', 'tarot_count', 'compatibility_count')
+USER_COLUMNS = (
+    'username', 'first_name', 'joined', 'horoscope_count', 'num_count', 'tarot_count',
+    'compatibility_count', 'last_zodiac', 'last_horoscope_date', 'chat_id', 'birth_date',
+    'life_path_number', 'total_requests'
+)
+PAYMENT_COLUMNS = ('user_id', 'tariff_days', 'amount', 'status', 'created_at', 'updated_at')
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    joined TEXT,
+    horoscope_count INTEGER NOT NULL DEFAULT 0,
+    num_count INTEGER NOT NULL DEFAULT 0,
+    tarot_count INTEGER NOT NULL DEFAULT 0,
+    compatibility_count INTEGER NOT NULL DEFAULT 0,
+    last_zodiac TEXT,
+    last_horoscope_date TEXT,
+    chat_id INTEGER,
+    birth_date TEXT,
+    life_path_number INTEGER,
+    total_requests INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS premium (
+    user_id TEXT PRIMARY KEY,
+    expires_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS payments (
+    payment_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    tariff_days INTEGER,
+    amount REAL NOT NULL DEFAULT 0,
+    status TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    updated_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_payments_user_id ON payments (user_id);
+CREATE INDEX IF NOT EXISTS idx_payments_status_created ON payments (status, created_at);
+CREATE TABLE IF NOT EXISTS inactive (
+    user_id TEXT PRIMARY KEY,
+    since TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS stats (
+    key TEXT PRIMARY KEY,
+    value NUMERIC NOT NULL DEFAULT 0
+);
+"""
+
+# Итоги для админки ведут триггеры: они срабатывают в той же транзакции, что и само изменение,
+# поэтому статистика не расходится с данными. INSERT OR REPLACE вызывает триггеры удаления
+# только при PRAGMA recursive_triggers = ON (включается при подключении).
+SQLITE_STATS_KEYS = (
+    'total_users', 'premium_users', 'total_payments', 'successful_payments',
+    'total_horoscopes', 'total_numerology', 'total_tarot', 'total_compatibility', 'total_revenue'
+)
+SQLITE_STATS_TRIGGERS = """
+CREATE TRIGGER IF NOT EXISTS stats_users_insert AFTER INSERT ON users BEGIN
+    UPDATE stats SET value = value + CASE key
+        WHEN 'total_users' THEN 1
+        WHEN 'total_horoscopes' THEN NEW.horoscope_count
+        WHEN 'total_numerology' THEN NEW.num_count
+        WHEN 'total_tarot' THEN NEW.tarot_count
+        WHEN 'total_compatibility' THEN NEW.compatibility_count
+    END WHERE key IN ('total_users', 'total_horoscopes', 'total_numerology', 'total_tarot', 'total_compatibility');
+END;
+CREATE TRIGGER IF NOT EXISTS stats_users_delete AFTER DELETE ON users BEGIN
+    UPDATE stats SET value = value - CASE key
+        WHEN 'total_users' THEN 1
+        WHEN 'total_horoscopes' THEN OLD.horoscope_count
+        WHEN 'total_numerology' THEN OLD.num_count
+        WHEN 'total_tarot' THEN OLD.tarot_count
+        WHEN 'total_compatibility' THEN OLD.compatibility_count
+    END WHERE key IN ('total_users', 'total_horoscopes', 'total_numerology', 'total_tarot', 'total_compatibility');
+END;
+CREATE TRIGGER IF NOT EXISTS stats_users_update
+AFTER UPDATE OF horoscope_count, num_count, tarot_count, compatibility_count ON users BEGIN
+    UPDATE stats SET value = value + CASE key
+        WHEN 'total_horoscopes' THEN NEW.horoscope_count - OLD.horoscope_count
+        WHEN 'total_numerology' THEN NEW.num_count - OLD.num_count
+        WHEN 'total_tarot' THEN NEW.tarot_count - OLD.tarot_count
+        WHEN 'total_compatibility' THEN NEW.compatibility_count - OLD.compatibility_count
+    END WHERE key IN ('total_horoscopes', 'total_numerology', 'total_tarot', 'total_compatibility');
+END;
+CREATE TRIGGER IF NOT EXISTS stats_premium_insert AFTER INSERT ON premium BEGIN
+    UPDATE stats SET value = value + 1 WHERE key = 'premium_users';
+END;
+CREATE TRIGGER IF NOT EXISTS stats_premium_delete AFTER DELETE ON premium BEGIN
+    UPDATE stats SET value = value - 1 WHERE key = 'premium_users';
+END;
+CREATE TRIGGER IF NOT EXISTS stats_payments_insert AFTER INSERT ON payments BEGIN
+    UPDATE stats SET value = value + CASE key
+        WHEN 'total_payments' THEN 1
+        WHEN 'successful_payments' THEN NEW.status = 'succeeded'
+        WHEN 'total_revenue' THEN (NEW.status = 'succeeded') * NEW.amount
+    END WHERE key IN ('total_payments', 'successful_payments', 'total_revenue');
+END;
+CREATE TRIGGER IF NOT EXISTS stats_payments_delete AFTER DELETE ON payments BEGIN
+    UPDATE stats SET value = value - CASE key
+        WHEN 'total_payments' THEN 1
+        WHEN 'successful_payments' THEN OLD.status = 'succeeded'
+        WHEN 'total_revenue' THEN (OLD.status = 'succeeded') * OLD.amount
+    END WHERE key IN ('total_payments', 'successful_payments', 'total_revenue');
+END;
+CREATE TRIGGER IF NOT EXISTS stats_payments_update AFTER UPDATE OF status, amount ON payments BEGIN
+    UPDATE stats SET value = value + CASE key
+        WHEN 'successful_payments' THEN (NEW.status = 'succeeded') - (OLD.status = 'succeeded')
+        WHEN 'total_revenue' THEN (NEW.status = 'succeeded') * NEW.amount - (OLD.status = 'succeeded') * OLD.amount
+    END WHERE key IN ('successful_payments', 'total_revenue');
+END;
+"""
+
+class SQLiteUserDatabase:
+    """Тот же интерфейс, что у UserDatabase, но данные живут в SQLite, а не в памяти"""
+    
+    def __init__(self, filename='data/users.sqlite3', json_filename='data/users.json'):
+        self.filename = filename
+        self.lock = Lock()
+        self.flush_event = None
+        self.conn = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA recursive_triggers = ON")
+        self.conn.executescript(SQLITE_SCHEMA)
+        self.init_stats()
+        self.migrate_from_json(json_filename)
+        self.premium_index = PremiumIndex(self.fetchall("SELECT user_id, expires_at FROM premium"))
+    
+    def execute(self, sql, params=()):
+        """Запрос на изменение; курсор возвращается только ради rowcount"""
+        with self.lock:
+            return self.conn.execute(sql, params)
+    
+    def fetchone(self, sql, params=()):
+        # Строки выбираются под той же блокировкой: соединение общее для потоков
+        with self.lock:
+            return self.conn.execute(sql, params).fetchone()
+    
+    def fetchall(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+    
+    def init_stats(self):
+        """Создаёт триггеры итогов; в базе без итогов они один раз считаются полным проходом"""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                if self.conn.execute("SELECT COUNT(*) FROM stats").fetchone()[0] < len(SQLITE_STATS_KEYS):
+                    logger.info("📊 Накопительной статистики в базе нет — пересчитываем")
+                    self.conn.executemany(
+                        "INSERT OR REPLACE INTO stats (key, value) VALUES (?, ?)",
+                        self.compute_stats(locked=True).items()
+                    )
+                for statement in SQLITE_STATS_TRIGGERS.split("END;")[:-1]:
+                    self.conn.execute(statement + "END;")
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+    
+    def migrate_from_json(self, json_filename):
+        """Однократный перенос данных из data/users.json (+ журнала) в SQLite"""
+        if self.fetchone("SELECT 1 FROM meta WHERE key = 'migrated_from_json'"):
+            return
+        journal_filename = os.path.splitext(json_filename)[0] + '.journal'
+        if os.path.exists(json_filename) or os.path.exists(journal_filename):
+            # Старую базу только читаем: конструктор UserDatabase пересчитал бы итоги и переписал users.json
+            legacy_data = load_database_snapshot(json_filename)
+            replay_journal_files(legacy_data, journal_filename)
+            users = [
+                (uid,) + tuple(record.get(col, 0 if col in USER_COUNTERS or col == 'total_requests' else None) for col in USER_COLUMNS)
+                for uid, record in legacy_data['users'].items()
+            ]
+            payments = [
+                (pid,) + tuple(record.get(col) for col in PAYMENT_COLUMNS)
+                for pid, record in legacy_data['payments'].items()
+            ]
+            with self.lock:
+                self.conn.execute("BEGIN")
+                try:
+                    self.conn.executemany(
+                        "INSERT OR REPLACE INTO users (user_id, " + ", ".join(USER_COLUMNS) + ") VALUES (" + ", ".join("?" * (len(USER_COLUMNS) + 1)) + ")",
+                        users
+                    )
+                    self.conn.executemany("INSERT OR REPLACE INTO premium (user_id, expires_at) VALUES (?, ?)", legacy_data['premium'].items())
+                    self.conn.executemany("INSERT OR REPLACE INTO inactive (user_id, since) VALUES (?, ?)", legacy_data['inactive'].items())
+                    self.conn.executemany(
+                        "INSERT OR REPLACE INTO payments (payment_id, " + ", ".join(PAYMENT_COLUMNS) + ") VALUES (" + ", ".join("?" * (len(PAYMENT_COLUMNS) + 1)) + ")",
+                        payments
+                    )
+                    self.conn.execute("INSERT INTO meta (key, value) VALUES ('migrated_from_json', ?)", (datetime.now().strftime('%Y-%m-%d %H:%M:%S'),))
+                    self.conn.execute("COMMIT")
+                except Exception:
+                    self.conn.execute("ROLLBACK")
+                    raise
+            logger.info(f"📦 Миграция из {json_filename}: {len(users)} пользователей, {len(payments)} платежей")
+        else:
+            self.execute("INSERT INTO meta (key, value) VALUES ('migrated_from_json', ?)", (datetime.now().strftime('%Y-%m-%d %H:%M:%S'),))
+    
+    def add_user(self, user_id, username, first_name):
+        cursor = self.execute(
+            "INSERT OR IGNORE INTO users (user_id, username, first_name, joined, chat_id) VALUES (?, ?, ?, ?, ?)",
+            (str(user_id), username or 'unknown', first_name or 'Пользователь', datetime.now().strftime('%Y-%m-%d %H:%M:%S'), user_id)
+        )
+        if cursor.rowcount:
+            logger.info(f"👤 Новый пользователь: {user_id} ({first_name})")
+    
+    def get_user(self, user_id):
+        row = self.fetchone("SELECT * FROM users WHERE user_id = ?", (str(user_id),))
+        if row is None:
+            return None
+        user = dict(row)
+        del user['user_id']
+        return user
+    
+    def flush(self):
+        # Каждый запрос SQLite фиксируется сам (WAL), отдельный сброс не нужен
+        pass
+    
+    def get_flush_stats(self):
+        return {'flushes': 0, 'mutations': 0, 'total_ms': 0.0, 'last_ms': 0.0, 'max_ms': 0.0,
+                'pending': 0, 'avg_ms': 0.0, 'coalesced_ratio': 0.0}
+    
+    def get_all_user_ids(self):
+        return [row[0] for row in self.fetchall("SELECT user_id FROM users")]
+    
+    def get_active_user_ids(self):
+        return [row[0] for row in self.fetchall(
+            "SELECT user_id FROM users WHERE user_id NOT IN (SELECT user_id FROM inactive)"
+        )]
+    
+    def set_user_active(self, user_id, active):
+        if active:
+            cursor = self.execute("DELETE FROM inactive WHERE user_id = ?", (str(user_id),))
+        else:
+            cursor = self.execute(
+                "INSERT OR IGNORE INTO inactive (user_id, since) VALUES (?, ?)",
+                (str(user_id), datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            )
+        return cursor.rowcount > 0
+    
+    def get_premium_user_ids(self):
+        return [row[0] for row in self.fetchall("SELECT user_id FROM premium")]
+    
+    def update_counter(self, user_id, counter_name):
+        if counter_name not in USER_COUNTERS:
+            raise ValueError(f"Неизвестный счётчик: {counter_name}")
+        sql = "UPDATE users SET " + counter_name + " = " + counter_name + " + 1, total_requests = total_requests + 1 WHERE user_id = ?"
+        if not self.execute(sql, (str(user_id),)).rowcount:
+            self.add_user(user_id, None, None)
+            self.execute(sql, (str(user_id),))
+    
+    def add_premium(self, user_id, days):
+        end_date = (datetime.now() + timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+        self.execute("INSERT OR REPLACE INTO premium (user_id, expires_at) VALUES (?, ?)", (str(user_id), end_date))
+        self.premium_index.set(str(user_id), end_date)
+        logger.info(f"💎 Премиум активирован для {user_id} на {days} дней (до {end_date})")
+        return end_date
+    
+    def is_premium(self, user_id):
+        return self.premium_index.is_active(str(user_id))
+    
+    def remove_premium(self, user_id):
+        self.premium_index.remove(str(user_id))
+        if self.execute("DELETE FROM premium WHERE user_id = ?", (str(user_id),)).rowcount:
+            logger.info(f"❌ Премиум удалён для {user_id}")
+            return True
+        return False
+    
+    def expire_premium(self):
+        expired = self.premium_index.pop_expired()
+        if expired:
+            with self.lock:
+                self.conn.executemany("DELETE FROM premium WHERE user_id = ?", [(user_id,) for user_id in expired])
+            logger.info(f"⌛ Истёк премиум у {len(expired)} пользователей")
+        return expired
+    
+    def save_payment(self, payment_id, user_id, tariff_days, amount, status='pending'):
         try:
-            total_users = len(self.data.get('users', {}))
-            premium_users = len(self.data.get('premium', {}))
-            total_payments = len(self.data.get('payments', {}))
-            
-            successful_payments = 0
-            total_revenue = 0
-            for payment in self.data.get('payments', {}).values():
-                if payment.get('status') == 'succeeded':
-                    successful_payments += 1
-                    total_revenue += float(payment.get('amount', 0))
-            
-            total_horoscopes = sum(u.get('horoscope_count', 0) for u in self.data.get('users', {}).values())
-            total_numerology = sum(u.get('num_count', 0) for u in self.data.get('users', {}).values())
-            total_tarot = sum(u.get('tarot_count', 0) for u in self.data.get('users', {}).values())
-            total_compatibility = sum(u.get('compatibility_count', 0) for u in self.data.get('users', {}).values())
-            
-            return {
-                'total_users': total_users,
-                'premium_users': premium_users,
-                'total_payments': total_payments,
-                'successful_payments': successful_payments,
-                'total_horoscopes': total_horoscopes,
-                'total_numerology': total_numerology,
-                'total_tarot': total_tarot,
-                'total_compatibility': total_compatibility,
-                'total_revenue': total_revenue
-            }
+            self.execute(
+                "INSERT OR REPLACE INTO payments (payment_id, user_id, tariff_days, amount, status, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (payment_id, str(user_id), tariff_days, amount, status, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            )
+            logger.info(f"💰 Платеж сохранен: {payment_id} | Пользователь: {user_id} | Сумма: {amount}₽ | Статус: {status}")
         except Exception as e:
-            logger.error(f"❌ Ошибка получения статистики: {e}")
-            return {
-                'total_users': 0,
-                'premium_users': 0,
-                'total_payments': 0,
-                'successful_payments': 0,
-                'total_horoscopes': 0,
-                'total_numerology': 0,
-                'total_tarot': 0,
-                'total_compatibility': 0,
-                'total_revenue': 0
-            }
+            logger.error(f"❌ Ошибка сохранения платежа: {e}")
+    
+    def update_payment_status(self, payment_id, status):
+        try:
+            cursor = self.execute(
+                "UPDATE payments SET status = ?, updated_at = ? WHERE payment_id = ?",
+                (status, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), payment_id)
+            )
+            if cursor.rowcount:
+                logger.info(f"🔄 Статус платежа {payment_id} обновлен на: {status}")
+        except Exception as e:
+            logger.error(f"❌ Ошибка обновления статуса платежа: {e}")
+    
+    def update_user_birth_date(self, user_id, birth_date, life_path):
+        self.execute(
+            "UPDATE users SET birth_date = ?, life_path_number = ? WHERE user_id = ?",
+            (birth_date, life_path, str(user_id))
+        )
+    
+    def get_all_users_stats(self):
+        """O(1): итоги читаются из таблицы stats, которую ведут триггеры"""
+        stats = dict(self.fetchall("SELECT key, value FROM stats"))
+        return {key: stats.get(key, 0) for key in SQLITE_STATS_KEYS}
+    
+    def compute_stats(self, locked=False):
+        """Полный пересчёт статистики по таблицам (locked=True — блокировка уже взята)"""
+        if not locked:
+            with self.lock:
+                return self.compute_stats(locked=True)
+        execute = self.conn.execute
+        users = execute(
+            "SELECT COUNT(*), COALESCE(SUM(horoscope_count), 0), COALESCE(SUM(num_count), 0), "
+            "COALESCE(SUM(tarot_count), 0), COALESCE(SUM(compatibility_count), 0) FROM users"
+        ).fetchone()
+        successful = execute(
+            "SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM payments WHERE status = 'succeeded'"
+        ).fetchone()
+        return {
+            'total_users': users[0],
+            'premium_users': execute("SELECT COUNT(*) FROM premium").fetchone()[0],
+            'total_payments': execute("SELECT COUNT(*) FROM payments").fetchone()[0],
+            'successful_payments': successful[0],
+            'total_horoscopes': users[1],
+            'total_numerology': users[2],
+            'total_tarot': users[3],
+            'total_compatibility': users[4],
+            'total_revenue': successful[1]
+        }
+    
+    def verify_stats(self, repair=False):
+        with self.lock:
+            stored = dict(self.conn.execute("SELECT key, value FROM stats").fetchall())
+            actual = self.compute_stats(locked=True)
+        drift = stats_drift({key: stored.get(key, 0) for key in SQLITE_STATS_KEYS}, actual)
+        if drift:
+            logger.warning(f"⚠️ Расхождение статистики: {drift}")
+            if repair:
+                self.repair_stats(drift)
+        return drift
+    
+    def repair_stats(self, drift):
+        """Сдвигает итоги на величину расхождения — приращения триггеров после сверки не теряются"""
+        with self.lock:
+            self.conn.executemany(
+                "INSERT INTO stats (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = value + excluded.value",
+                [(key, actual - (stored or 0)) for key, (stored, actual) in drift.items()]
+            )
 
 # Инициализация БД
-db = UserDatabase()
+if DB_STORAGE == 'sqlite':
+    db = SQLiteUserDatabase()
+else:
+    db = UserDatabase()
+# Страховка: всё, что не успел сбросить db_flusher, пишем при выходе процесса
+atexit.register(db.flush)
+
+# ====== МЕТРИКИ ИСПОЛЬЗОВАНИЯ ======
+# Поминутно — последние 3 часа в памяти; почасовые и посуточные свёртки — в METRICS_DIR
+METRICS_DIR = os.getenv("METRICS_DIR", "data/metrics")
+METRICS_ROLL_INTERVAL = 60
+METRICS = MetricsStore(METRICS_DIR)
+# Как часто замерять задержку цикла событий (насколько позже положенного просыпается sleep)
+LOOP_LAG_INTERVAL = 0.5
+PROCESS_START_TIME = time.time()
+
+# ====== ФОНОВЫЙ СБРОС БД ======
+async def db_flusher():
+    """Сбрасывает изменения БД в пуле потоков, объединяя частые записи в одну"""
+    loop = asyncio.get_running_loop()
+    db.flush_event = asyncio.Event()
+    try:
+        while True:
+            try:
+                await asyncio.wait_for(db.flush_event.wait(), DB_FLUSH_INTERVAL_MS / 1000)
+            except asyncio.TimeoutError:
+                pass
+            db.flush_event.clear()
+            await loop.run_in_executor(None, db.flush)
+    finally:
+        db.flush_event = None
+        db.flush()
+
+async def horoscope_cache_warmer():
+    """Прогревает кэш гороскопов в полночь и на каждой границе периода суток"""
+    while True:
+        try:
+            HOROSCOPE_CACHE.warm()
+        except Exception as e:
+            logger.error(f"❌ Ошибка прогрева кэша гороскопов: {e}")
+        # +1 секунда, чтобы гарантированно проснуться уже в новом периоде
+        await asyncio.sleep(seconds_until_next_period(datetime.now()) + 1)
+
+async def metrics_roller():
+    """Раз в минуту дописывает завершённые часы и сутки метрик на диск"""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(METRICS_ROLL_INTERVAL)
+        try:
+            await loop.run_in_executor(None, METRICS.roll)
+        except Exception as e:
+            logger.error(f"❌ Ошибка записи метрик: {e}")
+
+async def loop_lag_monitor():
+    """Задержка цикла событий: на сколько позже положенного проснулся asyncio.sleep"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, loop.time() - started - LOOP_LAG_INTERVAL)
+        METRICS.set_gauge('event_loop_lag_seconds', lag)
+        if lag > METRICS.gauges.get('event_loop_lag_max_seconds', 0.0):
+            METRICS.set_gauge('event_loop_lag_max_seconds', lag)
+
+async def premium_expirer():
+    """Раз в PREMIUM_EXPIRY_INTERVAL секунд снимает истёкшие премиумы пачкой"""
+    while True:
+        await asyncio.sleep(PREMIUM_EXPIRY_INTERVAL)
+        try:
+            db.expire_premium()
+        except Exception as e:
+            logger.error(f"❌ Ошибка снятия истёкших премиумов: {e}")
 
 # ====== БИБЛИОТЕКА ИЗОБРАЖЕНИЙ ======
 ZODIAC_IMAGES = {
@@ -580,128 +1464,677 @@ TAROT_IMAGES = {
     "Отшельник": "https://img.icons8.com/color/512/hermit.png"
 }
 
+# ---- Кэш file_id изображений ----
+IMAGE_FILE_IDS_FILE = os.getenv("IMAGE_FILE_IDS_FILE", "data/image_file_ids.json")
+
+# Тексты BadRequest, означающие, что file_id больше не годится (Telegram пишет их в разном регистре)
+STALE_FILE_ID_ERRORS = (
+    'wrong file identifier',
+    'wrong remote file identifier',
+    'file reference has expired',
+    'file_reference_expired',
+    'invalid file_id',
+    'file_id_invalid',
+)
+
+class ImageAssets:
+    """
+    Каждое изображение загружается в Telegram один раз, дальше отправляется по file_id —
+    короткая ссылка вместо повторного скачивания URL или загрузки файла.
+    Ключ — sha256 содержимого для локальных файлов (файл поменялся — загрузится заново)
+    и sha256 адреса для URL. Устаревший file_id (BadRequest о неверном идентификаторе файла)
+    забывается и загружается снова; прочие BadRequest (подпись, разметка) пробрасываются как есть.
+    """
+    
+    def __init__(self, filename=IMAGE_FILE_IDS_FILE):
+        self.filename = filename
+        self.file_ids = {}       # ключ изображения → file_id
+        self.file_hashes = {}    # путь → (mtime, размер, sha256)
+        self.save_lock = Lock()
+        self.load()
+    
+    def load(self):
+        for path in snapshot_candidates(self.filename, generations=1):
+            if not os.path.exists(path):
+                continue
+            try:
+                self.file_ids = read_snapshot(path)['file_ids']
+            except Exception as e:
+                logger.error(f"Ошибка загрузки кэша изображений из {path}: {e}")
+                continue
+            logger.info(f"🖼 Загружено file_id изображений: {len(self.file_ids)}")
+            return
+    
+    def save(self):
+        with self.save_lock:
+            payload = json.dumps({'file_ids': dict(self.file_ids)}, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            write_snapshot(self.filename, payload, generations=1)
+    
+    def schedule_save(self):
+        asyncio.get_running_loop().run_in_executor(None, self.save)
+    
+    @staticmethod
+    def is_url(source):
+        return source.startswith(('http://', 'https://'))
+    
+    def key(self, source):
+        if self.is_url(source):
+            return 'url:' + hashlib.sha256(source.encode('utf-8')).hexdigest()
+        stat = os.stat(source)
+        cached = self.file_hashes.get(source)
+        if cached is None or cached[:2] != (stat.st_mtime, stat.st_size):
+            with open(source, 'rb') as f:
+                cached = (stat.st_mtime, stat.st_size, hashlib.sha256(f.read()).hexdigest())
+            self.file_hashes[source] = cached
+        return 'sha256:' + cached[2]
+    
+    def upload(self, source):
+        """Что передать Telegram при первой отправке: URL как есть, локальный файл — содержимым"""
+        if self.is_url(source):
+            return source
+        with open(source, 'rb') as f:
+            return f.read()
+    
+    def remember(self, key, message):
+        if message is not None and message.photo:
+            self.file_ids[key] = message.photo[-1].file_id
+            self.schedule_save()
+    
+    @staticmethod
+    def is_stale_file_id(error):
+        """BadRequest именно о неверном или устаревшем file_id, а не о подписи или разметке"""
+        message = str(error).lower()
+        return any(marker in message for marker in STALE_FILE_ID_ERRORS)
+    
+    def forget(self, key, error):
+        logger.warning(f"🖼 file_id устарел ({error}), изображение будет загружено заново")
+        self.file_ids.pop(key, None)
+        self.schedule_save()
+    
+    async def send_photo(self, message, source, **kwargs):
+        key = self.key(source)
+        file_id = self.file_ids.get(key)
+        if file_id:
+            try:
+                return await message.reply_photo(photo=file_id, **kwargs)
+            except BadRequest as e:
+                if not self.is_stale_file_id(e):
+                    raise
+                self.forget(key, e)
+        sent = await message.reply_photo(photo=self.upload(source), **kwargs)
+        self.remember(key, sent)
+        return sent
+    
+    async def send_album(self, message, items):
+        """items — [(источник, подпись)]; альбом одним sendMediaGroup"""
+        keys = [self.key(source) for source, caption in items]
+        if all(key in self.file_ids for key in keys):
+            try:
+                return await message.reply_media_group(media=[
+                    InputMediaPhoto(media=self.file_ids[key], caption=caption)
+                    for key, (source, caption) in zip(keys, items)
+                ])
+            except BadRequest as e:
+                if not self.is_stale_file_id(e):
+                    raise
+                # Какой из file_id устарел, Telegram не говорит — загружаем весь альбом заново
+                for key in keys:
+                    self.forget(key, e)
+        sent = await message.reply_media_group(media=[
+            InputMediaPhoto(media=self.file_ids.get(key) or self.upload(source), caption=caption)
+            for key, (source, caption) in zip(keys, items)
+        ])
+        for key, sent_message in zip(keys, sent):
+            self.remember(key, sent_message)
+        return sent
+
+IMAGE_ASSETS = ImageAssets()
+
 # ====== УЛУЧШЕННАЯ ГЕНЕРАЦИЯ ГОРОСКОПОВ ======
-def get_current_date_string():
+def get_current_date_string(now=None):
     months = {1: "января", 2: "февраля", 3: "марта", 4: "апреля", 5: "мая", 6: "июня",
               7: "июля", 8: "августа", 9: "сентября", 10: "октября", 11: "ноября", 12: "декабря"}
-    now = datetime.now()
+    now = now or datetime.now()
     weekday = ["понедельник", "вторник", "среда", "четверг", "пятница", "суббота", "воскресенье"][now.weekday()]
     return f"{now.day} {months[now.month]} {now.year} года ({weekday})"
 
+# ---- Шаблоны гороскопов (разбираются один раз, см. templates.py) ----
+BASIC_HOROSCOPE_TEMPLATE = Template(
+    "✨ *Гороскоп для {sign}* ✨\n*На {date}*\n\n"
+    "🌅 *{period}:* {time_text}\n\n"
+    "{moon_name} — {moon_desc}\n\n"
+    "{energy}\n\n"
+    "💖 *Любовь:* {love}\n\n"
+    "💼 *Карьера:* {career}\n\n"
+    "🌿 *Здоровье:* {health}\n\n"
+    "💫 *Совет:* {advice}\n\n"
+    "{unique}#{tag} #Астрология #Гороскоп"
+)
+
+# Слоты шаблона, привязанного к знаку и периоду суток, в порядке текста — в этом порядке их ждёт fill()
+BASIC_SLOTS = ("date", "time_text", "moon_name", "moon_desc", "energy", "love", "career", "health", "advice", "unique")
+
+def bind_sign(template, zodiac_sign, time_period):
+    bound = template.bind(sign=zodiac_sign, tag=zodiac_sign.split()[-1], period=time_period.title())
+    if bound.slots != BASIC_SLOTS:
+        raise ValueError(f"слоты базового шаблона {bound.slots} не совпадают с BASIC_SLOTS")
+    return bound
+
+# Знак и период суток подставлены заранее: на каждый гороскоп остаются только дневные слоты
+BASIC_TEMPLATES = {
+    (sign, period): bind_sign(BASIC_HOROSCOPE_TEMPLATE, sign, period)
+    for sign in ZODIAC_UNIQUE for period in TIME_PERIOD_TEXTS
+}
+
+PREMIUM_ADDITION_TEMPLATE = Template("""
+
+✨ *ПРЕМИУМ ДОПОЛНЕНИЕ* ✨
+
+*Астрологические детали:*
+• Луна в знаке: {moon}
+• Благоприятное время: {time}
+• Камень-талисман: {stone}
+• Цвет удачи: {color}
+
+*Недельный прогноз:*
+{weekly}
+
+#Премиум""")
+if PREMIUM_ADDITION_TEMPLATE.slots != ("moon", "time", "stone", "color", "weekly"):
+    raise ValueError("слоты премиум-дополнения не совпадают с порядком в render_premium_addition")
+PREMIUM_MOON_SIGNS = prepare_pool(['Овна', 'Тельца', 'Близнецов', 'Рака', 'Льва', 'Девы', 'Весов', 'Скорпиона', 'Стрельца', 'Козерога', 'Водолея', 'Рыб'])
+PREMIUM_TIMES = prepare_pool(['утро 9-11', 'день 14-16', 'вечер 19-21'])
+PREMIUM_STONES = prepare_pool(['аметист', 'горный хрусталь', 'розовый кварц', 'лазурит', 'тигровый глаз', 'цитрин'])
+PREMIUM_COLORS = prepare_pool(['золотой', 'изумрудный', 'сапфировый', 'рубиновый', 'лавандовый'])
+PREMIUM_WEEKLY = prepare_pool([
+    'Неделя принесет важные переговоры и новые возможности для роста.',
+    'Финансовая сфера будет особенно благоприятной в середине недели.',
+    'Отличное время для творческих проектов и самовыражения.'
+])
+
 def generate_basic_horoscope(zodiac_sign, user_id=None, personalize=False):
     """
     Базовый гороскоп — ПРОФЕССИОНАЛЬНАЯ ГЕНЕРАЦИЯ
     ✅ Уникальный каждый день + время суток + лунная фаза + опциональная персонализация
     """
-    today = datetime.now().strftime("%Y-%m-%d")
-    
-    # Уникальный seed на день + знак + (опционально) user_id
     if personalize and user_id:
+        return render_basic_horoscope(zodiac_sign, user_id)
+    # Без персонализации текст зависит только от (дата, знак, период суток)
+    return HOROSCOPE_CACHE.get(zodiac_sign)
+
+def horoscope_rng(today, zodiac_sign, user_id=None):
+    """
+    Собственный генератор на каждый гороскоп вместо random.seed() глобального модуля:
+    seed тот же (день + знак + опционально user_id), поэтому тексты не меняются,
+    а параллельные запросы не сбивают друг другу последовательность.
+    """
+    if user_id:
         seed_input = f"{today}_{zodiac_sign}_{user_id}"
     else:
         seed_input = f"{today}_{zodiac_sign}"
-    
     seed_hash = hashlib.md5(seed_input.encode()).hexdigest()
-    seed_number = int(seed_hash[:8], 16)
-    random.seed(seed_number)
-    
-    date_str = get_current_date_string()
-    time_period, time_texts = get_time_period()
-    moon_name, moon_desc = get_moon_phase()
+    return random.Random(int(seed_hash[:8], 16))
+
+def render_basic_horoscope(zodiac_sign, user_id=None, now=None, rng=None):
+    now = now or datetime.now()
+    if rng is None:
+        rng = horoscope_rng(now.strftime("%Y-%m-%d"), zodiac_sign, user_id)
     
-    # Выбираем уникальные фразы
-    energy = random.choice(ENERGY_TEXTS)
-    love = random.choice(LOVE_TEXTS)
-    career = random.choice(CAREER_TEXTS)
-    health = random.choice(HEALTH_TEXTS)
-    advice = random.choice(ADVICE_TEXTS)
-    time_text = random.choice(time_texts)
-    unique_phrase = random.choice(ZODIAC_UNIQUE.get(zodiac_sign, [""]))
+    date_str = get_current_date_string(now)
+    time_period, time_texts = get_time_period(now)
+    moon_name, moon_desc = get_moon_phase(now)
     
-    # Собираем гороскоп БЕЗ f-строк с эмодзи внутри
-    intro = "✨ *Гороскоп для " + zodiac_sign + "* ✨\n*На " + date_str + "*\n\n"
-    time_section = "🌅 *" + time_period.title() + ":* " + time_text + "\n\n"
-    moon_section = moon_name + " — " + moon_desc + "\n\n"
-    main_text = energy + "\n\n"
-    love_line = "💖 *Любовь:* " + love + "\n\n"
-    career_line = "💼 *Карьера:* " + career + "\n\n"
-    health_line = "🌿 *Здоровье:* " + health + "\n\n"
-    advice_line = "💫 *Совет:* " + advice + "\n\n"
+    template = BASIC_TEMPLATES.get((zodiac_sign, time_period)) or bind_sign(BASIC_HOROSCOPE_TEMPLATE, zodiac_sign, time_period)
+    # Порядок выборок не менять: от него зависят тексты при том же seed
+    energy = rng.choice(ENERGY_TEXTS)
+    love = rng.choice(LOVE_TEXTS)
+    career = rng.choice(CAREER_TEXTS)
+    health = rng.choice(HEALTH_TEXTS)
+    advice = rng.choice(ADVICE_TEXTS)
+    time_text = rng.choice(time_texts)
+    unique = rng.choice(ZODIAC_UNIQUE_LINES.get(zodiac_sign, ("",)))
+    # Значения — в порядке BASIC_SLOTS
+    return template.fill((date_str, time_text, moon_name, moon_desc, energy, love, career, health, advice, unique))
+
+# ====== КЭШ БАЗОВЫХ ГОРОСКОПОВ ======
+class HoroscopeCache:
+    """Готовые тексты базовых гороскопов по ключу (дата, знак, период суток)"""
     
-    horoscope = intro + time_section + moon_section + main_text + love_line + career_line + health_line + advice_line
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.warmups = 0
     
-    if unique_phrase:
-        horoscope += "*Особенность для вашего знака:* " + unique_phrase + "\n\n"
+    def get(self, zodiac_sign, now=None):
+        now = now or datetime.now()
+        key = (now.strftime("%Y-%m-%d"), zodiac_sign, get_time_period(now)[0])
+        horoscope = self.entries.get(key)
+        if horoscope is None:
+            self.misses += 1
+            horoscope = self.entries[key] = render_basic_horoscope(zodiac_sign, now=now)
+        else:
+            self.hits += 1
+        return horoscope
     
-    horoscope += "#" + zodiac_sign.split()[-1] + " #Астрология #Гороскоп"
+    def warm(self, now=None):
+        """Рендерит все 12 знаков для текущего периода и выбрасывает прошедшие дни"""
+        now = now or datetime.now()
+        today = now.strftime("%Y-%m-%d")
+        period = get_time_period(now)[0]
+        entries = {key: value for key, value in self.entries.items() if key[0] == today}
+        for zodiac_sign in ZODIAC_IMAGES:
+            entries[(today, zodiac_sign, period)] = render_basic_horoscope(zodiac_sign, now=now)
+        self.entries = entries
+        self.warmups += 1
     
-    return horoscope
+    def get_stats(self):
+        requests = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'warmups': self.warmups,
+            'hit_ratio': self.hits / requests if requests else 0.0
+        }
+
+HOROSCOPE_CACHE = HoroscopeCache()
+
+def seconds_until_next_period(now):
+    for hour in TIME_PERIOD_BOUNDARIES:
+        boundary = now.replace(hour=hour, minute=0, second=0, microsecond=0)
+        if boundary > now:
+            return (boundary - now).total_seconds()
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    return (midnight - now).total_seconds()
 
 def generate_premium_horoscope(zodiac_sign, user_id=None, personalize=False):
     """Премиум гороскоп из базы (полный, разнообразный)"""
-    today = datetime.now().strftime("%Y-%m-%d")
+    now = datetime.now()
+    today = now.strftime("%Y-%m-%d")
     
-    if today in PREMIUM_HOROSCOPES and zodiac_sign in PREMIUM_HOROSCOPES[today]:
-        return PREMIUM_HOROSCOPES[today][zodiac_sign]
+    if PREMIUM_HOROSCOPES is not None:
+        horoscope = PREMIUM_HOROSCOPES.get_day(today).get(zodiac_sign)
+        if horoscope:
+            return horoscope
+    
+    # Если нет в базе — генерируем расширенный; дополнение тянет из того же генератора
+    personal_id = user_id if personalize else None
+    rng = horoscope_rng(today, zodiac_sign, personal_id)
+    base = render_basic_horoscope(zodiac_sign, personal_id, now=now, rng=rng)
+    
+    return base + render_premium_addition(rng)
+
+def render_premium_addition(rng):
+    """Премиум-дополнение; выборки идут в порядке слотов шаблона: луна, время, камень, цвет, прогноз"""
+    return PREMIUM_ADDITION_TEMPLATE.fill((
+        rng.choice(PREMIUM_MOON_SIGNS),
+        rng.choice(PREMIUM_TIMES),
+        rng.choice(PREMIUM_STONES),
+        rng.choice(PREMIUM_COLORS),
+        rng.choice(PREMIUM_WEEKLY),
+    ))
+
+# ====== HTTP-СЕРВЕР ДЛЯ RENDER (обязательно!) ======
+def metrics_query(path, query):
+    """JSON-ответ для /metrics/recent, /metrics/hourly и /metrics/daily; None — неизвестный путь"""
+    def number(name, default, limit):
+        try:
+            return max(1, min(int(query.get(name, [default])[0]), limit))
+        except ValueError:
+            return default
+    if path == "/metrics/recent":
+        return {'handlers': METRICS.recent(number('minutes', 60, 180))}
+    if path == "/metrics/hourly":
+        hours = number('hours', 24, 24 * 31)
+        return {'series': METRICS.series('hour', hours), 'handlers': METRICS.handlers('hour', hours)}
+    if path == "/metrics/daily":
+        days = number('days', 30, 400)
+        return {'series': METRICS.series('day', days), 'handlers': METRICS.handlers('day', days)}
+    return None
+
+def process_rss_bytes():
+    """Текущий RSS процесса (Linux /proc); 0, если узнать нельзя"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+def render_prometheus_metrics():
+    """
+    /metrics в текстовом формате Prometheus. Только счётчики в памяти:
+    БД пользователей не читается, блокировки БД не берутся.
+    """
+    lines = METRICS.prometheus('astrobot')
+    lines += prometheus_lines('astrobot_updates_total', 'counter', 'Принято апдейтов Telegram',
+                              [({}, METRICS.counters.get('updates', 0))])
     
-    # Если нет в базе — генерируем расширенный
-    base = generate_basic_horoscope(zodiac_sign, user_id, personalize)
+    flush_stats = db.get_flush_stats()
+    lines += prometheus_lines('astrobot_db_flushes_total', 'counter', 'Сбросов БД на диск', [({}, flush_stats['flushes'])])
+    lines += prometheus_lines('astrobot_db_flush_seconds_total', 'counter', 'Суммарное время сбросов БД',
+                              [({}, flush_stats['total_ms'] / 1000)])
+    lines += prometheus_lines('astrobot_db_flush_last_seconds', 'gauge', 'Длительность последнего сброса БД',
+                              [({}, flush_stats['last_ms'] / 1000)])
+    lines += prometheus_lines('astrobot_db_flush_max_seconds', 'gauge', 'Самый долгий сброс БД',
+                              [({}, flush_stats['max_ms'] / 1000)])
+    lines += prometheus_lines('astrobot_db_pending_mutations', 'gauge', 'Изменения БД, ещё не сброшенные на диск',
+                              [({}, flush_stats['pending'])])
     
-    moon_name, moon_desc = get_moon_phase()
+    cache_stats = HOROSCOPE_CACHE.get_stats()
+    hits = [({'cache': 'horoscope'}, cache_stats['hits'])]
+    misses = [({'cache': 'horoscope'}, cache_stats['misses'])]
+    cache_info = getattr(getattr(PREMIUM_HOROSCOPES, 'get_day', None), 'cache_info', None)
+    if cache_info is not None:
+        info = cache_info()
+        hits.append(({'cache': 'premium_days'}, info.hits))
+        misses.append(({'cache': 'premium_days'}, info.misses))
+    lines += prometheus_lines('astrobot_cache_hits_total', 'counter', 'Попадания в кэши', hits)
+    lines += prometheus_lines('astrobot_cache_misses_total', 'counter', 'Промахи кэшей', misses)
     
-    premium_addition = """
+    broadcasts = list(ACTIVE_BROADCASTS)
+    lines += prometheus_lines('astrobot_broadcasts_active', 'gauge', 'Идущие рассылки', [({}, len(broadcasts))])
+    samples = []
+    for broadcast in broadcasts:
+        counts = dict(broadcast.job.counts)
+        samples += [({'job': broadcast.id, 'status': status}, count) for status, count in counts.items()]
+    lines += prometheus_lines('astrobot_broadcast_recipients', 'gauge', 'Получатели идущих рассылок по статусам', samples)
+    
+    lines += prometheus_lines('astrobot_update_queue_depth', 'gauge', 'Апдейты по стадиям: ждут свой чат, ждут слот, выполняются', [
+        ({'stage': 'chat'}, METRICS.gauges.get('updates_waiting_chat', 0)),
+        ({'stage': 'slot'}, METRICS.gauges.get('updates_waiting_slot', 0)),
+        ({'stage': 'running'}, METRICS.gauges.get('updates_running', 0)),
+    ])
+    lines += prometheus_lines('astrobot_send_queue_chats', 'gauge', 'Чаты с недоставленными ответами в конвейере',
+                              [({}, len(SEND_PIPELINE.workers))])
+    lines += prometheus_lines('astrobot_send_retry_after_total', 'counter', 'Ответы, отложенные по RetryAfter',
+                              [({}, METRICS.counters.get('send_retry_after', 0))])
+    lines += prometheus_lines('astrobot_update_chat_backlog_max', 'gauge', 'Самая длинная очередь одного чата с запуска',
+                              [({}, METRICS.gauges.get('updates_max_chat_backlog', 0))])
+    lines += prometheus_lines('astrobot_update_concurrency_limit', 'gauge', 'Предел одновременно обрабатываемых апдейтов',
+                              [({}, UPDATE_CONCURRENCY)])
+    lines += prometheus_lines('astrobot_event_loop_lag_seconds', 'gauge', 'Текущая задержка цикла событий',
+                              [({}, METRICS.gauges.get('event_loop_lag_seconds', 0.0))])
+    lines += prometheus_lines('astrobot_event_loop_lag_max_seconds', 'gauge', 'Максимальная задержка цикла событий с запуска',
+                              [({}, METRICS.gauges.get('event_loop_lag_max_seconds', 0.0))])
+    lines += prometheus_lines('process_resident_memory_bytes', 'gauge', 'Resident memory size in bytes',
+                              [({}, process_rss_bytes())])
+    lines += prometheus_lines('process_start_time_seconds', 'gauge', 'Start time of the process since unix epoch',
+                              [({}, PROCESS_START_TIME)])
+    return "\n".join(lines) + "\n"
 
-✨ *ПРЕМИУМ ДОПОЛНЕНИЕ* ✨
+# ---- Сервер на asyncio в цикле событий бота ----
+HTTP_PORT = int(os.environ.get("PORT", 10000))
+HTTP_KEEPALIVE_TIMEOUT = 15
+HTTP_MAX_BODY = 1024 * 1024
+# /ready отвечает 503, если апдейтов не было дольше READY_MAX_UPDATE_AGE секунд (0 — не проверять)
+READY_MAX_UPDATE_AGE = int(os.getenv("READY_MAX_UPDATE_AGE", 0))
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed",
+                413: "Payload Too Large", 503: "Service Unavailable"}
+HTTP_CONNECTIONS = {}  # writer → задача соединения
+HTTP_SERVER = None
 
-*Астрологические детали:*
-• Луна в знаке: {moon}
-• Благоприятное время: {time}
-• Камень-талисман: {stone}
-• Цвет удачи: {color}
+# ---- Webhook (BOT_MODE=webhook) ----
+# Webhook включается только явно: BOT_MODE=webhook или заданный WEBHOOK_URL. RENDER_EXTERNAL_URL
+# Render выставляет всем сервисам, поэтому он лишь подставляет адрес, но режим сам не переключает
+BOT_MODE = os.getenv("BOT_MODE", "webhook" if os.getenv("WEBHOOK_URL") else "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") or (os.getenv("RENDER_EXTERNAL_URL") if BOT_MODE == 'webhook' else None)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+# Секрет для заголовка X-Telegram-Bot-Api-Secret-Token; по умолчанию выводится из токена и не меняется между рестартами
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(("webhook:" + BOT_TOKEN).encode()).hexdigest()[:48]
+# Сколько апдейтов разных чатов обрабатывать одновременно (апдейты одного чата — всегда по очереди)
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", 32))
+# Сколько апдейтов всего может быть принято в обработку (в очередях чатов + выполняющихся)
+UPDATE_BACKLOG_LIMIT = int(os.getenv("UPDATE_BACKLOG_LIMIT", 1024))
+WEBHOOK_ACTIVE = False
 
-*Недельный прогноз:*
-{weekly}
+def readiness_state(app):
+    """Реальное состояние бота для /ready: БД, получение апдейтов (polling или webhook), возраст последнего апдейта"""
+    last_update = METRICS.gauges.get('last_update_time')
+    state = {
+        'db_loaded': db is not None,
+        'db_pending': db.get_flush_stats()['pending'],
+        'mode': 'webhook' if WEBHOOK_ACTIVE else 'polling',
+        'receiving': bool(app.running and (WEBHOOK_ACTIVE or (app.updater is not None and app.updater.running))),
+        'last_update_age': round(time.time() - last_update, 1) if last_update else None,
+    }
+    fresh = (
+        not READY_MAX_UPDATE_AGE
+        or state['last_update_age'] is None
+        or state['last_update_age'] <= READY_MAX_UPDATE_AGE
+    )
+    state['ready'] = state['db_loaded'] and state['receiving'] and fresh
+    return state
 
-#Премиум""".format(
-        moon=random.choice(['Овна', 'Тельца', 'Близнецов', 'Рака', 'Льва', 'Девы', 'Весов', 'Скорпиона', 'Стрельца', 'Козерога', 'Водолея', 'Рыб']),
-        time=random.choice(['утро 9-11', 'день 14-16', 'вечер 19-21']),
-        stone=random.choice(['аметист', 'горный хрусталь', 'розовый кварц', 'лазурит', 'тигровый глаз', 'цитрин']),
-        color=random.choice(['золотой', 'изумрудный', 'сапфировый', 'рубиновый', 'лавандовый']),
-        weekly=random.choice([
-            'Неделя принесет важные переговоры и новые возможности для роста.',
-            'Финансовая сфера будет особенно благоприятной в середине недели.',
-            'Отличное время для творческих проектов и самовыражения.'
-        ])
+async def receive_webhook(app, headers, body):
+    """Принимает апдейт от Telegram и кладёт его в очередь приложения; обработка идёт отдельно"""
+    if not hmac.compare_digest(headers.get('x-telegram-bot-api-secret-token', ''), WEBHOOK_SECRET):
+        logger.warning("⚠️ Webhook: запрос с неверным секретом отклонён")
+        return 403, "text/plain", b"Forbidden"
+    try:
+        payload = json.loads(body)
+        # Валидный JSON, но не апдейт ([] или {} без update_id) — тоже 400, иначе Telegram будет повторять запрос
+        update = Update.de_json(payload, app.bot) if isinstance(payload, dict) and 'update_id' in payload else None
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return 400, "text/plain", b"Bad Request"
+    if update is None:
+        return 400, "text/plain", b"Bad Request"
+    await app.update_queue.put(update)
+    return 200, "text/plain", b"OK"
+
+async def route_http(app, method, path, query, headers, body):
+    """(статус, Content-Type, тело) для запроса к HTTP-серверу"""
+    if path == WEBHOOK_PATH and method == "POST" and WEBHOOK_ACTIVE:
+        return await receive_webhook(app, headers, body)
+    if method not in ("GET", "HEAD"):
+        return 405, "text/plain", b"Method Not Allowed"
+    if path == "/health":
+        # Живость процесса: отвечает, пока цикл событий жив
+        return 200, "text/plain", b"OK"
+    if path == "/ready":
+        state = readiness_state(app)
+        return (200 if state['ready'] else 503), "application/json; charset=utf-8", json.dumps(state).encode('utf-8')
+    if path == "/metrics":
+        return 200, "text/plain; version=0.0.4; charset=utf-8", render_prometheus_metrics().encode('utf-8')
+    result = metrics_query(path, query) if path.startswith("/metrics/") else None
+    if result is None:
+        return 404, "text/plain", b"Not Found"
+    return 200, "application/json; charset=utf-8", json.dumps(result, ensure_ascii=False).encode('utf-8')
+
+async def read_http_request(reader):
+    """Читает запрос HTTP/1.x; None — соединение закрыто или простаивало дольше keep-alive"""
+    request_line = await asyncio.wait_for(reader.readline(), HTTP_KEEPALIVE_TIMEOUT)
+    if not request_line:
+        return None
+    method, target, version = request_line.decode('latin-1').split()
+    headers = {}
+    while True:
+        line = await asyncio.wait_for(reader.readline(), HTTP_KEEPALIVE_TIMEOUT)
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode('latin-1').partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length') or 0)
+    if length > HTTP_MAX_BODY:
+        raise ValueError("тело запроса слишком большое")
+    body = await reader.readexactly(length) if length else b""
+    return method, target, version, headers, body
+
+async def handle_http_connection(app, reader, writer):
+    """Одно соединение: запросы обслуживаются по очереди, пока клиент держит keep-alive"""
+    HTTP_CONNECTIONS[writer] = asyncio.current_task()
+    try:
+        while True:
+            try:
+                request = await read_http_request(reader)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                break
+            except ValueError:
+                writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                await writer.drain()
+                break
+            if request is None:
+                break
+            method, target, version, headers, body = request
+            url = urlsplit(target)
+            try:
+                status, content_type, payload = await route_http(app, method, url.path, parse_qs(url.query), headers, body)
+            except Exception as e:
+                logger.error(f"❌ Ошибка HTTP-обработчика {url.path}: {e}")
+                status, content_type, payload = 503, "text/plain", b"Service Unavailable"
+            connection = headers.get('connection', '').lower()
+            keep_alive = connection == 'keep-alive' if version == "HTTP/1.0" else connection != 'close'
+            head = (
+                f"HTTP/1.1 {status} {HTTP_REASONS.get(status, 'OK')}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+            ).encode('latin-1')
+            writer.write(head if method == "HEAD" else head + payload)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except ConnectionError:
+        pass
+    finally:
+        HTTP_CONNECTIONS.pop(writer, None)
+        writer.close()
+
+async def start_http_server(app):
+    """Запускает HTTP-сервер для Render на PORT в цикле событий бота"""
+    global HTTP_SERVER
+    HTTP_SERVER = await asyncio.start_server(
+        lambda reader, writer: handle_http_connection(app, reader, writer), "0.0.0.0", HTTP_PORT
     )
+    port = HTTP_SERVER.sockets[0].getsockname()[1]
+    logger.info(f"🌐 HTTP-сервер запущен на порту {port}")
+
+async def stop_http_server():
+    global HTTP_SERVER
+    if HTTP_SERVER is None:
+        return
+    HTTP_SERVER.close()
+    # Соединения keep-alive сами не закроются — закрываем сокеты, обработчики выходят по EOF
+    tasks = list(HTTP_CONNECTIONS.values())
+    for writer in list(HTTP_CONNECTIONS):
+        writer.close()
+    if tasks:
+        await asyncio.wait(tasks, timeout=1)
+    await HTTP_SERVER.wait_closed()
+    HTTP_SERVER = None
+
+# ====== КОНТЕКСТ ОБНОВЛЕНИЯ ======
+class UpdateContext:
+    """Пользователь и его премиум-статус, вычисленные один раз на апдейт"""
     
-    return base + premium_addition
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.is_premium = db.is_premium(user_id) if user_id else False
+        self._user = None
+        self._user_loaded = False
+    
+    @property
+    def user(self):
+        # Запись пользователя нужна не всем обработчикам — читаем её по первому требованию
+        if not self._user_loaded:
+            self._user = db.get_user(self.user_id) if self.user_id else None
+            self._user_loaded = True
+        return self._user
 
-# ====== HTTP-СЕРВЕР ДЛЯ RENDER (обязательно!) ======
-class HealthCheckHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        if self.path == "/health":
-            self.send_response(200)
-            self.send_header("Content-type", "text/plain")
-            self.end_headers()
-            self.wfile.write(b"OK")
-        else:
-            self.send_response(404)
-            self.end_headers()
+async def prepare_update_context(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """TypeHandler группы -1: один и тот же context получают все обработчики этого апдейта"""
+    METRICS.inc('updates')
+    METRICS.set_gauge('last_update_time', time.time())
+    user = update.effective_user
+    context.update_ctx = UpdateContext(user.id if user else None)
+
+def get_update_context(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    update_ctx = getattr(context, 'update_ctx', None)
+    if update_ctx is None:
+        user = update.effective_user
+        update_ctx = context.update_ctx = UpdateContext(user.id if user else None)
+    return update_ctx
+
+# ====== КОНВЕЙЕР ОТПРАВКИ ОТВЕТОВ ======
+SEND_MAX_ATTEMPTS = 3
+
+class SendPipeline:
+    """
+    Исходящие сообщения по очереди на каждый чат: обработчик ставит ответы в очередь и продолжает
+    работу, а доставка идёт в фоне строго по порядку. Никаких пауз «на всякий случай»:
+    ждём только когда Telegram сам попросил (RetryAfter), и только в этом чате.
+    Future каждой отправки завершается сообщением или ошибкой доставки: обработчик ждёт future
+    главного ответа и при ошибке отправляет запасной. Ошибки сопутствующих сообщений, которые
+    никто не ждёт, только пишутся в лог.
+    """
     
-    def log_message(self, format, *args):
-        # Подавляем логи HTTP-сервера
-        pass
+    def __init__(self):
+        self.queues = {}   # chat_id → deque[(отправка, future)]
+        self.workers = {}  # chat_id → задача доставки
+    
+    def submit(self, chat_id, send):
+        """send — функция без аргументов, возвращающая корутину отправки; результат — future с сообщением"""
+        future = asyncio.get_running_loop().create_future()
+        # Ошибка уже в логе воркера — для неожидаемых отправок не нужен «exception was never retrieved»
+        future.add_done_callback(lambda done: done.cancelled() or done.exception())
+        queue = self.queues.get(chat_id)
+        if queue is None:
+            queue = self.queues[chat_id] = deque()
+        queue.append((send, future))
+        if chat_id not in self.workers:
+            self.workers[chat_id] = asyncio.create_task(self.worker(chat_id, queue))
+        return future
+    
+    async def worker(self, chat_id, queue):
+        try:
+            while queue:
+                send, future = queue.popleft()
+                try:
+                    result = await self.deliver(send)
+                except Exception as e:
+                    logger.warning(f"⚠️ Не удалось отправить сообщение в чат {chat_id}: {e}")
+                    if not future.done():
+                        future.set_exception(e)
+                    continue
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            for send, future in queue:
+                future.cancel()
+            del self.queues[chat_id]
+            del self.workers[chat_id]
+    
+    async def deliver(self, send):
+        for attempt in range(SEND_MAX_ATTEMPTS - 1):
+            try:
+                return await send()
+            except RetryAfter as e:
+                METRICS.inc('send_retry_after')
+                logger.warning(f"⏳ RetryAfter {e.retry_after} сек. при отправке ответа")
+                await asyncio.sleep(float(e.retry_after))
+        return await send()
+    
+    async def flush(self, chat_id=None):
+        """Ждёт доставки всего, что уже в очереди (одного чата или всех)"""
+        if chat_id is None:
+            tasks = list(self.workers.values())
+        else:
+            tasks = [self.workers[chat_id]] if chat_id in self.workers else []
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
 
-def start_health_server():
-    """Запускает HTTP-сервер на PORT=10000 для Render"""
-    port = int(os.environ.get("PORT", 10000))
-    server = HTTPServer(("0.0.0.0", port), HealthCheckHandler)
-    logger.info(f"🌐 HTTP-сервер запущен на порту {port}")
-    server.serve_forever()
+SEND_PIPELINE = SendPipeline()
+
+def queue_reply(message, method, *args, **kwargs):
+    """Ставит message.<method>(...) в очередь чата; например queue_reply(message, 'reply_photo', photo=url)"""
+    return SEND_PIPELINE.submit(message.chat_id, functools.partial(getattr(message, method), *args, **kwargs))
 
-# Запускаем сервер в отдельном потоке (не блокирует бота)
-health_thread = Thread(target=start_health_server, daemon=True)
-health_thread.start()
+def queue_photo(message, source, caption):
+    """Фото через кэш file_id, в общей очереди чата"""
+    return SEND_PIPELINE.submit(message.chat_id, functools.partial(IMAGE_ASSETS.send_photo, message, source, caption=caption))
+
+def queue_album(message, items):
+    return SEND_PIPELINE.submit(message.chat_id, functools.partial(IMAGE_ASSETS.send_album, message, items))
 
 # ====== ОСНОВНЫЕ ОБРАБОТЧИКИ ======
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -716,9 +2149,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     user = update.effective_user
     user_id = user.id
+    ctx = get_update_context(update, context)
     try:
         db.add_user(user_id, user.username, user.first_name)
-        is_premium = db.is_premium(user_id)
+        is_premium = ctx.is_premium
         
         if is_premium:
             premium_status = "✅ **ВАШ ПРЕМИУМ АКТИВЕН!**"
@@ -736,10 +2170,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "• 💎 Премиум подписка\n\n"
             "Выбери услугу из меню ниже 👇"
         )
-        await update.message.reply_text(welcome_text, reply_markup=get_main_keyboard(user_id), parse_mode='Markdown')
+        await update.message.reply_text(welcome_text, reply_markup=get_main_keyboard(user_id, ctx.is_premium), parse_mode='Markdown')
     except Exception as e:
         logger.error(f"❌ Ошибка в команде /start: {e}")
-        await update.message.reply_text("Привет! Добро пожаловать в астрологический бот! 🔮", reply_markup=get_main_keyboard())
+        METRICS.mark_error()
+        await update.message.reply_text("Привет! Добро пожаловать в астрологический бот! 🔮", reply_markup=get_main_keyboard(is_premium=False))
 
 async def handle_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     global TECHNICAL_WORKS
@@ -752,9 +2187,10 @@ async def handle_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
         
     user_id = update.effective_user.id
+    ctx = get_update_context(update, context)
     text = update.message.text
     try:
-        is_premium = db.is_premium(user_id)
+        is_premium = ctx.is_premium
         if text == "🔮 Гороскоп":
             date_str = get_current_date_string()
             await update.message.reply_text("🔮 *Гороскоп на " + date_str + "*\n\nВыбери свой знак зодиака:", reply_markup=get_zodiac_keyboard(), parse_mode='Markdown')
@@ -764,7 +2200,7 @@ async def handle_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if is_premium:
                 await update.message.reply_text("🃏 *Гадание на Таро*\n\nВыбери тип расклада:", reply_markup=get_tarot_keyboard(), parse_mode='Markdown')
             else:
-                await update.message.reply_text("🃏 *Гадание на Таро*\n\n❌ *Требуется премиум подписка!*\n\nОформи премиум для доступа к Таро! 💎", reply_markup=get_main_keyboard(user_id), parse_mode='Markdown')
+                await update.message.reply_text("🃏 *Гадание на Таро*\n\n❌ *Требуется премиум подписка!*\n\nОформи премиум для доступа к Таро! 💎", reply_markup=get_main_keyboard(user_id, ctx.is_premium), parse_mode='Markdown')
         elif text == "💎 Премиум" or text == "⭐ Премиум активен":
             if is_premium:
                 premium_status = "✅ **ВАШ ПРЕМИУМ АКТИВЕН!**"
@@ -791,7 +2227,7 @@ async def handle_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             await update.message.reply_text(premium_text, reply_markup=get_premium_keyboard(), parse_mode='Markdown')
         elif text == "📊 Статистика":
-            user_info = db.get_user(user_id)
+            user_info = ctx.user
             if user_info:
                 if is_premium:
                     premium_badge = "✅ Активен"
@@ -810,7 +2246,7 @@ async def handle_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
             else:
                 stats_text = "📊 *Вы ещё не использовали услуги бота.*"
-            await update.message.reply_text(stats_text, reply_markup=get_main_keyboard(user_id), parse_mode='Markdown')
+            await update.message.reply_text(stats_text, reply_markup=get_main_keyboard(user_id, ctx.is_premium), parse_mode='Markdown')
         elif text == "ℹ️ Помощь":
             help_text = (
                 "ℹ️ *ПОМОЩЬ И ИНФОРМАЦИЯ*\n\n"
@@ -824,12 +2260,13 @@ async def handle_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "• 💎 Премиум подписка\n\n"
                 "*💫 Все предсказания носят развлекательный характер*"
             )
-            await update.message.reply_text(help_text, reply_markup=get_main_keyboard(user_id), parse_mode='Markdown')
+            await update.message.reply_text(help_text, reply_markup=get_main_keyboard(user_id, ctx.is_premium), parse_mode='Markdown')
         elif text == "🔙 Назад в меню":
-            await update.message.reply_text("🔙 Возвращаемся в главное меню:", reply_markup=get_main_keyboard(user_id))
+            await update.message.reply_text("🔙 Возвращаемся в главное меню:", reply_markup=get_main_keyboard(user_id, ctx.is_premium))
     except Exception as e:
         logger.error(f"❌ Ошибка в главном меню: {e}")
-        await update.message.reply_text("Произошла ошибка. Попробуйте еще раз.", reply_markup=get_main_keyboard(user_id))
+        METRICS.mark_error()
+        await update.message.reply_text("Произошла ошибка. Попробуйте еще раз.", reply_markup=get_main_keyboard(user_id, ctx.is_premium))
 
 async def handle_zodiac_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     global TECHNICAL_WORKS
@@ -842,29 +2279,29 @@ async def handle_zodiac_selection(update: Update, context: ContextTypes.DEFAULT_
         return
         
     user_id = update.effective_user.id
+    ctx = get_update_context(update, context)
     text = update.message.text
     if text == "🔙 Назад в меню":
-        await update.message.reply_text("🔙 Возвращаемся в главное меню:", reply_markup=get_main_keyboard(user_id))
+        await update.message.reply_text("🔙 Возвращаемся в главное меню:", reply_markup=get_main_keyboard(user_id, ctx.is_premium))
         return
     zodiac_sign = text
     if zodiac_sign in ZODIAC_IMAGES:
         try:
-            is_premium = db.is_premium(user_id)
+            is_premium = ctx.is_premium
             db.update_counter(user_id, 'horoscope_count')
-            await update.message.reply_text("🔮 *Генерирую гороскоп для " + zodiac_sign + "...* ✨", parse_mode='Markdown')
+            # Ответы уходят через конвейер: пока «Генерирую...» летит в Telegram, гороскоп уже собирается
+            queue_reply(update.message, 'reply_text', "🔮 *Генерирую гороскоп для " + zodiac_sign + "...* ✨", parse_mode='Markdown')
             if is_premium:
                 horoscope = generate_premium_horoscope(zodiac_sign, user_id, personalize=True)
             else:
                 horoscope = generate_basic_horoscope(zodiac_sign, user_id, personalize=False)
-            try:
-                await update.message.reply_photo(photo=ZODIAC_IMAGES[zodiac_sign], caption="✨ " + zodiac_sign + " ✨")
-                await asyncio.sleep(1)
-            except Exception as e:
-                logger.warning(f"Не удалось отправить изображение: {e}")
-            await update.message.reply_text(horoscope, reply_markup=get_main_keyboard(user_id), parse_mode='Markdown')
+            queue_photo(update.message, ZODIAC_IMAGES[zodiac_sign], "✨ " + zodiac_sign + " ✨")
+            # Ждём доставки самого гороскопа: ошибка отправки (например, разметки) уходит в запасной ответ ниже
+            await queue_reply(update.message, 'reply_text', horoscope, reply_markup=get_main_keyboard(user_id, ctx.is_premium), parse_mode='Markdown')
         except Exception as e:
-            logger.error(f"Ошибка генерации гороскопа: {e}")
-            await update.message.reply_text("✨ *Гороскоп для " + zodiac_sign + "* ✨\n\nСегодня звезды благоприятствуют вам!", reply_markup=get_main_keyboard(user_id), parse_mode='Markdown')
+            logger.error(f"Ошибка генерации или отправки гороскопа: {e}")
+            METRICS.mark_error()
+            await queue_reply(update.message, 'reply_text', "✨ *Гороскоп для " + zodiac_sign + "* ✨\n\nСегодня звезды благоприятствуют вам!", reply_markup=get_main_keyboard(user_id, ctx.is_premium), parse_mode='Markdown')
     else:
         await update.message.reply_text("🔮 Выбери знак зодиака из меню!", reply_markup=get_zodiac_keyboard())
 
@@ -879,11 +2316,13 @@ async def handle_numerology_input(update: Update, context: ContextTypes.DEFAULT_
         return
         
     user_id = update.effective_user.id
+    ctx = get_update_context(update, context)
     text = update.message.text
     try:
         date_obj = datetime.strptime(text, '%d.%m.%Y')
         day, month, year = date_obj.day, date_obj.month, date_obj.year
         db.update_counter(user_id, 'num_count')
+        rng = random.Random()
         await update.message.reply_text("🔢 *Анализирую ваши числа...* ✨", parse_mode='Markdown')
         life_path = sum(int(d) for d in str(day + month + year))
         while life_path > 9:
@@ -906,16 +2345,17 @@ async def handle_numerology_input(update: Update, context: ContextTypes.DEFAULT_
             "🔢 *НУМЕРОЛОГИЧЕСКИЙ ПОРТРЕТ*\n\n"
             "*Дата рождения:* " + text + "\n"
             "*Число жизненного пути:* " + str(life_path) + "\n\n"
-            + random.choice(personalities) + "\n\n"
+            + rng.choice(personalities) + "\n\n"
             "*💫 Совет:*\n"
-            + random.choice(advice_options)
+            + rng.choice(advice_options)
         )
-        await update.message.reply_text(numerology_result, reply_markup=get_main_keyboard(user_id), parse_mode='Markdown')
+        await update.message.reply_text(numerology_result, reply_markup=get_main_keyboard(user_id, ctx.is_premium), parse_mode='Markdown')
     except ValueError:
         await update.message.reply_text("❌ *Неверный формат даты!*\n\nИспользуй: `ДД.ММ.ГГГГ`\n*Пример:* `23.09.1992`", parse_mode='Markdown')
     except Exception as e:
         logger.error(f"❌ Ошибка нумерологии: {e}")
-        await update.message.reply_text("Произошла ошибка. Попробуйте еще раз.", reply_markup=get_main_keyboard(user_id))
+        METRICS.mark_error()
+        await update.message.reply_text("Произошла ошибка. Попробуйте еще раз.", reply_markup=get_main_keyboard(user_id, ctx.is_premium))
 
 async def handle_tarot_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     global TECHNICAL_WORKS
@@ -927,9 +2367,10 @@ async def handle_tarot_callback(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
+    ctx = get_update_context(update, context)
     try:
-        if not db.is_premium(user_id):
-            await query.message.reply_text("❌ *Требуется премиум подписка!*", reply_markup=get_main_keyboard(user_id), parse_mode='Markdown')
+        if not ctx.is_premium:
+            await query.message.reply_text("❌ *Требуется премиум подписка!*", reply_markup=get_main_keyboard(user_id, ctx.is_premium), parse_mode='Markdown')
             return
         spread_type = query.data
         db.update_counter(user_id, 'tarot_count')
@@ -939,70 +2380,69 @@ async def handle_tarot_callback(update: Update, context: ContextTypes.DEFAULT_TY
             await handle_tarot_three(update, context, user_id)
     except Exception as e:
         logger.error(f"❌ Ошибка в обработчике Таро: {e}")
-        await query.message.reply_text("Произошла ошибка. Попробуйте еще раз.", reply_markup=get_main_keyboard(user_id))
+        METRICS.mark_error()
+        await query.message.reply_text("Произошла ошибка. Попробуйте еще раз.", reply_markup=get_main_keyboard(user_id, ctx.is_premium))
 
 async def handle_tarot_daily(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int):
     query = update.callback_query
-    card_name = random.choice(list(TAROT_IMAGES.keys()))
+    rng = random.Random()
+    ctx = get_update_context(update, context)
+    card_name = rng.choice(list(TAROT_IMAGES.keys()))
     card_image = TAROT_IMAGES[card_name]
-    is_reversed = random.choice([True, False])
-    try:
-        caption = "🃏 *" + card_name + "* (" + ("перевернутая" if is_reversed else "прямая") + ")"
-        await query.message.reply_photo(photo=card_image, caption=caption)
-    except Exception as img_error:
-        logger.warning(f"⚠️ Не удалось отправить изображение карты: {img_error}")
+    is_reversed = rng.choice([True, False])
+    caption = "🃏 *" + card_name + "* (" + ("перевернутая" if is_reversed else "прямая") + ")"
+    queue_photo(query.message, card_image, caption)
     
     tarot_text = (
         "🃏 *КАРТА ДНЯ*\n\n"
         "*Выпала карта:*\n"
         "**" + card_name + "** (" + ("перевернутая" if is_reversed else "прямая") + ")\n\n"
         "*📖 Значение:*\n"
-        + random.choice([
+        + rng.choice([
             "Эта карта указывает на важность вашего внутреннего голоса.",
             "Сегодняшний день несет ключевое сообщение для вашего развития.",
             "Карта предлагает обратить внимание на определенную сферу жизни."
         ]) + "\n\n"
         "*🎯 Совет карты:*\n"
-        + random.choice([
+        + rng.choice([
             "Доверьтесь вселенной и следуйте за своим любопытством.",
             "Используйте все доступные вам ресурсы для достижения целей.",
             "Прислушивайтесь к своему внутреннему голосу и подсознанию."
         ])
     )
-    await query.message.reply_text(tarot_text, reply_markup=get_main_keyboard(user_id), parse_mode='Markdown')
+    # Ошибка доставки толкования попадёт в обработчик handle_tarot_callback и его запасной ответ
+    await queue_reply(query.message, 'reply_text', tarot_text, reply_markup=get_main_keyboard(user_id, ctx.is_premium), parse_mode='Markdown')
 
 async def handle_tarot_three(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int):
     query = update.callback_query
-    cards = random.sample(list(TAROT_IMAGES.items()), 3)
-    for card_name, card_image in cards:
-        try:
-            await query.message.reply_photo(photo=card_image, caption="🃏 *" + card_name + "*")
-            await asyncio.sleep(0.5)
-        except Exception as img_error:
-            logger.warning(f"⚠️ Не удалось отправить изображение: {img_error}")
+    rng = random.Random()
+    ctx = get_update_context(update, context)
+    cards = rng.sample(list(TAROT_IMAGES.items()), 3)
+    # Три карты — один альбом (sendMediaGroup) вместо трёх фото с паузами
+    queue_album(query.message, [(card_image, "🃏 *" + card_name + "*") for card_name, card_image in cards])
     
     tarot_text = (
         "🃏 *РАСКЛАД НА 3 КАРТЫ*\n\n"
         "*Прошлое (влияние на текущую ситуацию):*\n"
         "**" + cards[0][0] + "**\n"
-        + random.choice([
+        + rng.choice([
             "Ваш прошлый опыт подготовил вас к текущей ситуации.",
             "Прошлые события продолжают влиять на вашу жизнь."
         ]) + "\n\n"
         "*Настоящее (текущая ситуация):*\n"
         "**" + cards[1][0] + "**\n"
-        + random.choice([
+        + rng.choice([
             "Текущая ситуация требует вашего внимания и осознанности.",
             "Карта указывает на ключевые энергии, действующие в вашей жизни сейчас."
         ]) + "\n\n"
         "*Будущее (возможное развитие):*\n"
         "**" + cards[2][0] + "**\n"
-        + random.choice([
+        + rng.choice([
             "Будущее развитие зависит от ваших текущих решений.",
             "Карта показывает потенциальный результат ваших действий."
         ])
     )
-    await query.message.reply_text(tarot_text, reply_markup=get_main_keyboard(user_id), parse_mode='Markdown')
+    await queue_reply(query.message, 'reply_text', tarot_text, reply_markup=get_main_keyboard(user_id, ctx.is_premium), parse_mode='Markdown')
 
 async def handle_premium_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     global TECHNICAL_WORKS
@@ -1014,6 +2454,7 @@ async def handle_premium_callback(update: Update, context: ContextTypes.DEFAULT_
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
+    ctx = get_update_context(update, context)
     try:
         tariff_map = {
             "premium_1": {"days": 30, "price": 29900},
@@ -1047,7 +2488,8 @@ async def handle_premium_callback(update: Update, context: ContextTypes.DEFAULT_
         logger.info(f"💳 Инвойс отправлен: пользователь {user_id}, тариф {tariff['days']} дней")
     except Exception as e:
         logger.error(f"❌ Ошибка отправки инвойса: {e}")
-        await query.message.reply_text("❌ Ошибка создания счета на оплату. Попробуйте позже.", reply_markup=get_main_keyboard(user_id))
+        METRICS.mark_error()
+        await query.message.reply_text("❌ Ошибка создания счета на оплату. Попробуйте позже.", reply_markup=get_main_keyboard(user_id, ctx.is_premium))
 
 async def pre_checkout_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.pre_checkout_query
@@ -1057,6 +2499,7 @@ async def pre_checkout_handler(update: Update, context: ContextTypes.DEFAULT_TYP
 async def successful_payment_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     payment = update.message.successful_payment
     user_id = update.effective_user.id
+    ctx = get_update_context(update, context)
     try:
         if payment.invoice_payload:
             payload_parts = payment.invoice_payload.split('_')
@@ -1065,6 +2508,7 @@ async def successful_payment_handler(update: Update, context: ContextTypes.DEFAU
                 tariff_days = int(payload_parts[1])
                 db.update_payment_status(payment_id, 'succeeded')
                 premium_until = db.add_premium(user_id, tariff_days)
+                ctx.is_premium = True
                 success_text = (
                     "💎 *ПОЗДРАВЛЯЕМ! ПРЕМИУМ АКТИВИРОВАН!* 🎉\n\n"
                     "✅ *Оплата прошла успешно!*\n"
@@ -1073,26 +2517,385 @@ async def successful_payment_handler(update: Update, context: ContextTypes.DEFAU
                     "📅 *Премиум активен до:* " + premium_until.split()[0] + "\n\n"
                     "Теперь тебе доступны ВСЕ функции бота! ✨"
                 )
-                await update.message.reply_text(success_text, reply_markup=get_main_keyboard(user_id), parse_mode='Markdown')
+                await update.message.reply_text(success_text, reply_markup=get_main_keyboard(user_id, ctx.is_premium), parse_mode='Markdown')
                 logger.info(f"✅ Премиум активирован: пользователь {user_id}, {tariff_days} дней")
                 return
-        await update.message.reply_text("✅ Оплата прошла успешно! Премиум активирован.", reply_markup=get_main_keyboard(user_id))
+        await update.message.reply_text("✅ Оплата прошла успешно! Премиум активирован.", reply_markup=get_main_keyboard(user_id, ctx.is_premium))
     except Exception as e:
         logger.error(f"❌ Ошибка обработки платежа: {e}")
-        await update.message.reply_text("✅ Оплата прошла успешно! Если премиум не активировался, обратитесь в поддержку.", reply_markup=get_main_keyboard(user_id))
+        METRICS.mark_error()
+        await update.message.reply_text("✅ Оплата прошла успешно! Если премиум не активировался, обратитесь в поддержку.", reply_markup=get_main_keyboard(user_id, ctx.is_premium))
 
 async def handle_back_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
+    ctx = get_update_context(update, context)
     try:
-        await query.edit_message_text("🔙 Возвращаемся в главное меню...", reply_markup=get_main_keyboard(user_id))
+        await query.edit_message_text("🔙 Возвращаемся в главное меню...", reply_markup=get_main_keyboard(user_id, ctx.is_premium))
     except Exception as e:
         logger.warning(f"⚠️ Не удалось отредактировать сообщение: {e}")
         try:
-            await query.message.reply_text("🔙 Возвращаемся в главное меню:", reply_markup=get_main_keyboard(user_id))
+            await query.message.reply_text("🔙 Возвращаемся в главное меню:", reply_markup=get_main_keyboard(user_id, ctx.is_premium))
         except Exception as e2:
             logger.error(f"❌ Ошибка возврата: {e2}")
+            METRICS.mark_error()
+
+# ====== РАССЫЛКИ ======
+# Лимиты Telegram: ~30 сообщений в секунду на бота и не чаще раза в секунду в один чат
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 28))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", 16))
+BROADCAST_PROGRESS_INTERVAL = int(os.getenv("BROADCAST_PROGRESS_INTERVAL", 5))
+BROADCAST_MAX_ATTEMPTS = 3
+CHAT_SEND_INTERVAL = 1.0
+
+class TokenBucket:
+    """Глобальный лимит отправки: rate токенов в секунду, запас не больше capacity"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def pause(self, seconds):
+        """После RetryAfter останавливает отправку для всех воркеров сразу"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class ChatRateLimiter:
+    """Не чаще одного сообщения в CHAT_SEND_INTERVAL секунд в один чат"""
+
+    def __init__(self, interval=CHAT_SEND_INTERVAL):
+        self.interval = interval
+        self.next_send = {}
+
+    async def wait(self, chat_id):
+        now = time.monotonic()
+        send_at = max(now, self.next_send.get(chat_id, 0.0))
+        self.next_send[chat_id] = send_at + self.interval
+        if send_at > now:
+            await asyncio.sleep(send_at - now)
+        # Старые записи не нужны: чат уже свободен
+        if len(self.next_send) > 10000:
+            self.next_send = {cid: t for cid, t in self.next_send.items() if t > now}
+
+# Общие на процесс: параллельные рассылки делят один лимит
+SEND_BUCKET = TokenBucket(BROADCAST_RATE)
+CHAT_LIMITER = ChatRateLimiter()
+ACTIVE_BROADCASTS = []
+
+# ---- Задания рассылки на диске ----
+BROADCASTS_DIR = os.getenv("BROADCASTS_DIR", "data/broadcasts")
+# Снапшот задания пишется после каждых BROADCAST_CHECKPOINT_BATCH результатов (и при обновлении прогресса)
+BROADCAST_CHECKPOINT_BATCH = int(os.getenv("BROADCAST_CHECKPOINT_BATCH", 200))
+BROADCAST_KEEP_FINISHED = int(os.getenv("BROADCAST_KEEP_FINISHED", 10))
+RECIPIENT_STATUSES = ('pending', 'sent', 'blocked', 'failed')
+
+class BroadcastJob:
+    """
+    Задание рассылки со статусом каждого получателя (pending/sent/blocked/failed).
+    Хранится снапшотом data/broadcasts/<id>.json; незавершённые задания продолжаются после рестарта.
+    """
+    
+    def __init__(self, job_id, text, recipients, status='running', created=None,
+                 status_chat_id=None, status_message_id=None):
+        self.id = job_id
+        self.text = text
+        self.recipients = recipients
+        self.status = status
+        self.created = created or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.status_chat_id = status_chat_id
+        self.status_message_id = status_message_id
+        self.counts = {key: 0 for key in RECIPIENT_STATUSES}
+        for recipient_status in recipients.values():
+            self.counts[recipient_status] += 1
+        self.unsaved = 0
+    
+    @classmethod
+    def create(cls, text, user_ids, status_chat_id=None, status_message_id=None):
+        job_id = datetime.now().strftime('%Y%m%d-%H%M%S') + '-' + uuid.uuid4().hex[:6]
+        job = cls(job_id, text, dict.fromkeys(user_ids, 'pending'),
+                  status_chat_id=status_chat_id, status_message_id=status_message_id)
+        job.save()
+        return job
+    
+    @classmethod
+    def load(cls, filename):
+        for path in snapshot_candidates(filename, generations=1):
+            if not os.path.exists(path):
+                continue
+            try:
+                data = read_snapshot(path)
+            except Exception as e:
+                logger.error(f"Ошибка загрузки рассылки из {path}: {e}")
+                continue
+            return cls(data['id'], data['text'], data['recipients'], data['status'], data['created'],
+                       data.get('status_chat_id'), data.get('status_message_id'))
+        return None
+    
+    @property
+    def filename(self):
+        return os.path.join(BROADCASTS_DIR, self.id + '.json')
+    
+    def pending_ids(self):
+        return [uid for uid, recipient_status in self.recipients.items() if recipient_status == 'pending']
+    
+    def mark(self, user_id, recipient_status):
+        self.counts[self.recipients[user_id]] -= 1
+        self.recipients[user_id] = recipient_status
+        self.counts[recipient_status] += 1
+        self.unsaved += 1
+    
+    def dump(self):
+        payload = json.dumps({
+            'id': self.id,
+            'text': self.text,
+            'status': self.status,
+            'created': self.created,
+            'status_chat_id': self.status_chat_id,
+            'status_message_id': self.status_message_id,
+            'recipients': self.recipients,
+        }, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        self.unsaved = 0
+        return payload
+    
+    def save(self):
+        os.makedirs(BROADCASTS_DIR, exist_ok=True)
+        write_snapshot(self.filename, self.dump(), generations=1)
+
+def load_unfinished_broadcasts():
+    if not os.path.isdir(BROADCASTS_DIR):
+        return []
+    jobs = []
+    for name in sorted(os.listdir(BROADCASTS_DIR)):
+        if name.endswith('.json'):
+            job = BroadcastJob.load(os.path.join(BROADCASTS_DIR, name))
+            if job is not None and job.status == 'running':
+                jobs.append(job)
+    return jobs
+
+def prune_finished_broadcasts(keep=BROADCAST_KEEP_FINISHED):
+    """Оставляет на диске только keep последних завершённых рассылок"""
+    if not os.path.isdir(BROADCASTS_DIR):
+        return
+    running = {job.id for job in ACTIVE_BROADCASTS}
+    finished = sorted(name[:-5] for name in os.listdir(BROADCASTS_DIR)
+                      if name.endswith('.json') and name[:-5] not in running)
+    for job_id in finished[:-keep] if keep else finished:
+        job = BroadcastJob.load(os.path.join(BROADCASTS_DIR, job_id + '.json'))
+        if job is None or job.status == 'running':
+            continue
+        for path in snapshot_candidates(job.filename, generations=1):
+            if os.path.exists(path):
+                os.remove(path)
+
+class Broadcast:
+    """Рассылка задания пулом воркеров с глобальным и початовым лимитом и учётом RetryAfter"""
+
+    def __init__(self, bot, job, workers=BROADCAST_WORKERS,
+                 bucket=SEND_BUCKET, chat_limiter=CHAT_LIMITER):
+        self.bot = bot
+        self.job = job
+        self.user_ids = job.pending_ids()
+        self.workers = max(1, min(workers, len(self.user_ids)))
+        self.bucket = bucket
+        self.chat_limiter = chat_limiter
+        self.retries = 0
+        self.delivered_now = 0
+        self.started = None
+        self.finished = None
+        self.checkpoint_lock = asyncio.Lock()
+        self.checkpoint_task = None
+
+    @property
+    def id(self):
+        return self.job.id
+
+    def get_progress(self):
+        counts = self.job.counts
+        elapsed = (self.finished or time.monotonic()) - (self.started or time.monotonic())
+        return {
+            'total': len(self.job.recipients),
+            'done': len(self.job.recipients) - counts['pending'],
+            'sent': counts['sent'],
+            'blocked': counts['blocked'],
+            'failed': counts['failed'],
+            'retries': self.retries,
+            'rate': round(self.delivered_now / elapsed, 1) if elapsed > 0 else 0.0,
+        }
+
+    def format_progress(self):
+        progress = self.get_progress()
+        title = "✅ Рассылка завершена" if self.finished else "📤 Идёт рассылка"
+        return (
+            title + ": " + str(progress['done']) + "/" + str(progress['total']) + "\n"
+            "📨 Доставлено: " + str(progress['sent']) + "\n"
+            "🚫 Заблокировали бота: " + str(progress['blocked']) + "\n"
+            "❌ Ошибки: " + str(progress['failed']) + "\n"
+            "⚡ Скорость: " + str(progress['rate']) + " сообщ./сек"
+        )
+
+    async def checkpoint(self):
+        async with self.checkpoint_lock:
+            if not self.job.unsaved and self.job.status == 'running':
+                return
+            os.makedirs(BROADCASTS_DIR, exist_ok=True)
+            payload = self.job.dump()
+            await asyncio.get_running_loop().run_in_executor(
+                None, write_snapshot, self.job.filename, payload, 1
+            )
+
+    def record(self, chat_id, recipient_status):
+        self.job.mark(chat_id, recipient_status)
+        self.delivered_now += 1
+        if self.job.unsaved >= BROADCAST_CHECKPOINT_BATCH and (self.checkpoint_task is None or self.checkpoint_task.done()):
+            self.checkpoint_task = asyncio.create_task(self.checkpoint())
+
+    async def deliver(self, chat_id):
+        # RetryAfter — просьба Telegram притормозить, а не ошибка: ждём и не тратим на неё попытку
+        attempt = 0
+        while attempt < BROADCAST_MAX_ATTEMPTS:
+            await self.chat_limiter.wait(chat_id)
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(
+                    chat_id=int(chat_id),
+                    text="📢 *РАССЫЛКА*\n\n" + self.job.text,
+                    parse_mode='Markdown'
+                )
+                self.record(chat_id, 'sent')
+                return
+            except RetryAfter as e:
+                self.retries += 1
+                logger.warning(f"⏳ RetryAfter {e.retry_after} сек., рассылка приостановлена")
+                self.bucket.pause(float(e.retry_after))
+            except Forbidden:
+                # Заблокировал бота или удалил аккаунт — следующие рассылки его пропустят
+                db.set_user_active(chat_id, False)
+                self.record(chat_id, 'blocked')
+                return
+            except (TimedOut, NetworkError) as e:
+                self.retries += 1
+                logger.warning(f"Сетевая ошибка рассылки {chat_id} (попытка {attempt + 1}): {e}")
+                await asyncio.sleep(2 ** attempt)
+                attempt += 1
+            except TelegramError as e:
+                self.record(chat_id, 'failed')
+                logger.warning(f"Не удалось отправить рассылку {chat_id}: {e}")
+                return
+        self.record(chat_id, 'failed')
+        logger.warning(f"Рассылка {chat_id}: исчерпаны попытки")
+
+    async def worker(self, queue):
+        while True:
+            chat_id = await queue.get()
+            try:
+                await self.deliver(chat_id)
+            except Exception as e:
+                self.record(chat_id, 'failed')
+                logger.error(f"❌ Ошибка рассылки {chat_id}: {e}")
+            finally:
+                queue.task_done()
+
+    async def run(self):
+        queue = asyncio.Queue()
+        for uid in self.user_ids:
+            queue.put_nowait(uid)
+        self.started = time.monotonic()
+        workers = [asyncio.create_task(self.worker(queue)) for _ in range(self.workers)]
+        try:
+            await queue.join()
+            self.job.status = 'done'
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            self.finished = time.monotonic()
+        return self.get_progress()
+
+    async def report_progress(self, last_text=None):
+        text = self.format_progress()
+        if self.job.status_message_id is None or text == last_text:
+            return last_text
+        try:
+            await self.bot.edit_message_text(
+                text, chat_id=self.job.status_chat_id, message_id=self.job.status_message_id
+            )
+        except TelegramError as e:
+            logger.warning(f"Не удалось обновить прогресс рассылки: {e}")
+        return text
+
+    async def run_with_progress(self):
+        """
+        Выполняет рассылку, раз в BROADCAST_PROGRESS_INTERVAL секунд обновляя сообщение админа
+        и сохраняя задание. При отмене (остановка бота) задание остаётся running и продолжится при старте.
+        """
+        ACTIVE_BROADCASTS.append(self)
+        run_task = asyncio.create_task(self.run())
+        last_text = None
+        try:
+            while not run_task.done():
+                await asyncio.wait({run_task}, timeout=BROADCAST_PROGRESS_INTERVAL)
+                await self.checkpoint()
+                last_text = await self.report_progress(last_text)
+            progress = run_task.result()
+            logger.info(f"📢 Рассылка {self.id} завершена: {progress}")
+            return progress
+        finally:
+            run_task.cancel()
+            ACTIVE_BROADCASTS.remove(self)
+            await self.checkpoint()
+
+def spawn_broadcast(bot, job):
+    broadcast = Broadcast(bot, job)
+    task = asyncio.create_task(broadcast.run_with_progress())
+    # Задачи рассылок отменяются в post_stop вместе с остальными фоновыми задачами
+    BACKGROUND_TASKS.append(task)
+    task.add_done_callback(forget_background_task)
+    return broadcast
+
+def forget_background_task(task):
+    if task in BACKGROUND_TASKS:
+        BACKGROUND_TASKS.remove(task)
+
+async def start_broadcast(context: ContextTypes.DEFAULT_TYPE, message, text):
+    """Сохраняет задание рассылки и запускает его фоновой задачей"""
+    users = db.get_active_user_ids()
+    status_message = await message.reply_text("📤 Рассылка запущена: 0/" + str(len(users)))
+    job = BroadcastJob.create(text, users, status_message.chat_id, status_message.message_id)
+    prune_finished_broadcasts()
+    return spawn_broadcast(context.bot, job)
+
+def resume_broadcasts(bot):
+    """Продолжает рассылки, прерванные остановкой бота; уже доставленным повторно не шлём"""
+    for job in load_unfinished_broadcasts():
+        logger.info(f"🔄 Продолжаем рассылку {job.id}: осталось {job.counts['pending']} из {len(job.recipients)}")
+        spawn_broadcast(bot, job)
+
+async def handle_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Telegram сообщает о блокировке/разблокировке бота — держим отметку неактивности в актуальном виде"""
+    member = update.my_chat_member
+    if member.chat.type != 'private':
+        return
+    if member.new_chat_member.status == ChatMember.BANNED:
+        db.set_user_active(member.from_user.id, False)
+    elif member.new_chat_member.status == ChatMember.MEMBER:
+        db.set_user_active(member.from_user.id, True)
 
 # ====== АДМИНСКИЕ ФУНКЦИИ ======
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1103,6 +2906,8 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     stats = db.get_all_users_stats()
+    flush_stats = db.get_flush_stats()
+    cache_stats = HOROSCOPE_CACHE.get_stats()
     
     if TECHNICAL_WORKS:
         tech_status = "🔴 ВКЛЮЧЕНЫ"
@@ -1116,29 +2921,53 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "💎 Премиум: " + str(stats['premium_users']) + "\n"
         "💰 Платежей: " + str(stats['total_payments']) + "\n"
         "✅ Успешных: " + str(stats['successful_payments']) + "\n\n"
+        "*Запись БД:*\n"
+        "💾 Сбросов: " + str(flush_stats['flushes']) + " (в среднем " + f"{flush_stats['avg_ms']:.1f}" + " мс)\n"
+        "🧮 Объединено записей: " + f"{flush_stats['coalesced_ratio'] * 100:.0f}" + "%\n\n"
+        "*Кэш гороскопов:*\n"
+        "🗂️ Попаданий: " + f"{cache_stats['hit_ratio'] * 100:.0f}" + "% (" + str(cache_stats['hits']) + " / " + str(cache_stats['misses']) + " промахов)\n\n"
         "*Технические работы:*\n"
         + tech_status + "\n\n"
         "*Команды:*\n"
         "/send <текст> - рассылка всем\n"
         "/tech_on - включить тех. работы\n"
         "/tech_off - выключить тех. работы\n"
-        "/stats - обновить статистику"
+        "/stats - обновить статистику\n"
+        "/stats\\_verify - сверить статистику с полным пересчётом\n"
+        "/metrics - нагрузка и задержки по часам и дням"
     )
 
-    keyboard = [
-        [InlineKeyboardButton("📤 Рассылка", callback_data="admin_broadcast")],
-        [InlineKeyboardButton("🔧 Тех. работы: ВКЛ", callback_data="admin_tech_on")],
-        [InlineKeyboardButton("✅ Тех. работы: ВЫКЛ", callback_data="admin_tech_off")],
-        [InlineKeyboardButton("📊 Статистика", callback_data="admin_stats")],
-        [InlineKeyboardButton("👑 Управление премиумом", callback_data="admin_premium")]
-    ]
-    
     await update.message.reply_text(
         admin_text,
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=KEYBOARDS['admin'],
         parse_mode='Markdown'
     )
 
+def format_metrics_report():
+    """Текст для админа: обработчики за час, ряд по часам и по дням (без Markdown — в именах есть '_')"""
+    lines = ["📈 МЕТРИКИ", "", "⏱ Обработчики за последний час:"]
+    recent = sorted(METRICS.recent(60).items(), key=lambda item: -item[1]['count'])
+    for handler, stats in recent[:10]:
+        lines.append(
+            "• " + handler + ": " + str(stats['count']) + " запр., p95 " + f"{stats['p95_ms']:.0f}" + " мс"
+            + (", ошибок " + str(stats['errors']) if stats['errors'] else "")
+        )
+    if not recent:
+        lines.append("• запросов не было")
+    lines += ["", "🕐 По часам (последние 12):"]
+    for point in METRICS.series('hour', 12):
+        lines.append(
+            datetime.fromtimestamp(point['t']).strftime('%d.%m %H:00') + " — " + str(point['count'])
+            + " запр., p95 " + f"{point['p95_ms']:.0f}" + " мс"
+        )
+    lines += ["", "📅 По дням (последние 7):"]
+    for point in METRICS.series('day', 7):
+        lines.append(
+            datetime.fromtimestamp(point['t']).strftime('%d.%m') + " — " + str(point['count'])
+            + " запр., p95 " + f"{point['p95_ms']:.0f}" + " мс"
+        )
+    return "\n".join(lines)
+
 async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -1172,6 +3001,9 @@ async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TY
         )
         await query.message.reply_text(stats_text, parse_mode='Markdown')
         
+    elif query.data == "admin_metrics":
+        await query.message.reply_text(format_metrics_report())
+        
     elif query.data == "admin_premium":
         await query.message.reply_text(
             "👑 *УПРАВЛЕНИЕ ПРЕМИУМОМ*\n\n"
@@ -1220,7 +3052,7 @@ async def handle_admin_commands(update: Update, context: ContextTypes.DEFAULT_TY
             await update.message.reply_text("❌ Неверное количество параметров")
             
     elif text == '/premium_list':
-        premium_users = list(db.data.get('premium', {}).keys())
+        premium_users = db.get_premium_user_ids()
         if premium_users:
             users_list = "\n".join(["• " + uid for uid in premium_users[:20]])
             response = "👑 *ПРЕМИУМ ПОЛЬЗОВАТЕЛИ* (" + str(len(premium_users)) + "):\n\n" + users_list
@@ -1228,22 +3060,24 @@ async def handle_admin_commands(update: Update, context: ContextTypes.DEFAULT_TY
         else:
             await update.message.reply_text("👑 Нет премиум пользователей")
             
+    elif text == '/metrics':
+        await update.message.reply_text(format_metrics_report())
+        
+    elif text == '/stats_verify':
+        # Полный пересчёт — в пуле потоков, чтобы не стопорить обработку апдейтов;
+        # исправление — уже здесь, в цикле событий, поверх изменений, сделанных за время пересчёта
+        drift = await asyncio.get_running_loop().run_in_executor(None, db.verify_stats)
+        if drift:
+            db.repair_stats(drift)
+            lines = ["• " + key + ": " + str(stored) + " → " + str(actual) for key, (stored, actual) in drift.items()]
+            await update.message.reply_text("⚠️ Статистика расходилась и исправлена:\n\n" + "\n".join(lines))
+        else:
+            await update.message.reply_text("✅ Статистика совпадает с полным пересчётом")
+            
     elif text.startswith('/send'):
         broadcast_text = text[5:].strip()
         if broadcast_text:
-            users = list(db.data['users'].keys())
-            success_count = 0
-            for uid in users:
-                try:
-                    await context.bot.send_message(
-                        chat_id=int(uid),
-                        text="📢 *РАССЫЛКА*\n\n" + broadcast_text,
-                        parse_mode='Markdown'
-                    )
-                    success_count += 1
-                except Exception as e:
-                    logger.warning(f"Не удалось отправить рассылку {uid}: {e}")
-            await update.message.reply_text("✅ Рассылка отправлена " + str(success_count) + " из " + str(len(users)) + " пользователей")
+            await start_broadcast(context, update.message, broadcast_text)
         else:
             await update.message.reply_text("❌ Пустой текст рассылки")
 
@@ -1255,23 +3089,7 @@ async def handle_broadcast_text(update: Update, context: ContextTypes.DEFAULT_TY
         broadcast_text = update.message.text
         context.user_data['awaiting_broadcast'] = False
         
-        users = list(db.data['users'].keys())
-        success_count = 0
-        
-        for uid in users:
-            try:
-                await context.bot.send_message(
-                    chat_id=int(uid),
-                    text="📢 *РАССЫЛКА*\n\n" + broadcast_text,
-                    parse_mode='Markdown'
-                )
-                success_count += 1
-            except Exception as e:
-                logger.warning(f"Не удалось отправить рассылку {uid}: {e}")
-        
-        await update.message.reply_text(
-            "✅ Рассылка отправлена " + str(success_count) + " из " + str(len(users)) + " пользователей"
-        )
+        await start_broadcast(context, update.message, broadcast_text)
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     error = context.error
@@ -1280,53 +3098,285 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             if update and update.effective_user:
                 error_text = "😔 *Произошла ошибка*\n\nПопробуйте еще раз или вернитесь в главное меню."
-                await context.bot.send_message(chat_id=update.effective_user.id, text=error_text, parse_mode='Markdown', reply_markup=get_main_keyboard(update.effective_user.id))
+                await context.bot.send_message(chat_id=update.effective_user.id, text=error_text, parse_mode='Markdown', reply_markup=get_main_keyboard(update.effective_user.id, get_update_context(update, context).is_premium))
         except Exception as send_error:
             logger.error(f"❌ Не удалось отправить сообщение об ошибке: {send_error}")
 
 # ====== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ (клавиатуры) ======
-def get_main_keyboard(user_id=None):
-    is_premium = db.is_premium(user_id) if user_id else False
-    if is_premium:
-        premium_btn = "⭐ Премиум активен"
-    else:
-        premium_btn = "💎 Премиум"
+def build_keyboards():
+    """
+    Все клавиатуры строятся один раз при старте. Объекты разметки PTB неизменяемы,
+    поэтому одни и те же экземпляры безопасно отдавать в каждый ответ.
+    """
+    def main_keyboard(premium_btn):
+        return ReplyKeyboardMarkup([
+            ["🔮 Гороскоп", "🔢 Нумерология"],
+            ["🃏 Таро", premium_btn],
+            ["📊 Статистика", "ℹ️ Помощь"]
+        ], resize_keyboard=True)
     
-    keyboard = [
-        ["🔮 Гороскоп", "🔢 Нумерология"],
-        ["🃏 Таро", premium_btn],
-        ["📊 Статистика", "ℹ️ Помощь"]
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    return {
+        'main': main_keyboard("💎 Премиум"),
+        'main_premium': main_keyboard("⭐ Премиум активен"),
+        'zodiac': ReplyKeyboardMarkup([
+            ["♈️ Овен", "♉️ Телец", "♊️ Близнецы"],
+            ["♋️ Рак", "♌️ Лев", "♍️ Дева"],
+            ["♎️ Весы", "♏️ Скорпион", "♐️ Стрелец"],
+            ["♑️ Козерог", "♒️ Водолей", "♓️ Рыбы"],
+            ["🔙 Назад в меню"]
+        ], resize_keyboard=True),
+        'premium': InlineKeyboardMarkup([
+            [InlineKeyboardButton("💎 1 месяц - 299₽", callback_data="premium_1")],
+            [InlineKeyboardButton("💎 3 месяца - 799₽", callback_data="premium_3")],
+            [InlineKeyboardButton("💎 12 месяцев - 1999₽", callback_data="premium_12")],
+            [InlineKeyboardButton("🔙 Назад", callback_data="back_main")]
+        ]),
+        'tarot': InlineKeyboardMarkup([
+            [InlineKeyboardButton("🃏 Карта дня", callback_data="tarot_daily")],
+            [InlineKeyboardButton("🃏 3 карты", callback_data="tarot_three")],
+            [InlineKeyboardButton("🔙 Назад", callback_data="back_main")]
+        ]),
+        'admin': InlineKeyboardMarkup([
+            [InlineKeyboardButton("📤 Рассылка", callback_data="admin_broadcast")],
+            [InlineKeyboardButton("🔧 Тех. работы: ВКЛ", callback_data="admin_tech_on")],
+            [InlineKeyboardButton("✅ Тех. работы: ВЫКЛ", callback_data="admin_tech_off")],
+            [InlineKeyboardButton("📊 Статистика", callback_data="admin_stats")],
+            [InlineKeyboardButton("📈 Метрики", callback_data="admin_metrics")],
+            [InlineKeyboardButton("👑 Управление премиумом", callback_data="admin_premium")]
+        ])
+    }
+
+KEYBOARDS = build_keyboards()
+
+def get_main_keyboard(user_id=None, is_premium=None):
+    if is_premium is None:
+        is_premium = db.is_premium(user_id) if user_id else False
+    return KEYBOARDS['main_premium'] if is_premium else KEYBOARDS['main']
 
 def get_zodiac_keyboard():
-    keyboard = [
-        ["♈️ Овен", "♉️ Телец", "♊️ Близнецы"],
-        ["♋️ Рак", "♌️ Лев", "♍️ Дева"],
-        ["♎️ Весы", "♏️ Скорпион", "♐️ Стрелец"],
-        ["♑️ Козерог", "♒️ Водолей", "♓️ Рыбы"],
-        ["🔙 Назад в меню"]
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    return KEYBOARDS['zodiac']
 
 def get_premium_keyboard():
-    keyboard = [
-        [InlineKeyboardButton("💎 1 месяц - 299₽", callback_data="premium_1")],
-        [InlineKeyboardButton("💎 3 месяца - 799₽", callback_data="premium_3")],
-        [InlineKeyboardButton("💎 12 месяцев - 1999₽", callback_data="premium_12")],
-        [InlineKeyboardButton("🔙 Назад", callback_data="back_main")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return KEYBOARDS['premium']
 
 def get_tarot_keyboard():
-    keyboard = [
-        [InlineKeyboardButton("🃏 Карта дня", callback_data="tarot_daily")],
-        [InlineKeyboardButton("🃏 3 карты", callback_data="tarot_three")],
-        [InlineKeyboardButton("🔙 Назад", callback_data="back_main")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return KEYBOARDS['tarot']
+
+# ====== ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА АПДЕЙТОВ ======
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Апдейты разных чатов обрабатываются параллельно (не больше max_running сразу),
+    апдейты одного чата — строго по очереди, в порядке поступления.
+    Сначала апдейт встаёт в очередь своего чата и только потом берёт общий слот: пользователь,
+    приславший пачку сообщений, ждёт сам себя и не занимает слоты остальных.
+    Семафор BaseUpdateProcessor (max_backlog) ограничивает лишь число принятых апдейтов —
+    ожидающих в очередях чатов и выполняющихся; сам апдейт ждёт своего завершения, чтобы
+    Application.stop() по-прежнему дожидался обработки всего принятого.
+    Обработчики дожидаются доставки своих ответов, поэтому следующий апдейт чата
+    не обгонит сообщения предыдущего.
+    """
+    
+    def __init__(self, max_running, max_backlog=UPDATE_BACKLOG_LIMIT):
+        super().__init__(max(max_backlog, max_running))
+        self.slots = asyncio.Semaphore(max_running)
+        self.chats = {}  # ключ чата → [asyncio.Lock, апдейтов в очереди чата]
+        self.waiting_chat = 0
+        self.waiting_slot = 0
+        self.running = 0
+        self.max_chat_backlog = 0
+    
+    @staticmethod
+    def chat_key(update):
+        if isinstance(update, Update):
+            if update.effective_chat is not None:
+                return update.effective_chat.id
+            if update.effective_user is not None:
+                return update.effective_user.id
+        return None
+    
+    def publish(self):
+        METRICS.set_gauge('updates_waiting_chat', self.waiting_chat)
+        METRICS.set_gauge('updates_waiting_slot', self.waiting_slot)
+        METRICS.set_gauge('updates_running', self.running)
+        METRICS.set_gauge('updates_max_chat_backlog', self.max_chat_backlog)
+    
+    async def do_process_update(self, update, coroutine):
+        key = self.chat_key(update)
+        if key is None:
+            await self.run(coroutine)
+            return
+        entry = self.chats.get(key)
+        if entry is None:
+            entry = self.chats[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        self.max_chat_backlog = max(self.max_chat_backlog, entry[1])
+        self.waiting_chat += 1
+        self.publish()
+        try:
+            # asyncio.Lock будит ожидающих по порядку — апдейты чата идут в порядке поступления;
+            # пока апдейт ждёт свой чат, общий слот он не занимает
+            try:
+                await entry[0].acquire()
+            except BaseException:
+                coroutine.close()
+                raise
+            finally:
+                self.waiting_chat -= 1
+            try:
+                await self.run(coroutine)
+            finally:
+                entry[0].release()
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.chats[key]
+            self.publish()
+    
+    async def run(self, coroutine):
+        """Выполняет апдейт в общем слоте: слот берётся, только когда апдейт чата дошёл до выполнения"""
+        self.waiting_slot += 1
+        self.publish()
+        try:
+            await self.slots.acquire()
+        except BaseException:
+            coroutine.close()
+            raise
+        finally:
+            self.waiting_slot -= 1
+        self.running += 1
+        self.publish()
+        try:
+            await coroutine
+        finally:
+            self.running -= 1
+            self.slots.release()
+            self.publish()
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
 
 # ====== ЗАПУСК БОТА ======
+BACKGROUND_TASKS = []
+
+async def post_init(app: Application):
+    """Запускает HTTP-сервер и фоновые задачи в цикле событий бота"""
+    await start_http_server(app)
+    BACKGROUND_TASKS.append(asyncio.create_task(db_flusher()))
+    BACKGROUND_TASKS.append(asyncio.create_task(premium_expirer()))
+    BACKGROUND_TASKS.append(asyncio.create_task(horoscope_cache_warmer()))
+    BACKGROUND_TASKS.append(asyncio.create_task(metrics_roller()))
+    BACKGROUND_TASKS.append(asyncio.create_task(loop_lag_monitor()))
+    resume_broadcasts(app.bot)
+
+async def post_stop(app: Application):
+    """Дожидается отправки ответов, останавливает фоновые задачи; db_flusher при отмене сбрасывает БД на диск"""
+    try:
+        await asyncio.wait_for(SEND_PIPELINE.flush(), 10)
+    except asyncio.TimeoutError:
+        logger.warning("⚠️ Не все ответы успели уйти до остановки")
+    for task in BACKGROUND_TASKS:
+        task.cancel()
+    await asyncio.gather(*BACKGROUND_TASKS, return_exceptions=True)
+    BACKGROUND_TASKS.clear()
+    db.flush()
+    METRICS.save_current()
+    await stop_http_server()
+
+def build_application(request=None, concurrent_updates=None):
+    """
+    Собирает Application со всеми обработчиками (request — подмена Bot API для бенчмарков).
+    concurrent_updates — сколько апдейтов разных чатов обрабатывать одновременно (по умолчанию UPDATE_CONCURRENCY).
+    """
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .concurrent_updates(ChatOrderedUpdateProcessor(concurrent_updates or UPDATE_CONCURRENCY))
+    )
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    app = builder.build()
+    
+    # Контекст апдейта — до всех остальных обработчиков
+    app.add_handler(TypeHandler(Update, prepare_update_context), group=-1)
+    
+    # Основные обработчики
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("help", start))
+    app.add_handler(MessageHandler(filters.Regex(r'^(🔮 Гороскоп|🔢 Нумерология|🃏 Таро|💎 Премиум|⭐ Премиум активен|📊 Статистика|ℹ️ Помощь)$'), handle_main_menu))
+    app.add_handler(MessageHandler(filters.Regex(r'^(♈️ Овен|♉️ Телец|♊️ Близнецы|♋️ Рак|♌️ Лев|♍️ Дева|♎️ Весы|♏️ Скорпион|♐️ Стрелец|♑️ Козерог|♒️ Водолей|♓️ Рыбы|🔙 Назад в меню)$'), handle_zodiac_selection))
+    app.add_handler(MessageHandler(filters.Regex(r'^\d{2}\.\d{2}\.\d{4}$'), handle_numerology_input))
+    app.add_handler(CallbackQueryHandler(handle_tarot_callback, pattern="^tarot_"))
+    app.add_handler(CallbackQueryHandler(handle_premium_callback, pattern="^premium_"))
+    app.add_handler(CallbackQueryHandler(handle_back_callback, pattern="^back_"))
+    app.add_handler(PreCheckoutQueryHandler(pre_checkout_handler))
+    app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_handler))
+    app.add_handler(ChatMemberHandler(handle_my_chat_member, ChatMemberHandler.MY_CHAT_MEMBER))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_main_menu))
+    
+    # Админские обработчики
+    app.add_handler(CommandHandler("admin", admin_panel))
+    app.add_handler(MessageHandler(filters.TEXT & filters.User(ADMIN_USER_ID), handle_admin_commands))
+    app.add_handler(CallbackQueryHandler(handle_admin_callback, pattern="^admin_"))
+    # Текст рассылки — отдельной группой: в группе 0 его перехватывает общий обработчик меню
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.User(ADMIN_USER_ID), handle_broadcast_text), group=1)
+    
+    # Время и ошибки каждого обработчика — в метрики (служебная группа -1 не в счёт);
+    # пойманные самим обработчиком ошибки он отмечает через METRICS.mark_error()
+    for group, handlers in app.handlers.items():
+        if group < 0:
+            continue
+        for handler in handlers:
+            handler.callback = METRICS.timed(handler.callback)
+    
+    # Обработчик ошибок
+    app.add_error_handler(error_handler)
+    
+    return app
+
+async def start_webhook(app):
+    """Включает приём апдейтов на WEBHOOK_PATH и регистрирует адрес в Telegram"""
+    global WEBHOOK_ACTIVE
+    WEBHOOK_ACTIVE = True
+    await app.bot.set_webhook(
+        url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=Update.ALL_TYPES,
+        max_connections=min(100, UPDATE_CONCURRENCY),
+    )
+    logger.info(f"🪝 Webhook зарегистрирован: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+
+async def run_webhook(app):
+    """
+    Жизненный цикл в режиме webhook вручную (run_webhook из PTB требует tornado и свой порт):
+    initialize → post_init (HTTP-сервер, фоновые задачи) → start → set_webhook → ждём SIGTERM/SIGINT → stop.
+    Webhook при остановке не снимается: апдейты на время рестарта копятся у Telegram, а не теряются.
+    """
+    global WEBHOOK_ACTIVE
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+    await app.initialize()
+    try:
+        await app.post_init(app)
+        await app.start()
+        await start_webhook(app)
+        await stop_event.wait()
+    finally:
+        WEBHOOK_ACTIVE = False
+        if app.running:
+            await app.stop()
+        await app.post_stop(app)
+        await app.shutdown()
+
 def main():
     print("=" * 70)
     print("🔮 ЗАПУСК АСТРОЛОГИЧЕСКОГО БОТА")
@@ -1339,36 +3389,19 @@ def main():
     print("=" * 70)
     
     try:
-        app = Application.builder().token(BOT_TOKEN).build()
-        
-        # Основные обработчики
-        app.add_handler(CommandHandler("start", start))
-        app.add_handler(CommandHandler("help", start))
-        app.add_handler(MessageHandler(filters.Regex(r'^(🔮 Гороскоп|🔢 Нумерология|🃏 Таро|💎 Премиум|⭐ Премиум активен|📊 Статистика|ℹ️ Помощь)$'), handle_main_menu))
-        app.add_handler(MessageHandler(filters.Regex(r'^(♈️ Овен|♉️ Телец|♊️ Близнецы|♋️ Рак|♌️ Лев|♍️ Дева|♎️ Весы|♏️ Скорпион|♐️ Стрелец|♑️ Козерог|♒️ Водолей|♓️ Рыбы|🔙 Назад в меню)$'), handle_zodiac_selection))
-        app.add_handler(MessageHandler(filters.Regex(r'^\d{2}\.\d{2}\.\d{4}$'), handle_numerology_input))
-        app.add_handler(CallbackQueryHandler(handle_tarot_callback, pattern="^tarot_"))
-        app.add_handler(CallbackQueryHandler(handle_premium_callback, pattern="^premium_"))
-        app.add_handler(CallbackQueryHandler(handle_back_callback, pattern="^back_"))
-        app.add_handler(PreCheckoutQueryHandler(pre_checkout_handler))
-        app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_handler))
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_main_menu))
+        if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+            raise ValueError("для BOT_MODE=webhook нужен WEBHOOK_URL")
+        app = build_application()
         
-        # Админские обработчики
-        app.add_handler(CommandHandler("admin", admin_panel))
-        app.add_handler(MessageHandler(filters.TEXT & filters.User(ADMIN_USER_ID), handle_admin_commands))
-        app.add_handler(MessageHandler(filters.TEXT & filters.User(ADMIN_USER_ID), handle_broadcast_text))
-        app.add_handler(CallbackQueryHandler(handle_admin_callback, pattern="^admin_"))
-        
-        # Обработчик ошибок
-        app.add_error_handler(error_handler)
-        
-        print("✅ Бот запущен и готов к работе!")
+        print("✅ Бот запущен и готов к работе! Режим: " + BOT_MODE)
         print("📱 Напишите /start в Telegram")
         print("👑 Админ-команда: /admin")
         print("=" * 70)
         
-        app.run_polling(drop_pending_updates=True)
+        if BOT_MODE == 'webhook':
+            asyncio.run(run_webhook(app))
+        else:
+            app.run_polling(drop_pending_updates=True)
         
     except KeyboardInterrupt:
         print("\n👋 Бот остановлен пользователем")
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ЭФЕМЕРИДЫ ЛУНЫ: ТАБЛИЦА ФАЗ
+Моменты новолуний, четвертей и полнолуний считаются по рядам Меёса
+(Jean Meeus, «Astronomical Algorithms», гл. 49; точность — минуты) один раз
+на диапазон лет. Границы фаз лежат в отсортированном array('d') unix-времён,
+коды фаз — в array('B'); «фаза в момент t» — bisect по массиву, а для запросов
+внутри того же интервала, что и прошлый, — вообще без поиска.
+"""
+
+import math
+from array import array
+from bisect import bisect_right
+from datetime import datetime, timezone
+
+SYNODIC_MONTH = 29.530588861
+# Главная фаза (новолуние, четверть, полнолуние) длится ±1/16 синодического месяца вокруг точного момента
+PRINCIPAL_WINDOW_DAYS = SYNODIC_MONTH / 16
+
+# Коды фаз — индексы для текстов в боте; порядок соответствует ходу лунного цикла
+NEW_MOON_END = 0      # последние часы перед новолунием
+NEW_MOON = 1
+WAXING_CRESCENT = 2
+FIRST_QUARTER = 3
+WAXING_GIBBOUS = 4
+FULL_MOON = 5
+WANING_GIBBOUS = 6
+LAST_QUARTER = 7
+WANING_CRESCENT = 8
+
+JD_UNIX_EPOCH = 2440587.5
+
+# ---- Ряды Меёса (гл. 49) ----
+# Аргументы периодических членов: (коэф. M', коэф. M, коэф. F, степень E)
+NEW_FULL_ARGUMENTS = (
+    (1, 0, 0, 0), (0, 1, 0, 1), (2, 0, 0, 0), (0, 0, 2, 0), (1, -1, 0, 1), (1, 1, 0, 1),
+    (0, 2, 0, 2), (1, 0, -2, 0), (1, 0, 2, 0), (2, 1, 0, 1), (3, 0, 0, 0), (0, 1, 2, 1),
+    (0, 1, -2, 1), (2, -1, 0, 1), (1, 2, 0, 0), (2, 0, -2, 0), (0, 3, 0, 0),
+    (1, 1, -2, 0), (2, 0, 2, 0), (1, 1, 2, 0), (1, -1, 2, 0), (1, -1, -2, 0), (3, 1, 0, 0), (4, 0, 0, 0),
+)
+NEW_MOON_COEFFICIENTS = (
+    -0.40720, 0.17241, 0.01608, 0.01039, 0.00739, -0.00514, 0.00208, -0.00111, -0.00057, 0.00056,
+    -0.00042, 0.00042, 0.00038, -0.00024, -0.00007, 0.00004, 0.00004, 0.00003, 0.00003, -0.00003,
+    0.00003, -0.00002, -0.00002, 0.00002,
+)
+FULL_MOON_COEFFICIENTS = (
+    -0.40614, 0.17302, 0.01614, 0.01043, 0.00734, -0.00515, 0.00209, -0.00111, -0.00057, 0.00056,
+    -0.00042, 0.00042, 0.00038, -0.00024, -0.00007, 0.00004, 0.00004, 0.00003, 0.00003, -0.00003,
+    0.00003, -0.00002, -0.00002, 0.00002,
+)
+QUARTER_TERMS = (
+    (-0.62801, (1, 0, 0, 0)), (0.17172, (0, 1, 0, 1)), (-0.01183, (1, 1, 0, 1)), (0.00862, (2, 0, 0, 0)),
+    (0.00804, (0, 0, 2, 0)), (0.00454, (1, -1, 0, 1)), (0.00204, (0, 2, 0, 2)), (-0.00180, (1, 0, -2, 0)),
+    (-0.00070, (1, 0, 2, 0)), (-0.00040, (3, 0, 0, 0)), (-0.00034, (2, -1, 0, 1)), (0.00032, (0, 1, 2, 1)),
+    (0.00032, (0, 1, -2, 1)), (-0.00028, (1, 2, 0, 2)), (0.00027, (2, 1, 0, 1)), (-0.00005, (1, -1, -2, 0)),
+    (0.00004, (2, 0, 2, 0)), (-0.00004, (1, 1, 2, 0)), (0.00004, (1, -2, 0, 0)), (0.00003, (1, 1, -2, 0)),
+    (0.00003, (0, 3, 0, 0)), (0.00002, (2, 0, -2, 0)), (0.00002, (1, -1, 2, 0)), (-0.00002, (3, 1, 0, 0)),
+)
+# Планетные поправки: (A0, скорость по k, член при T², амплитуда)
+PLANETARY_TERMS = (
+    (299.77, 0.107408, -0.009173, 0.000325), (251.88, 0.016321, 0, 0.000165), (251.83, 26.651886, 0, 0.000164),
+    (349.42, 36.412478, 0, 0.000126), (84.66, 18.206239, 0, 0.000110), (141.74, 53.303771, 0, 0.000062),
+    (207.14, 2.453732, 0, 0.000060), (154.84, 7.306860, 0, 0.000056), (34.52, 27.261239, 0, 0.000047),
+    (207.19, 0.121824, 0, 0.000042), (291.34, 1.844379, 0, 0.000040), (161.72, 24.198154, 0, 0.000037),
+    (239.56, 25.513099, 0, 0.000035), (331.55, 3.592518, 0, 0.000023),
+)
+
+def phase_jde(k):
+    """
+    Юлианская эфемеридная дата главной фазы номер k: целое k — новолуние,
+    k + 0.25 — первая четверть, + 0.5 — полнолуние, + 0.75 — последняя четверть (k = 0 — 6 января 2000)
+    """
+    t = k / 1236.85
+    jde = (2451550.09766 + SYNODIC_MONTH * k + 0.00015437 * t ** 2
+           - 0.000000150 * t ** 3 + 0.00000000073 * t ** 4)
+    e = 1 - 0.002516 * t - 0.0000074 * t ** 2
+    m = math.radians(2.5534 + 29.10535670 * k - 0.0000014 * t ** 2 - 0.00000011 * t ** 3)
+    mp = math.radians(201.5643 + 385.81693528 * k + 0.0107582 * t ** 2
+                      + 0.00001238 * t ** 3 - 0.000000058 * t ** 4)
+    f = math.radians(160.7108 + 390.67050284 * k - 0.0016118 * t ** 2
+                     - 0.00000227 * t ** 3 + 0.000000011 * t ** 4)
+    omega = math.radians(124.7746 - 1.56375588 * k + 0.0020672 * t ** 2 + 0.00000215 * t ** 3)
+
+    fraction = round((k % 1) * 4) % 4
+    if fraction in (0, 2):
+        coefficients = NEW_MOON_COEFFICIENTS if fraction == 0 else FULL_MOON_COEFFICIENTS
+        terms = zip(coefficients, NEW_FULL_ARGUMENTS)
+    else:
+        terms = QUARTER_TERMS
+    correction = -0.00017 * math.sin(omega)
+    for coefficient, (a_mp, a_m, a_f, e_power) in terms:
+        correction += coefficient * e ** e_power * math.sin(a_mp * mp + a_m * m + a_f * f)
+    if fraction in (1, 3):
+        w = (0.00306 - 0.00038 * e * math.cos(m) + 0.00026 * math.cos(mp) - 0.00002 * math.cos(mp - m)
+             + 0.00002 * math.cos(mp + m) + 0.00002 * math.cos(2 * f))
+        correction += w if fraction == 1 else -w
+
+    for a0, rate, t2, amplitude in PLANETARY_TERMS:
+        correction += amplitude * math.sin(math.radians(a0 + rate * k + t2 * t ** 2))
+    return jde + correction
+
+def delta_t_seconds(year):
+    """ΔT = TD − UT (полиномы Эспенака–Меёса); для фаз Луны хватает точности в секунды"""
+    if 2005 <= year < 2050:
+        t = year - 2000
+        return 62.92 + 0.32217 * t + 0.005589 * t ** 2
+    if 1986 <= year < 2005:
+        t = year - 2000
+        return 63.86 + 0.3345 * t - 0.060374 * t ** 2 + 0.0017275 * t ** 3 + 0.000651814 * t ** 4 + 0.00002373599 * t ** 5
+    u = (year - 1820) / 100
+    if 2050 <= year < 2150:
+        return -20 + 32 * u ** 2 - 0.5628 * (2150 - year)
+    return -20 + 32 * u ** 2
+
+def jde_to_unix(jde):
+    unix_td = (jde - JD_UNIX_EPOCH) * 86400
+    year = 1970 + unix_td / (365.2425 * 86400)
+    return unix_td - delta_t_seconds(year)
+
+UNIX_EPOCH = datetime(1970, 1, 1)
+
+def to_timestamp(moment):
+    """
+    datetime или unix-время → unix-время. Наивное datetime считается UTC, как и в прежнем
+    расчёте по среднему циклу (на хостинге часы в UTC); это вычитание, без mktime.
+    """
+    if isinstance(moment, datetime):
+        if moment.tzinfo is None:
+            return (moment - UNIX_EPOCH).total_seconds()
+        return moment.timestamp()
+    return float(moment)
+
+class MoonPhaseTable:
+    """Границы фаз Луны на диапазон лет: boundaries[i] — начало интервала с кодом codes[i]"""
+
+    def __init__(self, start_year, end_year):
+        self.build(start_year, end_year)
+
+    def build(self, start_year, end_year):
+        self.start_year, self.end_year = start_year, end_year
+        first_k = math.floor((start_year - 2000) * 12.3685) - 1
+        last_k = math.ceil((end_year + 1 - 2000) * 12.3685) + 1
+        window = PRINCIPAL_WINDOW_DAYS * 86400
+        boundaries = array("d")
+        codes = array("B")
+        # Внутри цикла: новолуние → серп → четверть → ... → перед следующим новолунием
+        for k in range(first_k, last_k):
+            new_moon, first_quarter, full_moon, last_quarter, next_new_moon = (
+                jde_to_unix(phase_jde(k + quarter / 4)) for quarter in range(5)
+            )
+            for moment, code in (
+                (new_moon, NEW_MOON), (new_moon + window, WAXING_CRESCENT),
+                (first_quarter - window, FIRST_QUARTER), (first_quarter + window, WAXING_GIBBOUS),
+                (full_moon - window, FULL_MOON), (full_moon + window, WANING_GIBBOUS),
+                (last_quarter - window, LAST_QUARTER), (last_quarter + window, WANING_CRESCENT),
+                (next_new_moon - window, NEW_MOON_END),
+            ):
+                boundaries.append(moment)
+                codes.append(code)
+        self.boundaries = boundaries
+        self.codes = codes
+        # Последний найденный интервал: запросы «сейчас» почти всегда в него попадают
+        self.last = (0.0, 0.0, 0)
+
+    def covers(self, timestamp):
+        return self.boundaries[0] <= timestamp < self.boundaries[-1]
+
+    def phase_code(self, moment):
+        timestamp = to_timestamp(moment)
+        low, high, code = self.last
+        if low <= timestamp < high:
+            return code
+        if not self.covers(timestamp):
+            # Вне таблицы — достраиваем диапазон (редко: раз в годы работы)
+            year = datetime.fromtimestamp(timestamp, timezone.utc).year
+            self.build(min(self.start_year, year - 1), max(self.end_year, year + 1))
+        index = bisect_right(self.boundaries, timestamp) - 1
+        code = self.codes[index]
+        self.last = (self.boundaries[index], self.boundaries[index + 1], code)
+        return code
+
+    def events(self, start, end):
+        """Точные моменты главных фаз в [start, end): [(unix-время, код)], для проверки и отладки"""
+        start, end = to_timestamp(start), to_timestamp(end)
+        window = PRINCIPAL_WINDOW_DAYS * 86400
+        result = []
+        for boundary, code in zip(self.boundaries, self.codes):
+            if code == NEW_MOON:
+                moment = boundary
+            elif code in (FIRST_QUARTER, FULL_MOON, LAST_QUARTER):
+                moment = boundary + window
+            else:
+                continue
+            if start <= moment < end:
+                result.append((moment, code))
+        return result
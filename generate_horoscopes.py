@@ -3,118 +3,270 @@
 """
 ГЕНЕРАТОР ПРЕМИУМ БАЗЫ ГОРОСКОПОВ
 Запустите 1 раз перед развёртыванием на хостинге
-Создаст файл horoscopes_premium.json с 4380 уникальными гороскопами (365 дней × 12 знаков)
+Создаст файл horoscopes_premium.bin с 4380 уникальными гороскопами (365 дней × 12 знаков)
+(бинарное хранилище с индексом по дате и знаку, бот читает его через mmap — см. horoscope_store.py)
+
+    python generate_horoscopes.py                          # 365 дней с сегодняшнего
+    python generate_horoscopes.py --days 1826 --seed 42    # 5 лет, воспроизводимо
+    python generate_horoscopes.py --years 10 --seed 42 --workers 0   # параллельно на всех ядрах
+    python generate_horoscopes.py --output horoscopes_premium.jsonl.gz   # текстовый формат, день на строку
+
+Генерация пакетная: индексы шаблонов для всех дней × знаков вытягиваются разом,
+тексты собираются подстановкой в заранее разобранный шаблон и сразу уходят на диск.
 """
 
-import json
+import argparse
+import multiprocessing
+import os
 import random
+import time
 from datetime import datetime, timedelta
+from functools import lru_cache
 
-def generate_premium_horoscopes():
-    """Генерация базы ПРЕМИУМ гороскопов с максимальным разнообразием"""
-    
-    months_ru = {1: "января", 2: "февраля", 3: "марта", 4: "апреля", 5: "мая", 6: "июня",
-                 7: "июля", 8: "августа", 9: "сентября", 10: "октября", 11: "ноября", 12: "декабря"}
-    
-    zodiac_themes = {
-        "♈️ Овен": {"element": "🔥 Огонь", "planet": "Марс", "planet_gen": "Марса", "colors": ["красный", "оранжевый"], "stones": ["рубин", "гранат"]},
-        "♉️ Телец": {"element": "🌍 Земля", "planet": "Венера", "planet_gen": "Венеры", "colors": ["зеленый", "розовый"], "stones": ["изумруд", "розовый кварц"]},
-        "♊️ Близнецы": {"element": "💨 Воздух", "planet": "Меркурий", "planet_gen": "Меркурия", "colors": ["желтый", "голубой"], "stones": ["цитрин", "аквамарин"]},
-        "♋️ Рак": {"element": "💧 Вода", "planet": "Луна", "planet_gen": "Луны", "colors": ["серебристый", "белый"], "stones": ["лунный камень", "жемчуг"]},
-        "♌️ Лев": {"element": "🔥 Огонь", "planet": "Солнце", "planet_gen": "Солнца", "colors": ["золотой", "оранжевый"], "stones": ["янтарь", "тигровый глаз"]},
-        "♍️ Дева": {"element": "🌍 Земля", "planet": "Меркурий", "planet_gen": "Меркурия", "colors": ["коричневый", "зеленый"], "stones": ["нефрит", "авантюрин"]},
-        "♎️ Весы": {"element": "💨 Воздух", "planet": "Венера", "planet_gen": "Венеры", "colors": ["голубой", "розовый"], "stones": ["опал", "розовый турмалин"]},
-        "♏️ Скорпион": {"element": "💧 Вода", "planet": "Плутон", "planet_gen": "Плутона", "colors": ["черный", "бордовый"], "stones": ["обсидиан", "рубин"]},
-        "♐️ Стрелец": {"element": "🔥 Огонь", "planet": "Юпитер", "planet_gen": "Юпитера", "colors": ["фиолетовый", "синий"], "stones": ["лазурит", "аметист"]},
-        "♑️ Козерог": {"element": "🌍 Земля", "planet": "Сатурн", "planet_gen": "Сатурна", "colors": ["черный", "коричневый"], "stones": ["оникс", "дымчатый кварц"]},
-        "♒️ Водолей": {"element": "💨 Воздух", "planet": "Уран", "planet_gen": "Урана", "colors": ["синий", "серебристый"], "stones": ["аметист", "лабрадорит"]},
-        "♓️ Рыбы": {"element": "💧 Вода", "planet": "Нептун", "planet_gen": "Нептуна", "colors": ["фиолетовый", "морской волны"], "stones": ["аметист", "аквамарин"]}
-    }
-    
-    # Шаблоны для максимального разнообразия
-    energy = ["Энергия {} сегодня создает уникальные возможности", "Космические вибрации усиливают вашу связь с высшими силами",
-              "Луна в {} фазе открывает порталы для новых начинаний", "Планетарные аспекты формируют благоприятную атмосферу"]
-    
-    love = ["Сегодня Вселенная посылает знаки в сердечных делах", "Энергия Венеры гармонизирует ваши отношения",
-            "Кармические встречи возможны сегодня — будьте открыты", "Глубокие эмоциональные разговоры укрепят связь"]
-    
-    career = ["Профессиональные возможности расширяются под влиянием Юпитера", "Финансовые потоки активируются — будьте внимательны",
-              "Космические энергии поддерживают ваши амбиции", "Сегодня удачный день для переговоров"]
-    
-    health = ["Энергетический баланс сегодня особенно важен", "Космические энергии способствуют детоксу и очищению",
-              "Ментальное здоровье требует внимания — медитация принесет ясность", "Физическая активность принесет двойную пользу"]
-    
-    advice = ["Доверяйте потоку событий и следуйте за синхроничностями", "Настоящая сила в умении быть гибким, как вода",
-              "Обращайте внимание на повторяющиеся числа и символы", "Ваши мысли сегодня особенно сильны — направляйте их с любовью"]
-    
-    horoscopes = {}
-    start_date = datetime.now()
-    
-    print("🚀 Генерация ПРЕМИУМ базы гороскопов (365 дней × 12 знаков)...")
-    
-    for day in range(365):
-        date = start_date + timedelta(days=day)
-        date_str = date.strftime("%Y-%m-%d")
-        date_ru = f"{date.day} {months_ru[date.month]} {date.year} года"
-        horoscopes[date_str] = {}
-        
-        if day % 50 == 0:
-            print(f"  📅 {day}/365 дней ({date_ru})")
-        
-        for sign_name, sign_data in zodiac_themes.items():
-            horoscope = f"""✨ *Гороскоп {sign_name}* ✨
+from horoscope_store import HoroscopeStore, HoroscopeStoreWriter, open_store_writer
+from templates import Template, prepare_pool
+from ephemeris import MoonPhaseTable
+
+MONTHS_RU = {1: "января", 2: "февраля", 3: "марта", 4: "апреля", 5: "мая", 6: "июня",
+             7: "июля", 8: "августа", 9: "сентября", 10: "октября", 11: "ноября", 12: "декабря"}
+
+ZODIAC_THEMES = {
+    "♈️ Овен": {"element": "🔥 Огонь", "planet": "Марс", "planet_gen": "Марса", "colors": ["красный", "оранжевый"], "stones": ["рубин", "гранат"]},
+    "♉️ Телец": {"element": "🌍 Земля", "planet": "Венера", "planet_gen": "Венеры", "colors": ["зеленый", "розовый"], "stones": ["изумруд", "розовый кварц"]},
+    "♊️ Близнецы": {"element": "💨 Воздух", "planet": "Меркурий", "planet_gen": "Меркурия", "colors": ["желтый", "голубой"], "stones": ["цитрин", "аквамарин"]},
+    "♋️ Рак": {"element": "💧 Вода", "planet": "Луна", "planet_gen": "Луны", "colors": ["серебристый", "белый"], "stones": ["лунный камень", "жемчуг"]},
+    "♌️ Лев": {"element": "🔥 Огонь", "planet": "Солнце", "planet_gen": "Солнца", "colors": ["золотой", "оранжевый"], "stones": ["янтарь", "тигровый глаз"]},
+    "♍️ Дева": {"element": "🌍 Земля", "planet": "Меркурий", "planet_gen": "Меркурия", "colors": ["коричневый", "зеленый"], "stones": ["нефрит", "авантюрин"]},
+    "♎️ Весы": {"element": "💨 Воздух", "planet": "Венера", "planet_gen": "Венеры", "colors": ["голубой", "розовый"], "stones": ["опал", "розовый турмалин"]},
+    "♏️ Скорпион": {"element": "💧 Вода", "planet": "Плутон", "planet_gen": "Плутона", "colors": ["черный", "бордовый"], "stones": ["обсидиан", "рубин"]},
+    "♐️ Стрелец": {"element": "🔥 Огонь", "planet": "Юпитер", "planet_gen": "Юпитера", "colors": ["фиолетовый", "синий"], "stones": ["лазурит", "аметист"]},
+    "♑️ Козерог": {"element": "🌍 Земля", "planet": "Сатурн", "planet_gen": "Сатурна", "colors": ["черный", "коричневый"], "stones": ["оникс", "дымчатый кварц"]},
+    "♒️ Водолей": {"element": "💨 Воздух", "planet": "Уран", "planet_gen": "Урана", "colors": ["синий", "серебристый"], "stones": ["аметист", "лабрадорит"]},
+    "♓️ Рыбы": {"element": "💧 Вода", "planet": "Нептун", "planet_gen": "Нептуна", "colors": ["фиолетовый", "морской волны"], "stones": ["аметист", "аквамарин"]}
+}
+
+# Шаблоны для максимального разнообразия
+ENERGY = ["Энергия {planet_gen} сегодня создает уникальные возможности", "Космические вибрации усиливают вашу связь с высшими силами",
+          "Луна в {moon_phase} фазе открывает порталы для новых начинаний", "Планетарные аспекты формируют благоприятную атмосферу"]
+# Прилагательное для «Луна в ... фазе» по коду фазы ephemeris (0..8) — по настоящей фазе дня
+MOON_PHASES = ["новой", "растущей", "полной", "убывающей"]
+MOON_PHASE_BY_CODE = (0, 0, 1, 1, 1, 2, 3, 3, 3)
+
+LOVE = ["Сегодня Вселенная посылает знаки в сердечных делах", "Энергия Венеры гармонизирует ваши отношения",
+        "Кармические встречи возможны сегодня — будьте открыты", "Глубокие эмоциональные разговоры укрепят связь"]
+
+CAREER = ["Профессиональные возможности расширяются под влиянием Юпитера", "Финансовые потоки активируются — будьте внимательны",
+          "Космические энергии поддерживают ваши амбиции", "Сегодня удачный день для переговоров"]
+
+HEALTH = ["Энергетический баланс сегодня особенно важен", "Космические энергии способствуют детоксу и очищению",
+          "Ментальное здоровье требует внимания — медитация принесет ясность", "Физическая активность принесет двойную пользу"]
+
+ADVICE = ["Доверяйте потоку событий и следуйте за синхроничностями", "Настоящая сила в умении быть гибким, как вода",
+          "Обращайте внимание на повторяющиеся числа и символы", "Ваши мысли сегодня особенно сильны — направляйте их с любовью"]
+
+MOON_SIGNS = ['Овне', 'Тельце', 'Близнецах', 'Раке', 'Льве', 'Деве', 'Весах', 'Скорпионе', 'Стрельце', 'Козероге', 'Водолее', 'Рыбах']
+GOOD_TIMES = ['утро 9-11', 'день 14-16', 'вечер 19-21']
+MEDITATIONS = ['осознанности', 'любви-доброты', 'визуализации']
+
+PREMIUM_TEMPLATE = Template("""✨ *Гороскоп {sign}* ✨
 
 *На {date_ru}*
 
-{random.choice(energy).format(sign_data['planet_gen'], random.choice(['новой', 'растущей', 'полной']))}
+{energy}
 
-*Элемент:* {sign_data["element"]}
-*Планета-покровитель:* {sign_data["planet"]}
-*Цвета удачи:* {', '.join(sign_data['colors'])}
-*Камни-талисманы:* {', '.join(sign_data['stones'])}
+*Элемент:* {element}
+*Планета-покровитель:* {planet}
+*Цвета удачи:* {colors}
+*Камни-талисманы:* {stones}
 
 💖 *Любовь и отношения:*
-{random.choice(love)}
+{love}
 
 💼 *Карьера и финансы:*
-{random.choice(career)}
+{career}
 
 🌿 *Здоровье и энергетика:*
-{random.choice(health)}
+{health}
 
 💫 *Совет дня:*
-{random.choice(advice)}
+{advice}
 
 *Дополнительно для премиум:*
-🌠 Луна в {random.choice(['Овне', 'Тельце', 'Близнецах', 'Раке', 'Льве', 'Деве', 'Весах', 'Скорпионе', 'Стрельце', 'Козероге', 'Водолее', 'Рыбах'])} усиливает вашу интуицию
-🔮 Благоприятное время: {random.choice(['утро 9-11', 'день 14-16', 'вечер 19-21'])}
-📿 Медитация: практикуйте {random.choice(['осознанности', 'любви-доброты', 'визуализации'])} для гармонизации чакр
-
-#{sign_name.split()[-1]} #Астрология #Гороскоп #Премиум"""
-            
-            horoscopes[date_str][sign_name] = horoscope
-    
-    print("✅ Генерация завершена!")
-    return horoscopes
-
-def save_premium_horoscopes():
-    horoscopes = generate_premium_horoscopes()
-    
-    with open('horoscopes_premium.json', 'w', encoding='utf-8') as f:
-        json.dump(horoscopes, f, ensure_ascii=False, indent=2)
-    
-    total_days = len(horoscopes)
-    total_horoscopes = sum(len(day) for day in horoscopes.values())
-    
+🌠 Луна в {moon_sign} усиливает вашу интуицию
+🔮 Благоприятное время: {good_time}
+📿 Медитация: практикуйте {meditation} для гармонизации чакр
+
+#{tag} #Астрология #Гороскоп #Премиум""")
+
+# Слоты, которые меняются от гороскопа к гороскопу; остальные подставляются один раз на знак
+DYNAMIC_SLOTS = ("date_ru", "energy", "love", "career", "health", "advice", "moon_sign", "good_time", "meditation")
+
+def compile_sign(sign_name, sign_data):
+    """Готовый шаблон знака и его варианты фразы об энергии: energy[фраза][фаза Луны]"""
+    static = {
+        "sign": sign_name,
+        "element": sign_data["element"],
+        "planet": sign_data["planet"],
+        "colors": ", ".join(sign_data["colors"]),
+        "stones": ", ".join(sign_data["stones"]),
+        "tag": sign_name.split()[-1],
+    }
+    energy = [prepare_pool(text.format(planet_gen=sign_data["planet_gen"], moon_phase=phase) for phase in MOON_PHASES)
+              for text in ENERGY]
+    template = PREMIUM_TEMPLATE.bind(**static)
+    positions = dict(template.positions)
+    return (template.pieces, tuple(positions[name] for name in DYNAMIC_SLOTS)), energy
+
+@lru_cache(maxsize=4)
+def moon_phase_table(first_year, last_year):
+    """Одна таблица фаз на процесс (и на каждый процесс пула) для всего диапазона генерации"""
+    return MoonPhaseTable(first_year, last_year)
+
+def iter_premium_horoscopes(start_date, days, rng, moon_table=None):
+    """
+    Пакетная генерация: по дню за раз отдаёт (дата, {знак: текст}).
+    Все случайные индексы для days × 12 гороскопов тянутся заранее — по массиву на слот,
+    дальше на каждый гороскоп только выборка по индексам и один ''.join.
+    Фаза Луны во фразе об энергии — настоящая, на полдень дня, из таблицы эфемерид.
+    """
+    if moon_table is None:
+        moon_table = moon_phase_table(start_date.year, (start_date + timedelta(days=days)).year)
+    signs = [(sign_name,) + compile_sign(sign_name, sign_data) for sign_name, sign_data in ZODIAC_THEMES.items()]
+    total = days * len(signs)
+    pools = tuple(prepare_pool(pool) for pool in (LOVE, CAREER, HEALTH, ADVICE, MOON_SIGNS, GOOD_TIMES, MEDITATIONS))
+    # Индексы по слотам → сразу выбранные фразы; строки не копируются, в списках только ссылки
+    energy_indexes = rng.choices(range(len(ENERGY)), k=total)
+    columns = [rng.choices(pool, k=total) for pool in pools]
+    rows = zip(energy_indexes, *columns)
+
+    for day in range(days):
+        date = start_date + timedelta(days=day)
+        date_ru = f"{date.day} {MONTHS_RU[date.month]} {date.year} года"
+        moon_phase = MOON_PHASE_BY_CODE[moon_table.phase_code(date.replace(hour=12, minute=0, second=0, microsecond=0))]
+        horoscopes = {}
+        for (sign_name, (pieces, positions), energy), row in zip(signs, rows):
+            p_date, p_energy, p_love, p_career, p_health, p_advice, p_moon, p_time, p_meditation = positions
+            parts = pieces[:]
+            parts[p_date] = date_ru
+            parts[p_energy] = energy[row[0]][moon_phase]
+            parts[p_love], parts[p_career], parts[p_health], parts[p_advice], \
+                parts[p_moon], parts[p_time], parts[p_meditation] = row[1:]
+            horoscopes[sign_name] = "".join(parts)
+        yield date.strftime("%Y-%m-%d"), horoscopes
+
+# ====== ШАРДЫ И ПАРАЛЛЕЛЬНАЯ ГЕНЕРАЦИЯ ======
+SHARD_DAYS = 31
+
+def plan_shards(start_date, days, shard_days=SHARD_DAYS):
+    """Диапазон дат → [(номер, первый день, дней)]; разбиение не зависит от числа процессов"""
+    return [(index, start_date + timedelta(days=offset), min(shard_days, days - offset))
+            for index, offset in enumerate(range(0, days, shard_days))]
+
+def shard_rng(seed, variant, shard_start):
+    """Своё зерно у каждого шарда: база одинакова при любом числе процессов"""
+    return random.Random(f"{seed}:{variant}:{shard_start:%Y-%m-%d}")
+
+def shard_path(path, index):
+    return f"{path}.shard-{index:04d}"
+
+def generate_shard(task):
+    """Выполняется в процессе пула: пишет шард в отдельный файл хранилища"""
+    path, index, shard_start, days, seed, variant, years = task
+    count = 0
+    with HoroscopeStoreWriter(shard_path(path, index)) as store:
+        for date_str, day in iter_premium_horoscopes(shard_start, days, shard_rng(seed, variant, shard_start),
+                                                     moon_phase_table(*years)):
+            store.add_day(date_str, day)
+            count += len(day)
+    return index, days, count
+
+def merge_shard(store, path, index):
+    """Дописывает шард в итоговое хранилище (шарды идут по порядку дат) и удаляет его файл"""
+    shard = HoroscopeStore(shard_path(path, index), cache_days=0)
+    try:
+        for date_str in shard.dates():
+            store.add_day(date_str, shard.load_day(date_str))
+    finally:
+        shard.close()
+        os.remove(shard_path(path, index))
+
+def print_progress(done_days, days, count, started):
+    elapsed = time.perf_counter() - started
+    print(f"\r  📅 {done_days}/{days} дней · {count / elapsed if elapsed else 0:.0f} гороскопов/сек", end="", flush=True)
+
+def save_premium_horoscopes(path='horoscopes_premium.bin', days=365, start_date=None, seed=None,
+                            variant="", workers=1, shard_days=SHARD_DAYS):
+    """
+    Генерирует базу по шардам дат и пишет в хранилище, которое читает бот.
+    workers=1 — всё в этом процессе прямо в итоговый файл; иначе шарды считаются в пуле процессов,
+    пишутся в отдельные файлы и сливаются по мере готовности. Результат при одном seed одинаков.
+    """
+    start_date = (start_date or datetime.now()).replace(hour=0, minute=0, second=0, microsecond=0)
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    shards = plan_shards(start_date, days, shard_days)
+    years = (start_date.year, (start_date + timedelta(days=days)).year)
+
+    print(f"🚀 Генерация ПРЕМИУМ базы гороскопов ({days} дней × {len(ZODIAC_THEMES)} знаков)...")
+    print(f"  🎲 seed={seed}{' вариант=' + variant if variant else ''}, шардов: {len(shards)}, процессов: {workers}")
+    started = time.perf_counter()
+    total_days = total_horoscopes = 0
+    with open_store_writer(path) as store:
+        if workers <= 1:
+            for index, shard_start, shard_length in shards:
+                for date_str, day in iter_premium_horoscopes(shard_start, shard_length, shard_rng(seed, variant, shard_start),
+                                                             moon_phase_table(*years)):
+                    store.add_day(date_str, day)
+                    total_horoscopes += len(day)
+                total_days += shard_length
+                print_progress(total_days, days, total_horoscopes, started)
+        else:
+            tasks = [(path, index, shard_start, shard_length, seed, variant, years)
+                     for index, shard_start, shard_length in shards]
+            with multiprocessing.Pool(workers) as pool:
+                try:
+                    # imap отдаёт шарды по порядку: пока пул считает следующие, готовые уже сливаются
+                    for index, shard_length, count in pool.imap(generate_shard, tasks):
+                        merge_shard(store, path, index)
+                        total_days += shard_length
+                        total_horoscopes += count
+                        print_progress(total_days, days, total_horoscopes, started)
+                finally:
+                    for index, _, _ in shards:
+                        for leftover in (shard_path(path, index), shard_path(path, index) + ".tmp"):
+                            if os.path.exists(leftover):
+                                os.remove(leftover)
+    elapsed = time.perf_counter() - started
+    print("\n✅ Генерация завершена!")
+
     print("\n" + "=" * 60)
     print("📊 СТАТИСТИКА ПРЕМИУМ БАЗЫ:")
     print("=" * 60)
     print(f"📅 Дней: {total_days}")
-    print(f"🔮 Гороскопов: {total_horoscopes} (12 знаков × 365 дней)")
-    print(f"💾 Размер файла: ~{total_horoscopes * 1.8:.0f} КБ")
+    print(f"🔮 Гороскопов: {total_horoscopes} ({len(ZODIAC_THEMES)} знаков × {total_days} дней)")
+    print(f"💾 Размер файла: {os.path.getsize(path) / 1024:.0f} КБ")
+    print(f"⏱ Время: {elapsed:.2f} сек ({total_horoscopes / elapsed:.0f} гороскопов/сек, "
+          f"{os.path.getsize(path) / 1024 / 1024 / elapsed:.1f} МБ/сек; процессов: {workers})")
     print("=" * 60)
-    print("\n✅ Файл horoscopes_premium.json успешно создан!")
+    print(f"\n✅ Файл {path} успешно создан!")
     print("📁 Этот файл нужно загрузить вместе с ботом на хостинг.")
 
+def main():
+    parser = argparse.ArgumentParser(description="Генерация премиум базы гороскопов")
+    parser.add_argument("--days", type=int, default=365, help="сколько дней сгенерировать")
+    parser.add_argument("--years", type=int, help="сколько лет сгенерировать (вместо --days)")
+    parser.add_argument("--start", help="первый день, ГГГГ-ММ-ДД (по умолчанию сегодня)")
+    parser.add_argument("--seed", type=int, help="зерно генератора для воспроизводимой базы")
+    parser.add_argument("--variant", default="", help="имя набора: другой вариант — другие тексты при том же seed")
+    parser.add_argument("--workers", type=int, default=1, help="процессов генерации (0 — по числу ядер)")
+    parser.add_argument("--shard-days", type=int, default=SHARD_DAYS, help="дней в одном шарде")
+    parser.add_argument("--output", default="horoscopes_premium.bin",
+                        help="файл базы; .jsonl или .jsonl.gz — компактный JSON по дню на строку")
+    args = parser.parse_args()
+    start_date = datetime.strptime(args.start, "%Y-%m-%d") if args.start else None
+    days = args.years * 365 + args.years // 4 if args.years else args.days
+    workers = args.workers or os.cpu_count() or 1
+    save_premium_horoscopes(args.output, days, start_date, args.seed, args.variant, workers, args.shard_days)
+
 if __name__ == "__main__":
-    save_premium_horoscopes()
+    main()
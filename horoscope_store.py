@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ХРАНИЛИЩЕ ПРЕМИУМ ГОРОСКОПОВ (horoscopes_premium.bin)
+Пишется generate_horoscopes.py, читается ботом через mmap: в память декодируются
+только запрошенные дни, а не вся база целиком.
+
+Текстовый вариант — horoscopes_premium.jsonl (или .jsonl.gz): одна строка компактного
+JSON на день, {"date": "ГГГГ-ММ-ДД", "signs": {знак: текст}}. Пишется потоково,
+читается по смещениям строк — разбирается только запрошенный день.
+
+Формат файла (все числа little-endian):
+    [тексты UTF-8 подряд]
+    [индекс: записи INDEX_ENTRY, отсортированы по (дата, номер знака)]
+    [таблица знаков: JSON-список названий]
+    [футер: FOOTER]
+"""
+
+import gzip
+import json
+import mmap
+import os
+import struct
+from functools import lru_cache
+
+STORE_MAGIC = b"HOROBIN1"
+# дата 'YYYY-MM-DD', номер знака в таблице знаков, смещение текста, длина текста
+INDEX_ENTRY = struct.Struct("<10sBQI")
+# смещение индекса, число записей, смещение таблицы знаков, длина таблицы знаков, магия
+FOOTER = struct.Struct("<QIQI8s")
+
+class HoroscopeStoreWriter:
+    """Потоковая запись: тексты уходят на диск сразу, в памяти копится только индекс"""
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.file = open(self.tmp_path, "wb")
+        self.offset = 0
+        self.signs = []
+        self.sign_numbers = {}
+        self.index = []
+
+    def add(self, date_str, sign, text):
+        number = self.sign_numbers.get(sign)
+        if number is None:
+            number = self.sign_numbers[sign] = len(self.signs)
+            self.signs.append(sign)
+        data = text.encode("utf-8")
+        self.file.write(data)
+        self.index.append((date_str.encode("ascii"), number, self.offset, len(data)))
+        self.offset += len(data)
+
+    def add_day(self, date_str, day):
+        for sign, text in day.items():
+            self.add(date_str, sign, text)
+
+    def close(self):
+        self.index.sort(key=lambda entry: (entry[0], entry[1]))
+        index_offset = self.offset
+        self.file.write(b"".join(INDEX_ENTRY.pack(*entry) for entry in self.index))
+        signs = json.dumps(self.signs, ensure_ascii=False).encode("utf-8")
+        signs_offset = index_offset + INDEX_ENTRY.size * len(self.index)
+        self.file.write(signs)
+        self.file.write(FOOTER.pack(index_offset, len(self.index), signs_offset, len(signs), STORE_MAGIC))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        # Атомарная подмена: уже открытые ботом mmap продолжают видеть старый файл
+        os.replace(self.tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+            os.remove(self.tmp_path)
+
+class HoroscopeStore:
+    """Чтение через mmap с бинарным поиском по индексу и LRU последних дней"""
+
+    def __init__(self, path, cache_days=8):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        index_offset, self.count, signs_offset, signs_length, magic = FOOTER.unpack_from(
+            self.mm, len(self.mm) - FOOTER.size
+        )
+        if magic != STORE_MAGIC:
+            raise ValueError(f"{path}: неизвестный формат хранилища")
+        self.index_offset = index_offset
+        self.signs = json.loads(self.mm[signs_offset:signs_offset + signs_length].decode("utf-8"))
+        self.get_day = lru_cache(maxsize=cache_days)(self.load_day)
+
+    def __len__(self):
+        return self.count
+
+    def entry(self, position):
+        return INDEX_ENTRY.unpack_from(self.mm, self.index_offset + position * INDEX_ENTRY.size)
+
+    def first_position(self, date_key):
+        """Первая запись индекса с датой >= date_key (бинарный поиск прямо по mmap)"""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.entry(middle)[0] < date_key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def load_day(self, date_str):
+        """Все знаки за день {знак: текст}; пустой словарь, если дня нет в базе"""
+        date_key = date_str.encode("ascii")
+        day = {}
+        position = self.first_position(date_key)
+        while position < self.count:
+            entry_date, number, offset, length = self.entry(position)
+            if entry_date != date_key:
+                break
+            day[self.signs[number]] = self.mm[offset:offset + length].decode("utf-8")
+            position += 1
+        return day
+
+    def dates(self):
+        """Все даты базы по порядку (читается только индекс, тексты не трогаются)"""
+        previous = None
+        for position in range(self.count):
+            date_key = self.entry(position)[0]
+            if date_key != previous:
+                previous = date_key
+                yield date_key.decode("ascii")
+
+    def close(self):
+        self.mm.close()
+
+class DictHoroscopeStore:
+    """Тот же интерфейс поверх старого horoscopes_premium.json, загруженного целиком"""
+
+    def __init__(self, horoscopes):
+        self.horoscopes = horoscopes
+        self.count = sum(len(day) for day in horoscopes.values())
+
+    def __len__(self):
+        return self.count
+
+    def get_day(self, date_str):
+        return self.horoscopes.get(date_str, {})
+
+    def dates(self):
+        return iter(sorted(self.horoscopes))
+
+    def close(self):
+        pass
+
+JSONL_DATE_PREFIX = b'{"date":"'
+
+def open_jsonl(path, mode, compressed=None):
+    """.gz — через gzip, остальное — обычный файл; режим бинарный"""
+    if compressed is None:
+        compressed = path.endswith(".gz")
+    if compressed:
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+class JsonlHoroscopeStoreWriter:
+    """Потоковая запись по дню на строку: в памяти не держится ничего, кроме текущего дня"""
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.file = open_jsonl(self.tmp_path, "wb", compressed=path.endswith(".gz"))
+        self.day = None
+        self.day_date = None
+
+    def write_day(self):
+        if self.day:
+            line = json.dumps({"date": self.day_date, "signs": self.day}, ensure_ascii=False, separators=(",", ":"))
+            self.file.write(line.encode("utf-8") + b"\n")
+        self.day = None
+
+    def add(self, date_str, sign, text):
+        if date_str != self.day_date:
+            self.write_day()
+            self.day_date = date_str
+            self.day = {}
+        self.day[sign] = text
+
+    def add_day(self, date_str, day):
+        self.write_day()
+        self.day_date = date_str
+        self.day = dict(day)
+
+    def close(self):
+        self.write_day()
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+            os.remove(self.tmp_path)
+
+class JsonlHoroscopeStore:
+    """
+    Один проход при открытии запоминает только смещение строки каждого дня (дата берётся
+    из начала строки, JSON не разбирается); get_day читает и разбирает одну строку.
+    В .gz переход к смещению дороже (распаковка с начала) — выручает LRU последних дней.
+    """
+
+    def __init__(self, path, cache_days=8):
+        self.path = path
+        self.offsets = {}
+        with open_jsonl(path, "rb") as f:
+            offset = 0
+            for line in f:
+                if line.startswith(JSONL_DATE_PREFIX):
+                    date_str = line[len(JSONL_DATE_PREFIX):len(JSONL_DATE_PREFIX) + 10].decode("ascii")
+                else:
+                    date_str = json.loads(line)["date"]
+                self.offsets[date_str] = offset
+                offset += len(line)
+        self.file = open_jsonl(path, "rb")
+        self.get_day = lru_cache(maxsize=cache_days)(self.load_day)
+        # Генератор пишет все знаки в каждый день — число записей оценивается по первому дню
+        first_day = self.load_day(min(self.offsets)) if self.offsets else {}
+        self.count = len(first_day) * len(self.offsets)
+
+    def __len__(self):
+        return self.count
+
+    def load_day(self, date_str):
+        offset = self.offsets.get(date_str)
+        if offset is None:
+            return {}
+        self.file.seek(offset)
+        return json.loads(self.file.readline())["signs"]
+
+    def dates(self):
+        return iter(sorted(self.offsets))
+
+    def close(self):
+        self.file.close()
+
+def open_store_writer(path):
+    """Формат по расширению: .jsonl / .jsonl.gz — текстовый, иначе бинарный"""
+    if path.endswith((".jsonl", ".jsonl.gz")):
+        return JsonlHoroscopeStoreWriter(path)
+    return HoroscopeStoreWriter(path)
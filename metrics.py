@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+МЕТРИКИ ИСПОЛЬЗОВАНИЯ БОТА
+Поминутное кольцо счётчиков и гистограмм задержек по каждому обработчику
+плюс почасовые и посуточные свёртки, которые копятся на диске.
+
+Файлы в папке метрик:
+    hourly.jsonl  — одна строка на завершённый час
+    daily.jsonl   — одна строка на завершённые сутки
+    current.json  — незавершённые час и сутки на момент остановки бота
+Строка: {"t": начало периода (epoch), "h": {обработчик: [запросы, ошибки, сумма мс, гистограмма]}}
+
+Для /metrics (формат Prometheus) те же записи копятся ещё и в накопительных итогах с момента старта.
+"""
+
+import bisect
+import contextvars
+import functools
+import json
+import os
+import time
+from collections import deque
+from threading import Lock
+
+# Верхние границы корзин гистограммы задержек, мс (последняя корзина — всё, что дольше)
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+MINUTES_KEEP = 180
+HOURS_KEEP = 24 * 31
+DAYS_KEEP = 400
+
+# Флаг ошибки текущего вызова обработчика: обработчики ловят свои исключения сами и отмечают их через mark_error()
+HANDLER_ERROR = contextvars.ContextVar('handler_error', default=None)
+
+def new_stats():
+    return [0, 0, 0.0, [0] * (len(LATENCY_BUCKETS_MS) + 1)]
+
+def merge_stats(target, stats):
+    target[0] += stats[0]
+    target[1] += stats[1]
+    target[2] += stats[2]
+    histogram = target[3]
+    for position, count in enumerate(stats[3]):
+        histogram[position] += count
+
+def merge_periods(periods):
+    """Несколько периодов {обработчик: статистика} → один"""
+    merged = {}
+    for period in periods:
+        for handler, stats in period.items():
+            merge_stats(merged.setdefault(handler, new_stats()), stats)
+    return merged
+
+def percentile(histogram, q):
+    """Оценка перцентиля по гистограмме (линейно внутри корзины), мс"""
+    total = sum(histogram)
+    if not total:
+        return 0.0
+    rank = q * total
+    seen = 0
+    for position, count in enumerate(histogram):
+        if count and seen + count >= rank:
+            low = LATENCY_BUCKETS_MS[position - 1] if position else 0.0
+            if position == len(LATENCY_BUCKETS_MS):
+                return float(low)
+            return low + (LATENCY_BUCKETS_MS[position] - low) * (rank - seen) / count
+        seen += count
+    return float(LATENCY_BUCKETS_MS[-1])
+
+def describe(stats):
+    count, errors, total_ms, histogram = stats
+    return {
+        'count': count,
+        'errors': errors,
+        'avg_ms': round(total_ms / count, 1) if count else 0.0,
+        'p50_ms': round(percentile(histogram, 0.50), 1),
+        'p95_ms': round(percentile(histogram, 0.95), 1),
+        'p99_ms': round(percentile(histogram, 0.99), 1),
+    }
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        key + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for key, value in labels.items()
+    )
+    return "{" + ",".join(escaped) + "}"
+
+def prometheus_lines(name, metric_type, help_text, samples):
+    """Одна метрика в текстовом формате Prometheus; samples — [(метки, значение)]"""
+    lines = ["# HELP " + name + " " + help_text, "# TYPE " + name + " " + metric_type]
+    for labels, value in samples:
+        lines.append(name + format_labels(labels) + " " + repr(float(value)))
+    return lines
+
+def hour_start(now):
+    return int(now // 3600) * 3600
+
+def day_start(now):
+    """Локальная полночь — сутки считаются так же, как даты гороскопов"""
+    local = time.localtime(now)
+    return int(time.mktime((local.tm_year, local.tm_mon, local.tm_mday, 0, 0, 0, 0, 0, -1)))
+
+class MetricsStore:
+    """
+    Запись из обработчиков — несколько сложений под неконкурентной блокировкой;
+    на диск завершённые часы и сутки дописывает roll() из фоновой задачи.
+    """
+
+    def __init__(self, directory='data/metrics', minutes=MINUTES_KEEP):
+        self.directory = directory
+        self.lock = Lock()
+        self.minute_keys = [-1] * minutes
+        self.minute_data = [{} for _ in range(minutes)]
+        now = time.time()
+        self.hour, self.hour_data = hour_start(now), {}
+        self.day, self.day_data = day_start(now), {}
+        self.next_rotation = self.rotation_time()
+        self.hourly = deque(maxlen=HOURS_KEEP)
+        self.daily = deque(maxlen=DAYS_KEEP)
+        self.unsaved = {'hourly': [], 'daily': []}
+        self.file_lines = {'hourly': 0, 'daily': 0}
+        # С момента старта: гистограммы обработчиков и простые счётчики/показатели.
+        # counters и gauges меняются только из цикла событий, читаются копией — без блокировок
+        self.totals = {}
+        self.counters = {}
+        self.gauges = {}
+        self.load()
+
+    # ---- Запись ----
+    def record(self, handler, seconds, error=False):
+        now = time.time()
+        ms = seconds * 1000
+        bucket = bisect.bisect_left(LATENCY_BUCKETS_MS, ms)
+        minute = int(now // 60)
+        with self.lock:
+            if now >= self.next_rotation:
+                self.rotate(now)
+            slot = minute % len(self.minute_keys)
+            if self.minute_keys[slot] != minute:
+                self.minute_keys[slot] = minute
+                self.minute_data[slot] = {}
+            for period in (self.minute_data[slot], self.hour_data, self.day_data, self.totals):
+                stats = period.get(handler)
+                if stats is None:
+                    stats = period[handler] = new_stats()
+                stats[0] += 1
+                stats[1] += error
+                stats[2] += ms
+                stats[3][bucket] += 1
+
+    def inc(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+
+    def mark_error(self):
+        """Засчитать ошибку текущему обработчику (вызывать из его except)"""
+        flag = HANDLER_ERROR.get()
+        if flag is not None:
+            flag[0] = True
+
+    def timed(self, callback, name=None):
+        """Обёртка обработчика PTB: время выполнения, исключения и ошибки из mark_error() пишутся в метрики"""
+        name = name or callback.__name__
+
+        @functools.wraps(callback)
+        async def wrapper(update, context):
+            started = time.perf_counter()
+            flag = [False]
+            token = HANDLER_ERROR.set(flag)
+            try:
+                return await callback(update, context)
+            except BaseException:
+                flag[0] = True
+                raise
+            finally:
+                HANDLER_ERROR.reset(token)
+                self.record(name, time.perf_counter() - started, flag[0])
+        return wrapper
+
+    def rotation_time(self):
+        # Ближайшая из границ: следующий час или следующая локальная полночь (сутки бывают 23–25 ч)
+        return min(self.hour + 3600, day_start(self.day + 26 * 3600))
+
+    def rotate(self, now):
+        """Закрывает завершившиеся час и сутки (вызывать под self.lock)"""
+        hour = hour_start(now)
+        if hour != self.hour:
+            if self.hour_data:
+                self.hourly.append((self.hour, self.hour_data))
+                self.unsaved['hourly'].append((self.hour, self.hour_data))
+            self.hour, self.hour_data = hour, {}
+        day = day_start(now)
+        if day != self.day:
+            if self.day_data:
+                self.daily.append((self.day, self.day_data))
+                self.unsaved['daily'].append((self.day, self.day_data))
+            self.day, self.day_data = day, {}
+        self.next_rotation = self.rotation_time()
+
+    # ---- Диск ----
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def load(self):
+        for name, target in (('hourly', self.hourly), ('daily', self.daily)):
+            path = self.path(name + '.jsonl')
+            if not os.path.exists(path):
+                continue
+            torn = False
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Оборванная строка после аварийной остановки
+                        torn = True
+                        continue
+                    target.append((record['t'], record['h']))
+                    self.file_lines[name] += 1
+            if torn:
+                # Иначе следующая дописанная строка склеится с оборванной
+                self.compact(name)
+        path = self.path('current.json')
+        if os.path.exists(path):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    current = json.load(f)
+            except ValueError:
+                current = {}
+            for name, key in (('hourly', 'hour'), ('daily', 'day')):
+                if key not in current:
+                    continue
+                start, data = current[key]
+                if start == getattr(self, key):
+                    setattr(self, key + '_data', data)
+                else:
+                    # Бот стоял через границу периода — период завершён, допишем его в файл
+                    getattr(self, name).append((start, data))
+                    self.unsaved[name].append((start, data))
+            os.remove(path)
+
+    def roll(self):
+        """Дописывает завершённые периоды на диск; вызывается из фоновой задачи в пуле потоков"""
+        with self.lock:
+            self.rotate(time.time())
+            unsaved = self.unsaved
+            self.unsaved = {'hourly': [], 'daily': []}
+        for name, periods in unsaved.items():
+            if not periods:
+                continue
+            os.makedirs(self.directory, exist_ok=True)
+            lines = "".join(json.dumps({'t': start, 'h': data}, separators=(',', ':')) + "\n" for start, data in periods)
+            with open(self.path(name + '.jsonl'), 'a', encoding='utf-8') as f:
+                f.write(lines)
+            self.file_lines[name] += len(periods)
+            keep = self.hourly.maxlen if name == 'hourly' else self.daily.maxlen
+            if self.file_lines[name] > 2 * keep:
+                self.compact(name)
+
+    def compact(self, name):
+        """Переписывает файл свёрток, оставляя только то, что помещается в память"""
+        with self.lock:
+            periods = list(self.hourly if name == 'hourly' else self.daily)
+        path = self.path(name + '.jsonl')
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            for start, data in periods:
+                f.write(json.dumps({'t': start, 'h': data}, separators=(',', ':')) + "\n")
+        os.replace(path + '.tmp', path)
+        self.file_lines[name] = len(periods)
+
+    def save_current(self):
+        """При остановке бота сохраняет незавершённые час и сутки"""
+        self.roll()
+        with self.lock:
+            current = {'hour': [self.hour, self.hour_data], 'day': [self.day, self.day_data]}
+            payload = json.dumps(current, separators=(',', ':'))
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path('current.json.tmp'), 'w', encoding='utf-8') as f:
+            f.write(payload)
+        os.replace(self.path('current.json.tmp'), self.path('current.json'))
+
+    # ---- Запросы ----
+    def recent(self, minutes=60):
+        """Сводка по обработчикам за последние minutes минут: {обработчик: describe()}"""
+        last = int(time.time() // 60)
+        with self.lock:
+            periods = [
+                data for key, data in zip(self.minute_keys, self.minute_data)
+                if last - min(minutes, len(self.minute_keys)) < key <= last
+            ]
+            merged = merge_periods(periods)
+        return {handler: describe(stats) for handler, stats in merged.items()}
+
+    def series(self, period='hour', count=24):
+        """Ряд по часам или суткам (с текущим незавершённым): [{'t', 'count', 'errors', 'p95_ms', ...}]"""
+        with self.lock:
+            if period == 'hour':
+                history = list(self.hourly)[-(count - 1):] if count > 1 else []
+                history.append((self.hour, self.hour_data))
+            else:
+                history = list(self.daily)[-(count - 1):] if count > 1 else []
+                history.append((self.day, self.day_data))
+            points = []
+            for start, data in history:
+                total = new_stats()
+                for stats in data.values():
+                    merge_stats(total, stats)
+                point = describe(total)
+                point['t'] = start
+                points.append(point)
+        return points
+
+    def handlers(self, period='hour', count=24):
+        """Сводка по обработчикам за последние count часов или суток"""
+        with self.lock:
+            if period == 'hour':
+                history = [data for _, data in list(self.hourly)[-(count - 1):]] if count > 1 else []
+                history.append(self.hour_data)
+            else:
+                history = [data for _, data in list(self.daily)[-(count - 1):]] if count > 1 else []
+                history.append(self.day_data)
+            merged = merge_periods(history)
+        return {handler: describe(stats) for handler, stats in merged.items()}
+
+    def prometheus(self, prefix):
+        """Гистограммы задержек и ошибки обработчиков с момента старта в формате Prometheus"""
+        with self.lock:
+            totals = {handler: (stats[0], stats[1], stats[2], list(stats[3])) for handler, stats in self.totals.items()}
+        name = prefix + "_handler_duration_seconds"
+        lines = ["# HELP " + name + " Время обработки апдейта обработчиком", "# TYPE " + name + " histogram"]
+        for handler, (count, errors, total_ms, histogram) in sorted(totals.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS_MS, histogram):
+                cumulative += bucket_count
+                lines.append(name + "_bucket" + format_labels({'handler': handler, 'le': repr(bound / 1000)}) + " " + str(cumulative))
+            lines.append(name + "_bucket" + format_labels({'handler': handler, 'le': '+Inf'}) + " " + str(count))
+            lines.append(name + "_sum" + format_labels({'handler': handler}) + " " + repr(total_ms / 1000))
+            lines.append(name + "_count" + format_labels({'handler': handler}) + " " + str(count))
+        lines += prometheus_lines(
+            prefix + "_handler_errors_total", "counter", "Исключения в обработчиках",
+            [({'handler': handler}, stats[1]) for handler, stats in sorted(totals.items())]
+        )
+        return lines
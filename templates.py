@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+КОМПИЛИРУЕМЫЕ ШАБЛОНЫ ГОРОСКОПОВ
+Шаблон в синтаксисе str.format ({имя}) разбирается один раз в список кусков:
+литералы и слоты строго чередуются (литерал, слот, литерал, ...; между соседними слотами —
+пустой литерал), так что слоты стоят на нечётных позициях. Рендер копирует список кусков,
+одним срезом pieces[1::2] вписывает значения слотов (в порядке slots) и делает один ''.join —
+без повторного разбора шаблона, без словаря аргументов и без промежуточных строк.
+Постоянные поля (знак, период суток) подставляются заранее через bind().
+"""
+
+import sys
+from string import Formatter
+
+MARKDOWN_SPECIAL = "_*`["
+
+def escape_markdown(text):
+    """Экранирование для parse_mode='Markdown' (первая версия разметки)"""
+    for char in MARKDOWN_SPECIAL:
+        if char in text:
+            text = text.replace(char, "\\" + char)
+    return text
+
+def prepare_pool(texts):
+    """Пул фраз: экранирован под Markdown и интернирован один раз при загрузке"""
+    return tuple(sys.intern(escape_markdown(text)) for text in texts)
+
+class Slot:
+    """Незаполненный слот при разборе и bind()"""
+
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+
+class Template:
+    """
+    Разобранный шаблон: pieces — литералы на чётных позициях и None на местах слотов (нечётных),
+    positions — (имя, позиция)
+    """
+
+    __slots__ = ("pieces", "positions")
+
+    def __init__(self, source=None, pieces=None):
+        if pieces is None:
+            pieces = self.split(source)
+        self.pieces = []
+        self.positions = []
+        for piece in pieces:
+            if isinstance(piece, Slot):
+                if not self.pieces or self.pieces[-1] is None:
+                    self.pieces.append("")
+                self.positions.append((piece.name, len(self.pieces)))
+                self.pieces.append(None)
+            elif self.pieces and self.pieces[-1] is not None:
+                # Соседние литералы склеиваются — меньше кусков на каждый рендер
+                self.pieces[-1] += piece
+            else:
+                self.pieces.append(piece)
+
+    def fill(self, values):
+        """
+        values — значения слотов в порядке self.slots (кортеж или список).
+        Без именованных аргументов и словаря: копия кусков, значения одним срезом на нечётные позиции, один ''.join
+        """
+        pieces = self.pieces[:]
+        pieces[1::2] = values
+        return "".join(pieces)
+
+    @staticmethod
+    def split(source):
+        pieces = []
+        for literal, field, format_spec, conversion in Formatter().parse(source):
+            if literal:
+                pieces.append(literal)
+            if field is not None:
+                if format_spec or conversion:
+                    raise ValueError(f"формат и преобразования в слоте {{{field}}} не поддерживаются")
+                pieces.append(Slot(field))
+        return pieces
+
+    @property
+    def slots(self):
+        return tuple(name for name, _ in self.positions)
+
+    def bind(self, **values):
+        """Новый шаблон с подставленными полями values; остальные слоты остаются слотами"""
+        positions = dict((position, name) for name, position in self.positions)
+        pieces = []
+        for index, piece in enumerate(self.pieces):
+            if piece is not None:
+                pieces.append(piece)
+            elif positions[index] in values:
+                pieces.append(values[positions[index]])
+            else:
+                pieces.append(Slot(positions[index]))
+        return Template(pieces=pieces)